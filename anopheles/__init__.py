@@ -1,11 +1,10 @@
 import os,sys
 import anopheles
-import anopheles_query
-from anopheles_query import *
 import species
 
-
-for mod in ['query_to_rec','model','spatial_submodels','utils','env_data','mahalanobis_covariance','mapping','validation_metrics','constrained_mvn_sample','constraints','step_methods']:
+# Plotting and database dependencies are imported on first use, so importing
+# the package is cheap and needs neither a display nor a database.
+for mod in ['query_to_rec','sessions','model','factor_cache','inducing_points','spatial_submodels','vecchia','utils','raster_store','cache_store','eo_sampling','multiband','env_data','bundles','mahalanobis_covariance','mapping','validation_metrics','constrained_mvn_sample','constraints','step_methods']:
     try:
         exec('from %s import *'%mod)
     except ImportError:
@@ -0,0 +1,202 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Species bundles: the prepared inputs of a species model.
+
+A bundle holds everything make_model needs that comes from the database or
+the raster store: the expert-opinion inducing points, the sites and their
+counts, the covariates extracted at all of those locations and the
+covariates' normalization stats. Bundles can be written to self-contained
+HDF5 files, so models can be run where there is no database or data server.
+"""
+
+import os
+import warnings
+import numpy as np
+import tables as tb
+from query_to_rec import sample_eo, sites_as_ndarray, list_species
+from env_data import extract_environment_many
+from cache_store import write_values, read_values
+from sessions import prefetch_species
+
+__all__ = ['SpeciesBundle', 'species_bundle', 'prepare_species', 'write_bundle', 'load_bundle', 'select_covariates', 'as_bundle']
+
+class SpeciesBundle(object):
+    """
+    The prepared, database-free inputs of a species model. Locations are in
+    radians. env_in, env_out and env_x hold the covariates named by
+    env_variables at pts_in, pts_out and x respectively. If env_means and
+    env_stds aren't given they are computed over the inducing points.
+    """
+    arrays = ['pts_in', 'pts_out', 'breaks', 'x', 'found', 'zero', 'others_found',
+                'env_in', 'env_out', 'env_x', 'env_means', 'env_stds']
+
+    def __init__(self, species, env_variables, n_inducing, pts_in, pts_out, breaks, x, found, zero, others_found,
+                    env_in, env_out, env_x, env_means=None, env_stds=None):
+        self.species = tuple(species)
+        self.env_variables = list(env_variables)
+        self.n_inducing = n_inducing
+        self.pts_in = pts_in
+        self.pts_out = pts_out
+        self.breaks = breaks
+        self.x = x
+        self.found = found
+        self.zero = zero
+        self.others_found = others_found
+        n = len(self.env_variables)
+        self.env_in = np.reshape(env_in, (len(pts_in), n))
+        self.env_out = np.reshape(env_out, (len(pts_out), n))
+        self.env_x = np.reshape(env_x, (len(x), n))
+
+        # Record the means and standard deviations, because the surfaces will be scaled and shifted
+        # according to those before input into the fields.
+        env_eo = np.vstack((self.env_in, self.env_out))
+        self.env_means = np.mean(env_eo, axis=0) if env_means is None else env_means
+        self.env_stds = np.std(env_eo, axis=0) if env_stds is None else env_stds
+
+    def __repr__(self):
+        return '<SpeciesBundle for %s: %i sites, %i inducing points, %i covariates>'%\
+            (self.species[1], len(self.found), len(self.pts_in)+len(self.pts_out), len(self.env_variables))
+
+def species_inputs(session, species, n_inducing):
+    "Queries the inducing points and sites of a species, in the order species_bundle takes them."
+    pts_in, pts_out = sample_eo(session, species, n_inducing)
+    breaks, x, found, zero, others_found, multipoints = sites_as_ndarray(session, species)
+    return pts_in, pts_out, breaks, x, found, zero, others_found
+
+def species_bundle(session, species, env_variables=None, n_inducing=1000):
+    "Prepares the bundle of a single species."
+    return prepare_species(session, [species], env_variables, n_inducing)[0]
+
+def resolve_species(session, species):
+    """
+    Converts a species given as an (id, name) tuple or as one of the modules in
+    anopheles.species to an (id, name) tuple and the module's covariates, if
+    any.
+    """
+    if hasattr(species, 'species_name'):
+        ids = dict([sp[::-1] for sp in list_species(session)])
+        return (ids[species.species_name], species.species_name), getattr(species, 'env', None)
+    return tuple(species), None
+
+def prepare_species(session, species, env_variables=None, n_inducing=1000, dirname=None, factory=None):
+    """
+    Prepares bundles for a list of species in one pass. The species can be
+    (id, name) tuples from list_species or modules from anopheles.species, in
+    which case the modules' env lists override env_variables. If
+    env_variables is None, other species have no covariates. Every covariate
+    is extracted once, over the union of all the species' inducing points and
+    sites. If dirname is given each bundle is also written to a file there,
+    named after the species. Returns the list of bundles.
+    
+    If a session factory is given, each species' queries run in the
+    background while the previous species' geometry is processed; see
+    prefetch_species. session can then be None.
+    """
+    if session is None:
+        session = factory()
+    resolved = [resolve_species(session, s) for s in species]
+    names = [sp for sp, env in resolved]
+    layers = [list(env if env is not None else env_variables or ()) for sp, env in resolved]
+    if factory is None:
+        inputs = [species_inputs(session, sp, n_inducing) for sp in names]
+    else:
+        inputs = [species_inputs(session, sp, n_inducing) for sp, sites, eo in prefetch_species(names, factory)]
+
+    all_layers = []
+    for l in layers:
+        all_layers.extend([n for n in l if n not in all_layers])
+    locations = [np.vstack((pts_in, pts_out, x)) for pts_in, pts_out, breaks, x, found, zero, others_found in inputs]
+    env_all = extract_environment_many(all_layers, np.vstack(locations)*180./np.pi)
+
+    bundles = []
+    start = 0
+    for sp, l, inp, loc in zip(names, layers, inputs, locations):
+        pts_in, pts_out, breaks, x, found, zero, others_found = inp
+        env = env_all[start:start+len(loc)][:, [all_layers.index(n) for n in l]]
+        start += len(loc)
+        n_in = len(pts_in)
+        n_eo = n_in + len(pts_out)
+        bundle = SpeciesBundle(sp, l, n_inducing, pts_in, pts_out, breaks, x, found, zero, others_found,
+                                env[:n_in], env[n_in:n_eo], env[n_eo:])
+        if dirname is not None:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            write_bundle(bundle, os.path.join(dirname, sp[1]+'.hdf5'))
+        bundles.append(bundle)
+
+    return bundles
+
+def write_bundle(bundle, hf, where='/'):
+    """
+    Writes a bundle to the group where in hf, which can be an open HDF5 file
+    or a path. If it is a path the file is overwritten.
+    """
+    if isinstance(hf, basestring):
+        tmp = hf + '.tmp'
+        f = tb.openFile(tmp, 'w')
+        try:
+            write_bundle(bundle, f, where)
+        finally:
+            f.close()
+        os.rename(tmp, hf)
+        return
+    values = dict([(name, getattr(bundle, name)) for name in bundle.arrays])
+    values['meta'] = {'species': bundle.species, 'env_variables': bundle.env_variables, 'n_inducing': bundle.n_inducing}
+    write_values(hf, where, values)
+
+def load_bundle(hf, where='/'):
+    "Reads a bundle written by write_bundle from an open HDF5 file or a path."
+    if isinstance(hf, basestring):
+        f = tb.openFile(hf)
+        try:
+            return load_bundle(f, where)
+        finally:
+            f.close()
+    values = read_values(hf.getNode(where))
+    meta = values.pop('meta')
+    return SpeciesBundle(meta['species'], meta['env_variables'], meta['n_inducing'], **values)
+
+def select_covariates(bundle, env_variables):
+    "Returns a copy of a bundle holding only the named covariates, in the given order."
+    missing = [n for n in env_variables if n not in bundle.env_variables]
+    if len(missing) > 0:
+        raise ValueError, 'The bundle for %s does not hold covariates %s.'%(bundle.species[1], ', '.join(missing))
+    cols = [bundle.env_variables.index(n) for n in env_variables]
+    return SpeciesBundle(bundle.species, env_variables, bundle.n_inducing, bundle.pts_in, bundle.pts_out, bundle.breaks, bundle.x,
+                            bundle.found, bundle.zero, bundle.others_found, bundle.env_in[:,cols], bundle.env_out[:,cols],
+                            bundle.env_x[:,cols], bundle.env_means[cols], bundle.env_stds[cols])
+
+def as_bundle(source, species=None, env_variables=None, n_inducing=1000):
+    """
+    Returns the bundle of a model's inputs. source can be a SpeciesBundle, the
+    path of a bundle file, or a database session, in which case the bundle is
+    prepared from the database and the raster store. A bundle must hold all of
+    env_variables, and only those are kept, so if env_variables is empty none
+    are. If env_variables is None, all the bundle's covariates are kept.
+    """
+    if isinstance(source, basestring):
+        source = load_bundle(source)
+    if not isinstance(source, SpeciesBundle):
+        return species_bundle(source, species, env_variables, n_inducing)
+    
+    if species is not None and tuple(species) != source.species:
+        raise ValueError, 'The bundle is for %s, not %s.'%(source.species[1], species[1])
+    if n_inducing != source.n_inducing:
+        warnings.warn('The bundle for %s has %i inducing points, not %i.'%(source.species[1], source.n_inducing, n_inducing))
+    if env_variables is None or list(env_variables) == source.env_variables:
+        return source
+    return select_covariates(source, env_variables)
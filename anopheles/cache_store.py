@@ -0,0 +1,236 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import os, tempfile, time
+import hashlib
+import cPickle
+import numpy as np
+import tables as tb
+
+__all__ = ['CacheStore', 'cache_store', 'set_cache_store', 'write_values', 'read_values']
+
+def write_values(hf, where, values, chunked=()):
+    """
+    Writes a dictionary of named values under the group where of an open HDF5
+    file. Arrays are written as arrays, compressed and chunked if their names
+    are in chunked, and everything else is pickled.
+    """
+    for name, value in values.iteritems():
+        if isinstance(value, np.ndarray) and value.size > 0 and value.dtype != np.object_:
+            if name in chunked:
+                arr = hf.createCArray(where, name, atom=tb.Atom.from_dtype(value.dtype), shape=value.shape,
+                                        filters=tb.Filters(complevel=1))
+                arr[:] = value
+            else:
+                hf.createArray(where, name, value)
+        else:
+            hf.createVLArray(where, name, atom=tb.ObjectAtom()).append(value)
+
+def read_values(group):
+    "Reads back a dictionary of values written by write_values."
+    out = {}
+    for node in group._f_iterNodes():
+        if isinstance(node, tb.VLArray):
+            out[node.name] = node[0]
+        elif isinstance(node, tb.Leaf):
+            out[node.name] = node[:]
+    return out
+
+class CacheStore(object):
+    """
+    An indexed, size-bounded store of cached arrays.
+
+    Each entry is a dictionary of named values, written to its own HDF5 file
+    in dirname. An index file maps keys to entries, so lookups don't depend on
+    the number of entries. Entries are written to a temporary file and renamed
+    into place, so readers never see a partial entry. When the entries'
+    total size exceeds max_bytes the least recently used ones are deleted,
+    except those that are open for reading.
+
+    Keys can be any tuple of strings and numbers. Values can be NumPy arrays
+    or any picklable objects.
+    """
+    def __init__(self, dirname='anopheles-caches', max_bytes=2**32):
+        self.dirname = dirname
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(dirname, 'INDEX')
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        self.index = {}
+        self._index_mtime = None
+        self._deleted = set()
+        self._open = {}
+        self._load_index()
+
+    def _load_index(self):
+        "Rereads the index if another process has changed it."
+        if not os.path.exists(self.index_path):
+            return
+        mtime = os.path.getmtime(self.index_path)
+        if mtime == self._index_mtime:
+            return
+        disk_index = cPickle.load(file(self.index_path, 'rb'))
+        for h, entry in disk_index.iteritems():
+            if h in self._deleted:
+                continue
+            if self.index.has_key(h):
+                entry['atime'] = max(entry['atime'], self.index[h]['atime'])
+            self.index[h] = entry
+        self._index_mtime = mtime
+
+    def _save_index(self):
+        self._load_index()
+        fd, tmp = tempfile.mkstemp(dir=self.dirname, prefix='.INDEX')
+        f = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(self.index, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        os.rename(tmp, self.index_path)
+        self._index_mtime = os.path.getmtime(self.index_path)
+        self._deleted = set()
+
+    def key_hash(self, key):
+        return hashlib.sha1(repr(key)).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.dirname, self.key_hash(key) + '.hdf5')
+
+    def _lookup(self, key):
+        "Returns the index entry for key, or None, counting hits and misses."
+        h = self.key_hash(key)
+        entry = self.index.get(h, None)
+        if entry is None:
+            self._load_index()
+            entry = self.index.get(h, None)
+        if entry is not None and not os.path.exists(self.path(key)):
+            # Deleted by another process.
+            self.index.pop(h)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry['atime'] = time.time()
+        return entry
+
+    def __contains__(self, key):
+        return self.index.has_key(self.key_hash(key)) and os.path.exists(self.path(key))
+
+    def get(self, key):
+        "Returns the dictionary of values stored under key, or None."
+        if self._lookup(key) is None:
+            return None
+        hf = tb.openFile(self.path(key))
+        try:
+            return read_values(hf.root)
+        finally:
+            hf.close()
+
+    def open(self, key):
+        """
+        Returns the open HDF5 file holding the values stored under key, or None,
+        for reading values lazily. The caller should close it.
+        """
+        if self._lookup(key) is None:
+            return None
+        hf = tb.openFile(self.path(key))
+        self._open.setdefault(self.key_hash(key), []).append(hf)
+        return hf
+
+    def _is_open(self, h):
+        "Whether the entry with hash h is open for reading."
+        handles = [hf for hf in self._open.pop(h, []) if hf.isopen]
+        if handles:
+            self._open[h] = handles
+        return len(handles) > 0
+
+    def put(self, key, values, chunked=(), fill=None):
+        """
+        Stores the dictionary of values under key. Arrays whose names are in
+        chunked are written compressed, with chunks suitable for reading in
+        tiles. If fill is given it is called with the open file once values
+        are written, to write arrays too large to hold in memory piece by
+        piece.
+        """
+        fd, tmp = tempfile.mkstemp(dir=self.dirname, prefix='.tmp', suffix='.hdf5')
+        os.close(fd)
+        try:
+            hf = tb.openFile(tmp, 'w')
+            try:
+                write_values(hf, '/', values, chunked)
+                if fill is not None:
+                    fill(hf)
+            finally:
+                hf.close()
+            os.rename(tmp, self.path(key))
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        self.index[self.key_hash(key)] = {'key': repr(key), 'nbytes': os.path.getsize(self.path(key)), 'atime': time.time()}
+        self.evict()
+        self._save_index()
+
+    def remove(self, key):
+        h = self.key_hash(key)
+        self.index.pop(h, None)
+        self._deleted.add(h)
+        if os.path.exists(self.path(key)):
+            os.remove(self.path(key))
+
+    def nbytes(self):
+        return sum([entry['nbytes'] for entry in self.index.itervalues()])
+
+    def evict(self):
+        "Deletes least recently used entries until the store is within max_bytes."
+        total = self.nbytes()
+        if total <= self.max_bytes:
+            return
+        by_age = sorted(self.index.iteritems(), key=lambda item: item[1]['atime'])
+        for h, entry in by_age[:-1]:
+            if total <= self.max_bytes:
+                break
+            if self._is_open(h):
+                continue
+            self.index.pop(h)
+            self._deleted.add(h)
+            path = os.path.join(self.dirname, h + '.hdf5')
+            if os.path.exists(path):
+                os.remove(path)
+            total -= entry['nbytes']
+
+    def stats(self):
+        "Returns a dictionary of hit and miss counts and the store's size."
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.index), 'nbytes': self.nbytes()}
+
+_store = None
+
+def cache_store():
+    """
+    Returns the process-wide cache store, creating it on first use in the
+    directory 'anopheles-caches'. ANOPHELES_CACHE_BYTES sets its byte budget.
+    """
+    global _store
+    if _store is None:
+        _store = CacheStore('anopheles-caches', max_bytes=int(os.environ.get('ANOPHELES_CACHE_BYTES', 2**32)))
+    return _store
+
+def set_cache_store(store):
+    "Replaces the process-wide cache store."
+    global _store
+    _store = store
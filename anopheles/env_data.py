@@ -13,85 +13,367 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import os, subprocess
+import os
 import anopheles
-import map_utils
-import hashlib
-import tables as tb
+from raster_store import raster_store, raster_handle
+from cache_store import cache_store
+from multiband import stack_index, band_is_current
 import warnings
+import threading
+import multiprocessing, multiprocessing.pool
 import numpy as np
 
-__all__ = ['get_datafile','extract_environment']
+__all__ = ['get_datafile','extract_environment','extract_environment_many','extraction_stats','reset_extraction_stats','set_extraction_workers','layer_map']
 
 data_dirname = os.path.join(anopheles.__path__[0] ,'../datafiles')
 
 def get_datafile(name):
-    """Transparently synchronizes file with server (via ssh) and returns it."""
-    data_root = os.path.join(anopheles.__path__[0],'../datafiles')
-    path, name = os.path.split(name)
-    data_path = os.path.join(data_root, path)
-    fname = name+'.hdf5'
-    data_file = os.path.join(data_path, fname)    
-    remote_file = os.path.join('/srv/data',path,fname)
+    """
+    Returns the root of the named datafile, synchronizing it with the server
+    first if the raster store's manifest says the local copy is stale. The
+    file handle belongs to the raster store and should not be closed.
+    """
+    return raster_store().open(name).root
+
+def point_values_key(name):
+    """
+    The cache key of a layer's point values. It includes the layer's version,
+    so updating the layer invalidates them. Layers that only exist as bands
+    of a stack are keyed on the stack's version.
+    """
+    try:
+        version = raster_store().version(name)
+    except IOError:
+        index = stack_index()
+        if not index.has_key(name):
+            raise
+        version = ('stack', raster_store().version(index[name][0]))
+    return ('point_values', name, version)
+
+def grid_geometry(hr):
+    "A hashable description of a layer's grid. Layers with equal geometries share interpolation weights."
+    return (hr.view, hr.data.shape, len(hr.lon), hr.lon[0], hr.lon[-1], len(hr.lat), hr.lat[0], hr.lat[-1])
+
+def axis_weights(axis, x):
+    """
+    Returns the index of the grid node below each element of x along an
+    increasing axis, and the fractional distance to the node above. Locations
+    off the edge of the axis are clamped to it.
+    """
+    i = np.clip(np.searchsorted(axis, x) - 1, 0, max(len(axis)-2, 0))
+    if len(axis) < 2:
+        return i, np.zeros(len(x))
+    t = (x - axis[i]) / (axis[i+1] - axis[i])
+    return i, np.clip(t, 0, 1)
+
+def interpolation_weights(lon, lat, view, shape, x):
+    """
+    Returns rows, cols and weights, each of shape (len(x), 4): the indices into
+    the data array of the four grid nodes surrounding each location and their
+    bilinear interpolation weights.
+    
+    lon and lat are the layer's coordinate axes, which are increasing; view
+    says how the axes map onto the data array's rows and columns.
+    """
+    i_lon, t = axis_weights(lon, x[:,0])
+    i_lat, u = axis_weights(lat, x[:,1])
+    n_lon = len(lon)
+    n_lat = len(lat)
+    
+    # The four corners, in lon/lat index space.
+    lon_ind = np.vstack((i_lon, np.minimum(i_lon+1, n_lon-1), i_lon, np.minimum(i_lon+1, n_lon-1))).T
+    lat_ind = np.vstack((i_lat, i_lat, np.minimum(i_lat+1, n_lat-1), np.minimum(i_lat+1, n_lat-1))).T
+    weights = np.vstack(((1-t)*(1-u), t*(1-u), (1-t)*u, t*u)).T
+    
+    # Map into data array space. The sign following each axis in the view
+    # says whether the data array runs along it forward or backward.
+    for axis, sign in ((view[0], view[1]), (view[2], view[3])):
+        if sign == '-':
+            if axis == 'x':
+                lon_ind = n_lon-1-lon_ind
+            else:
+                lat_ind = n_lat-1-lat_ind
+    if view[0] == 'x':
+        rows, cols = lon_ind, lat_ind
+    else:
+        rows, cols = lat_ind, lon_ind
+    
+    if len(x) > 0 and (rows.max() >= shape[0] or cols.max() >= shape[1]):
+        raise ValueError, 'View %s does not match data array of shape %s with %i longitudes and %i latitudes.'%(view, shape, n_lon, n_lat)
     
-    if not os.path.exists(data_path):
-        os.mkdir(data_path)
+    return rows, cols, weights
 
-    res = os.system('rsync --quiet map1.zoo.ox.ac.uk:%s %s'%(remote_file, data_file))
-    if res > 0:
-        warnings.warn('Failed to synchronize %s with server.'%name)
+# Counts of the reads made by read_points, for benchmarking.
+read_counts = {'chunk': 0, 'box': 0, 'point': 0}
+
+def extraction_stats():
+    "Returns the numbers of chunk, bounding-box and single-element reads made so far."
+    return dict(read_counts)
+
+def reset_extraction_stats():
+    for k in read_counts.iterkeys():
+        read_counts[k] = 0
+
+def read_chunks(data, r, c):
+    """
+    Reads data[r, c] by bucketing the elements by the chunk they live in and
+    reading each chunk exactly once, in storage order.
+    """
+    cr, cc = data.chunkshape[:2]
+    n_chunk_cols = (data.shape[1]-1)/cc + 1
+    chunk_id = (r/cr)*n_chunk_cols + c/cc
+    order = np.argsort(chunk_id, kind='mergesort')
+    ids, starts = np.unique(chunk_id[order], return_index=True)
+    stops = np.append(starts[1:], len(order))
     
-    return tb.openFile(data_file).root
+    vals = np.empty((len(r),)+data.shape[2:], dtype=data.atom.dtype)
+    for chunk, start, stop in zip(ids, starts, stops):
+        r0 = (chunk / n_chunk_cols) * cr
+        c0 = (chunk % n_chunk_cols) * cc
+        block = data[r0:r0+cr, c0:c0+cc]
+        read_counts['chunk'] += 1
+        here = order[start:stop]
+        vals[here] = block[r[here]-r0, c[here]-c0]
+    return vals
 
-def extract_environment(name, x, cache=True):
+def read_points(data, rows, cols, mode='auto'):
+    """
+    Reads data[rows, cols] from an in-memory or on-disk array, reading each
+    distinct element once. Any trailing dimensions of data are kept.
     
-    """Expects ALL locations to be in decimal degrees."""
+    On-disk arrays can be read
+    - 'chunks': chunk by chunk, each chunk containing a requested element
+      being read and decompressed exactly once,
+    - 'box': as the bounding box of the requested elements, in one read,
+    - 'points': element by element.
+    By default ('auto') small bounding boxes are read in one go, and large
+    chunked arrays chunk by chunk.
+    """
+    shape = rows.shape
+    flat = np.ravel_multi_index((rows.ravel(), cols.ravel()), data.shape[:2])
+    unique_flat, inverse = np.unique(flat, return_inverse=True)
+    r, c = np.unravel_index(unique_flat, data.shape[:2])
     
-    if cache:
-        x_hash = hashlib.sha1(x.data).hexdigest()
-        fname = os.path.split(name)[1] + '_' + x_hash + '.hdf5'
-        if 'anopheles-caches' in os.listdir('.'):
-            if fname in os.listdir('anopheles-caches'):
-                hf = tb.openFile(os.path.join('anopheles-caches',fname))
-                out = hf.root.eval[:]
-                hf.close()
-                return out
+    if mode == 'auto' and not isinstance(data, np.ndarray):
+        if len(unique_flat) > 0 and (r.max()-r.min()+1)*(c.max()-c.min()+1) <= 1e7:
+            mode = 'box'
+        elif getattr(data, 'chunkshape', None) is not None:
+            mode = 'chunks'
+        else:
+            mode = 'points'
     
-        print 'Evaluation of environmental layer %s on array with SHA1 hash %s not found, recomputing.'%(name, hashlib.sha1(x.data).hexdigest())
+    if mode == 'chunks' and getattr(data, 'chunkshape', None) is None:
+        mode = 'points'
     
-    hr = get_datafile(name)
+    if isinstance(data, np.ndarray):
+        vals = data[r, c]
+    elif len(unique_flat) == 0:
+        vals = np.empty((0,)+data.shape[2:], dtype=data.atom.dtype)
+    elif mode == 'box':
+        box = data[r.min():r.max()+1, c.min():c.max()+1]
+        read_counts['box'] += 1
+        vals = box[r-r.min(), c-c.min()]
+    elif mode == 'chunks':
+        vals = read_chunks(data, r, c)
+    elif mode == 'points':
+        vals = np.array([data[r[i], c[i]] for i in xrange(len(r))])
+        read_counts['point'] += len(r)
+    else:
+        raise ValueError, 'Unknown read mode %s.'%mode
     
-    if hasattr(hr, 'lon'):
-        grid_lon = hr.lon[:]
+    return vals[inverse].reshape(shape + vals.shape[1:])
+
+def interpolate(vals, mask, weights, name):
+    """
+    Interpolates values read at the grid nodes using precomputed weights.
+    Masked nodes are dropped and the remaining weights renormalized; locations
+    surrounded by masked nodes evaluate to NaN.
+    """
+    vals = vals.astype('float')
+    if mask is not None:
+        weights = weights * (True - mask.astype('bool'))
+    wsum = weights.sum(axis=1)
+    out = np.empty(len(weights))
+    good = wsum > 0
+    out[good] = np.sum(vals[good]*weights[good], axis=1) / wsum[good]
+    out[True-good] = np.nan
+    if not np.all(good):
+        warnings.warn('%i locations are surrounded by masked pixels in %s.'%(np.sum(True-good), name))
+    return out
+
+def apply_weights(hr, rows, cols, weights, mode='auto'):
+    "Interpolates a layer using precomputed weights."
+    vals = read_points(hr.data, rows, cols, mode)
+    if hr.mask is not None:
+        mask = read_points(hr.mask, rows, cols, mode)
+    else:
+        mask = None
+    return interpolate(vals, mask, weights, hr.name)
+
+# Locations are cached to the nearest millionth of a degree.
+point_quantum = 1.e-6
+
+def point_keys(x):
+    """
+    Quantizes locations in decimal degrees to integer keys for the per-point
+    cache. Locations within point_quantum of each other share a key.
+    """
+    q = np.round(np.asarray(x)/point_quantum).astype('int64') + 2**28
+    return (q[:,0] << 32) | q[:,1]
+
+def lookup_points(entry, keys):
+    """
+    Looks keys up in a per-point cache entry. Returns the cached values and a
+    boolean array saying which keys were found.
+    """
+    if entry is None or len(entry['keys'])==0:
+        return np.empty(len(keys)), np.zeros(len(keys), dtype=bool)
+    ind = np.minimum(np.searchsorted(entry['keys'], keys), len(entry['keys'])-1)
+    return entry['values'][ind], entry['keys'][ind]==keys
+
+def merge_points(entry, keys, values):
+    "Returns a per-point cache entry with keys and values added to entry."
+    if entry is not None:
+        keys = np.concatenate((keys, entry['keys']))
+        values = np.concatenate((values, entry['values']))
+    keys, ind = np.unique(keys, return_index=True)
+    return {'keys': keys, 'values': values[ind]}
+
+# The worker pool used to extract layers in parallel.
+extraction_workers = {'n': int(os.environ.get('ANOPHELES_EXTRACTION_WORKERS', 1)), 'kind': 'process'}
+hdf5_lock = threading.Lock()
+
+def set_extraction_workers(n, kind='process'):
+    """
+    Sets the number of workers that layers are extracted over, one layer per
+    task, and whether they are processes or threads. Unless HDF5 is built
+    thread-safe, thread workers take turns reading, so only the interpolation
+    runs in parallel; processes are the better choice for cold caches.
+    """
+    if kind not in ['process', 'thread']:
+        raise ValueError, "Worker kind must be 'process' or 'thread', not %s."%kind
+    extraction_workers['n'] = n
+    extraction_workers['kind'] = kind
+
+def worker_init():
+    "Makes forked workers open their own raster handles rather than use the parent's."
+    raster_store().pool.forget()
+
+def layer_map(fn, args):
+    """
+    Returns [fn(a) for a in args], farming the calls out over the extraction
+    workers. The results are in the order of args.
+    """
+    n = min(extraction_workers['n'], len(args))
+    if n <= 1:
+        return map(fn, args)
+    if extraction_workers['kind'] == 'thread':
+        pool = multiprocessing.pool.ThreadPool(n)
     else:
-        grid_lon = hr.long[:]
-    grid_lat = hr.lat[:]
+        pool = multiprocessing.Pool(n, initializer=worker_init)
+    try:
+        return pool.map(fn, args, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def extract_layer(args):
+    "Applies precomputed interpolation weights to one layer. Used as a worker task."
+    name, rows, cols, weights, mode = args
+    if extraction_workers['kind'] == 'thread':
+        hdf5_lock.acquire()
+        try:
+            hr = raster_handle(name)
+            vals = read_points(hr.data, rows, cols, mode)
+            mask = None if hr.mask is None else read_points(hr.mask, rows, cols, mode)
+        finally:
+            hdf5_lock.release()
+        return interpolate(vals, mask, weights, name)
+    return apply_weights(raster_handle(name), rows, cols, weights, mode)
+
+def extract_environment_many(names, x, cache=True, mode='auto'):
+    """
+    Evaluates several environmental layers at locations x, which should be in
+    decimal degrees. Returns an array of shape (len(x), len(names)).
+    
+    The grid indices and interpolation weights are computed once for each
+    distinct grid geometry and applied to all the layers that share it.
+    
+    If cache is True, evaluations are cached per layer and per location, so
+    only locations that haven't been seen before are extracted. mode says how
+    the rasters are read; see read_points.
     
-    grid_data = hr.data
+    Layers that have been packed into a stack by pack_layers are read from
+    the stack, all their bands at once. The others are extracted in parallel
+    over the workers set by set_extraction_workers.
+    """
+    x = np.ascontiguousarray(x)
+    out = np.empty((len(x), len(names)))
     
-    if hasattr(grid_data.attrs,'view'):
-        view = grid_data.attrs.view
+    # For each layer, the indices of the locations that need extracting.
+    missing = {}
+    entries = {}
+    if cache:
+        keys = point_keys(x)
+        for i, name in enumerate(names):
+            entries[i] = cache_store().get(point_values_key(name))
+            out[:,i], found = lookup_points(entries[i], keys)
+            if not np.all(found):
+                missing[i] = np.where(True-found)[0]
+                print 'Evaluation of environmental layer %s not found at %i of %i locations, extracting.'%(name, len(missing[i]), len(x))
     else:
-        raise ValueError, "Key 'view' not found in data array's attrs for datafile %s. \n\
+        for i in xrange(len(names)):
+            missing[i] = np.arange(len(x))
+    
+    # Layers that are bands of a stack are read together, one chunk read for
+    # all their bands. Group the rest by grid geometry.
+    index = stack_index()
+    stacked = {}
+    groups = {}
+    for i in missing.iterkeys():
+        if index.has_key(names[i]) and band_is_current(index[names[i]][0], names[i]):
+            stacked.setdefault(index[names[i]][0], []).append(i)
+            continue
+        hr = raster_handle(names[i])
+        if hr.view is None:
+            raise ValueError, "Key 'view' not found in data array's attrs for datafile %s. \n\
     I could assume a default view, but you would suffer bitterly. \n\
-    I could not bear it, human."%grid_data._v_file.filename
+    I could not bear it, human."%hr.path
+        groups.setdefault(grid_geometry(hr), []).append(i)
     
-    if hasattr(hr, 'mask'):
-        grid_mask = hr.mask
-    else:
-        grid_mask = None
-    if np.prod(hr.data.shape) > 1e8:
-        grid_chunk = hr.data.chunkshape
-    else:
-        grid_chunk=None
+    # The locations extracted for each layer.
+    extracted = {}
     
-    eval = map_utils.interp_geodata(grid_lon, grid_lat, grid_data, x[:,0], x[:,1], grid_mask, grid_chunk, view=view)
+    for stack, indices in stacked.iteritems():
+        where = np.unique(np.concatenate([missing[i] for i in indices]))
+        hr = raster_handle(stack)
+        rows, cols, weights = interpolation_weights(hr.lon, hr.lat, hr.view, hr.data.shape, x[where])
+        vals = read_points(hr.data, rows, cols, mode)
+        mask = None if hr.mask is None else read_points(hr.mask, rows, cols, mode)
+        for i in indices:
+            b = index[names[i]][1]
+            out[where,i] = interpolate(vals[:,:,b], None if mask is None else mask[:,:,b], weights, names[i])
+            extracted[i] = where
     
-    hr._v_file.close()
+    for indices in groups.itervalues():
+        # Extract all the locations missing from any layer in the group in one batch.
+        where = np.unique(np.concatenate([missing[i] for i in indices]))
+        hr = raster_handle(names[indices[0]])
+        rows, cols, weights = interpolation_weights(hr.lon, hr.lat, hr.view, hr.data.shape, x[where])
+        evals = layer_map(extract_layer, [(names[i], rows, cols, weights, mode) for i in indices])
+        for i, e in zip(indices, evals):
+            out[where,i] = e
+            extracted[i] = where
     
     if cache:
-        hf = tb.openFile(os.path.join('anopheles-caches',fname),'w')
-        hf.createArray('/','eval',eval)
-        hf.close()
+        for i, where in extracted.iteritems():
+            cache_store().put(point_values_key(names[i]), merge_points(entries[i], keys[where], out[where,i]))
     
-    return eval
\ No newline at end of file
+    return out
+
+def extract_environment(name, x, cache=True):
+    """
+    Evaluates the environmental layer at locations x, which should be in
+    decimal degrees.
+    """
+    return extract_environment_many([name], x, cache)[:,0]
@@ -0,0 +1,208 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Area-weighted sampling of regions on the sphere.
+
+Regions are polygons whose edges are straight in lon/lat. A region is
+triangulated once, and the triangulation is kept in the cache store with
+the area of each triangle on the sphere. Points are then drawn uniformly
+in lon/lat within the triangles and thinned in proportion to cos(lat), which
+makes them uniform on the sphere, all as array operations.
+"""
+
+import hashlib
+import numpy as np
+from shapely.ops import triangulate as delaunay
+from shapely.prepared import prep
+from shapely.geometry import Point
+import shapely.wkb
+from cache_store import cache_store
+
+__all__ = ['earth_radius', 'triangulate', 'spherical_areas', 'triangulation', 'sample_triangles', 'PreparedRegion', 'prepared_region', 'region_geometries']
+
+# In kilometres, for reporting areas.
+earth_radius = 6371.
+
+def polygons_of(geom):
+    "Returns the polygons making up a geometry."
+    if geom.is_empty:
+        return []
+    if geom.geom_type == 'Polygon':
+        return [geom]
+    if hasattr(geom, 'geoms'):
+        return sum([polygons_of(g) for g in geom.geoms], [])
+    return []
+
+def triangulate_polygon(poly, max_depth):
+    """
+    Triangulates a polygon. Delaunay triangles of its vertices that cross its
+    boundary are clipped to it and the pieces triangulated in turn, up to
+    max_depth times, after which they are kept if their centroids are inside.
+    """
+    prepared = prep(poly)
+    out = []
+    for t in delaunay(poly):
+        if prepared.contains(t):
+            out.append(t)
+        elif not prepared.intersects(t):
+            continue
+        elif max_depth > 0:
+            piece = t.intersection(poly)
+            if piece.area >= t.area*(1-1e-9):
+                out.append(t)
+            else:
+                for p in polygons_of(piece):
+                    out.extend(triangulate_polygon(p, max_depth-1))
+        elif prepared.contains(t.centroid):
+            out.append(t)
+    return out
+
+def triangulate(geom, max_depth=8):
+    """
+    Triangulates a polygon or multipolygon in lon/lat degrees. Returns an
+    array of shape (n,3,2) holding the triangles' vertices.
+    """
+    tris = sum([triangulate_polygon(p, max_depth) for p in polygons_of(geom)], [])
+    if len(tris) == 0:
+        return np.empty((0,3,2))
+    return np.array([t.exterior.coords[:3] for t in tris])
+
+def spherical_areas(tris):
+    """
+    Returns the areas on the sphere, in steradians, of triangles whose
+    vertices are given in lon/lat degrees and whose edges are straight in
+    lon/lat, like the edges of the regions. This is the integral of cos(lat)
+    over each triangle, which is exact because lat is linear on it.
+    """
+    lon = tris[...,0]*np.pi/180.
+    lat = tris[...,1]*np.pi/180.
+    planar = np.abs((lon[:,1]-lon[:,0])*(lat[:,2]-lat[:,0]) - (lon[:,2]-lon[:,0])*(lat[:,1]-lat[:,0]))/2.
+    # Twice the planar area times the second divided difference of -cos at
+    # the vertices' latitudes, written to avoid cancellation.
+    a, b, c = np.sort(lat, axis=1).T
+    def first(x, y):
+        return np.sin((x+y)/2.)*np.sinc((y-x)/2./np.pi)
+    span = c - a
+    close = span < 1e-3
+    second = np.where(close, np.cos((a+b+c)/3.)/2., (first(b,c)-first(a,b))/np.where(close, 1, span))
+    return 2*planar*second
+
+def max_cos_lat(tris):
+    "The largest value of cos(lat) on each of the triangles."
+    lat = tris[...,1]*np.pi/180.
+    crosses = (lat.min(axis=1) <= 0) & (lat.max(axis=1) >= 0)
+    return np.where(crosses, 1., np.cos(np.abs(lat).min(axis=1)))
+
+def triangulation(geom, key=None):
+    """
+    Returns a dictionary holding the triangles of geom and their areas on
+    the sphere, persisted in the cache store under key. The key defaults to
+    a hash of geom's WKB. If a key is given, geom may instead be a function
+    returning the geometry, which is then only called if the triangulation
+    isn't cached.
+    """
+    if key is None:
+        key = ('triangulation', hashlib.sha1(geom.wkb).hexdigest())
+    cached = cache_store().get(key)
+    if cached is not None:
+        return cached
+    if callable(geom):
+        geom = geom()
+    tris = triangulate(geom)
+    out = {'triangles': tris, 'areas': spherical_areas(tris)}
+    cache_store().put(key, out)
+    return out
+
+def sample_triangles(tri, n):
+    """
+    Draws n points uniformly on the sphere from the region covered by a
+    triangulation. Points are drawn uniformly in lon/lat from triangles
+    chosen in proportion to their lon/lat areas times their largest
+    cos(lat), and kept with probability cos(lat) over that bound, so they
+    always lie inside the triangles. Returns lon and lat in degrees.
+    """
+    if n <= 0:
+        return np.empty(0), np.empty(0)
+    tris = tri['triangles']
+    bound = max_cos_lat(tris)
+    planar = np.abs(np.cross(tris[:,1]-tris[:,0], tris[:,2]-tris[:,0]))/2.*(np.pi/180.)**2
+    cum = np.cumsum(planar*bound)
+    acceptance = tri['areas'].sum()/cum[-1]
+    lon = []
+    lat = []
+    got = 0
+    while got < n:
+        m = int((n-got)/acceptance*1.1)+10
+        which = np.minimum(np.searchsorted(cum, np.random.random(m)*cum[-1]), len(cum)-1)
+        r = np.sqrt(np.random.random(m))[:,np.newaxis]
+        xi = np.random.random(m)[:,np.newaxis]
+        P = (1-r)*tris[which,0] + r*(1-xi)*tris[which,1] + r*xi*tris[which,2]
+        keep = np.random.random(m)*bound[which] < np.cos(P[:,1]*np.pi/180.)
+        lon.append(P[keep,0])
+        lat.append(P[keep,1])
+        got += keep.sum()
+    return np.concatenate(lon)[:n], np.concatenate(lat)[:n]
+
+class PreparedRegion(object):
+    """
+    A geometry loaded from WKB, with its content hash and its prepared version
+    for repeated point-in-polygon tests.
+    """
+    def __init__(self, wkb, hash=None):
+        self.wkb = wkb
+        self.hash = hash or hashlib.sha1(wkb).hexdigest()
+        self.geom = shapely.wkb.loads(wkb)
+        self.prepared = prep(self.geom)
+
+    def contains(self, lon, lat):
+        "Returns a boolean array saying which of the points, in degrees, are in the region."
+        return np.array([self.prepared.contains(Point(x,y)) for x,y in zip(lon, lat)], dtype=bool)
+
+    def triangulation(self):
+        return triangulation(self.geom, key=('triangulation', self.hash))
+
+_regions = {}
+
+def prepared_region(wkb, hash=None):
+    "Returns the PreparedRegion for some WKB, reusing it if it has been loaded already."
+    hash = hash or hashlib.sha1(wkb).hexdigest()
+    if not _regions.has_key(hash):
+        _regions[hash] = PreparedRegion(wkb, hash)
+    return _regions[hash]
+
+def region_geometries(wkb, world, world_key='World', tolerance=.05):
+    """
+    Returns a dictionary of PreparedRegions: 'region' is the region given as
+    WKB, 'complement' is the rest of the world, and 'region_display' and
+    'complement_display' are versions simplified to tolerance degrees for
+    plotting. world is a function returning the world's WKB and is only
+    called if the geometries aren't in the cache store, where they are kept
+    as WKB with their content hashes.
+    """
+    key = ('region_geometries', hashlib.sha1(wkb).hexdigest(), world_key, tolerance)
+    cached = cache_store().get(key)
+    if cached is None:
+        region = shapely.wkb.loads(wkb)
+        complement = shapely.wkb.loads(world()).difference(region)
+        geoms = {'region': wkb,
+                'complement': complement.wkb,
+                'region_display': region.simplify(tolerance, preserve_topology=True).wkb,
+                'complement_display': complement.simplify(tolerance, preserve_topology=True).wkb}
+        cached = dict(geoms)
+        cached['hashes'] = dict([(k, hashlib.sha1(g).hexdigest()) for k, g in geoms.iteritems()])
+        cache_store().put(key, cached)
+    hashes = cached.pop('hashes')
+    return dict([(k, prepared_region(g, hashes[k])) for k, g in cached.iteritems()])
@@ -0,0 +1,186 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+An in-memory cache of covariance factors.
+
+The Cholesky factor of a covariance on the inducing points, and the
+off-diagonal blocks C(xp,x) U^{-1} computed from it, depend only on the
+covariance's hyperparameters and the locations. Metropolis steps on the
+hyperparameters often reject a proposal and later propose nearby or
+identical values again, so the factors are kept in a least-recently-used
+cache keyed on the exact hyperparameter values and a hash of the locations.
+Revisiting a state then costs no O(n^3) work.
+
+A second cache holds pairwise distances between sets of locations and the
+components of covariance matrices built from them, so that changing one
+component's hyperparameters only re-evaluates that component.
+"""
+
+import os
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+__all__ = ['FactorCache', 'factor_cache', 'distance_cache', 'without_distance_cache', 'covariance_key', 'array_key', 'cached_cholesky']
+
+# Stored in place of the factor of a covariance that isn't positive definite.
+not_positive_definite = 'not positive definite'
+
+def array_key(x):
+    "A hash of an array's shape, type and contents."
+    x = np.ascontiguousarray(x)
+    return hashlib.sha1(x.view(np.uint8)).hexdigest() + str(x.shape) + x.dtype.str
+
+def _param_key(v):
+    try:
+        v = np.asarray(v, dtype=float)
+    except (TypeError, ValueError):
+        return repr(v)
+    return (v.shape, v.tostring())
+
+def covariance_key(C):
+    """
+    Returns a hashable key identifying a covariance by its evaluation
+    function and the exact values of its parameters.
+    """
+    params = tuple([(k, _param_key(C.params[k])) for k in sorted(C.params.iterkeys())])
+    return (C.eval_fun.__module__, C.eval_fun.__name__, params)
+
+def _nbytes(value):
+    return getattr(value, 'nbytes', 0)
+
+class FactorCache(object):
+    """
+    A least-recently-used cache of covariance factors. At most maxsize
+    entries are kept, and the arrays held are kept under max_bytes; the
+    least recently used entries are dropped to make room.
+
+    Values handed out by the cache are shared with later callers, so they
+    must not be modified in place. While enabled is False, values are
+    computed and not kept.
+    """
+    def __init__(self, maxsize=64, max_bytes=2**29):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.enabled = True
+
+    def get(self, key, compute):
+        """
+        Returns the value stored under key, calling compute() to make it if
+        it isn't in the cache.
+        """
+        if not self.enabled:
+            return compute()
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = compute()
+        self.entries[key] = value
+        self.nbytes += _nbytes(value)
+        self.evict()
+        return value
+
+    def evict(self):
+        "Drops least recently used entries until the cache is within its budgets."
+        while len(self.entries) > 1 and (len(self.entries) > self.maxsize or self.nbytes > self.max_bytes):
+            key, value = self.entries.popitem(last=False)
+            self.nbytes -= _nbytes(value)
+            self.evictions += 1
+
+    def cholesky(self, C, x):
+        """
+        Returns the upper-triangular Cholesky factor of C on x, or None if C
+        is not positive definite on x.
+        """
+        def compute():
+            try:
+                return C.cholesky(x)
+            except np.linalg.LinAlgError:
+                return not_positive_definite
+        U = self.get(('cholesky', covariance_key(C), array_key(x)), compute)
+        if U is not_positive_definite:
+            return None
+        return U
+
+    def offdiag(self, C, x, xp, compute):
+        """
+        Returns the off-diagonal block between x and xp computed from the
+        factor of C on x, calling compute() to make it if it isn't cached.
+        """
+        return self.get(('offdiag', covariance_key(C), array_key(x), array_key(xp)), compute)
+
+    def clear(self):
+        self.entries = OrderedDict()
+        self.nbytes = 0
+
+    def stats(self):
+        "Returns a dictionary of hit, miss and eviction counts and the cache's size."
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.entries), 'nbytes': self.nbytes}
+
+_cache = None
+
+def factor_cache():
+    """
+    Returns the process-wide factor cache, creating it on first use.
+    ANOPHELES_FACTOR_CACHE_SIZE and ANOPHELES_FACTOR_CACHE_BYTES set its
+    budgets.
+    """
+    global _cache
+    if _cache is None:
+        _cache = FactorCache(maxsize=int(os.environ.get('ANOPHELES_FACTOR_CACHE_SIZE', 64)),
+                                max_bytes=int(os.environ.get('ANOPHELES_FACTOR_CACHE_BYTES', 2**29)))
+    return _cache
+
+_distances = None
+
+def distance_cache():
+    """
+    Returns the process-wide cache of distances and covariance components,
+    creating it on first use. ANOPHELES_DISTANCE_CACHE_BYTES sets its byte
+    budget.
+    """
+    global _distances
+    if _distances is None:
+        _distances = FactorCache(maxsize=256, max_bytes=int(os.environ.get('ANOPHELES_DISTANCE_CACHE_BYTES', 2**30)))
+    return _distances
+
+def without_distance_cache(f, *args, **kwds):
+    """
+    Calls f with the distance cache switched off, for covariances that are
+    evaluated once on points that won't be seen again, so that they don't
+    push out the distances between the model's fixed sets of points.
+    """
+    cache = distance_cache()
+    enabled = cache.enabled
+    cache.enabled = False
+    try:
+        return f(*args, **kwds)
+    finally:
+        cache.enabled = enabled
+
+def cached_cholesky(C, x, cache=None):
+    "Returns C.cholesky(x) from the factor cache, or None if C is not positive definite on x."
+    return (cache or factor_cache()).cholesky(C, x)
@@ -0,0 +1,97 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Selection of inducing points.
+
+The field is sampled at the inducing points and kriged everywhere else, so
+the cost of every step is cubic in their number. Rather than using every
+candidate, points are chosen greedily by variance reduction: each new point
+is the candidate whose value is least explained by the points chosen so
+far under a reference covariance. The approximation error is the largest
+fraction of any candidate's prior variance left unexplained, and the number
+of points can be sized to reach a target error or to fit a memory budget.
+"""
+
+import numpy as np
+from factor_cache import without_distance_cache
+
+__all__ = ['variance_reduction', 'rank_for_bytes', 'select_inducing_points']
+
+def variance_reduction(C, x, max_rank, tol=0.):
+    """
+    Chooses up to max_rank of the rows of x by incomplete Cholesky
+    factorization of C on x with greedy pivoting, stopping once the largest
+    remaining conditional variance is at most tol times the largest prior
+    variance. C(x) must return the variances at x. Only the rows of C at
+    the chosen points are evaluated, so the cost is O(n*max_rank^2). The
+    factor's rows are allocated in doubling blocks, so stopping early at tol
+    doesn't cost max_rank rows of memory.
+
+    Returns the chosen indices in the order they were chosen, and the
+    relative error after each one was added.
+    """
+    n = len(x)
+    max_rank = min(max_rank, n)
+    d = np.asarray(C(x), dtype=float).ravel().copy()
+    prior = d.max()
+    L = np.empty((min(max_rank, 64), n))
+    pivots = []
+    errors = []
+    for k in xrange(max_rank):
+        i = np.argmax(d)
+        if d[i] <= tol*prior:
+            break
+        pivots.append(i)
+        if k == len(L):
+            L = np.vstack((L, np.empty((min(len(L), max_rank-len(L)), n))))
+        # Each row is evaluated once, so it isn't kept in the distance cache.
+        row = np.asarray(without_distance_cache(C, x[i:i+1], x), dtype=float).ravel() - np.dot(L[:k,i], L[:k])
+        L[k] = row/np.sqrt(d[i])
+        d -= L[k]**2
+        d[pivots] = 0
+        errors.append(max(d.max(), 0)/prior)
+    return np.array(pivots, dtype=int), np.array(errors)
+
+def rank_for_bytes(max_bytes, n_eval):
+    """
+    The largest number of inducing points whose factor and off-diagonal
+    blocks against n_eval evaluation points fit in max_bytes of doubles.
+    """
+    entries = max_bytes/8.
+    return int((-n_eval + np.sqrt(n_eval**2 + 4*entries))/2)
+
+def select_inducing_points(C, candidates, target_error=None, max_bytes=None, max_points=None, n_eval=None):
+    """
+    Chooses inducing points from the rows of candidates by variance reduction
+    under C. Points are added until the relative error, the largest fraction
+    of any candidate's prior variance they leave unexplained, is at most
+    target_error, or until the factor on the chosen points and their
+    off-diagonal blocks against n_eval evaluation points would exceed
+    max_bytes, or until there are max_points of them. n_eval defaults to
+    the number of candidates.
+
+    Returns the indices of the chosen candidates in increasing order and
+    the relative error they achieve.
+    """
+    n = len(candidates)
+    limit = n if max_points is None else min(max_points, n)
+    if max_bytes is not None:
+        limit = min(limit, rank_for_bytes(max_bytes, n if n_eval is None else n_eval))
+    if limit < 1:
+        raise ValueError, 'A budget of %i bytes does not leave room for any inducing points.'%max_bytes
+    pivots, errors = variance_reduction(C, candidates, limit, target_error or 0.)
+    error = errors[-1] if len(errors) > 0 else 1.
+    return np.sort(pivots), error
@@ -16,9 +16,11 @@
 import numpy as np
 import pymc as pm
 from utils import mahal
-from scipy.special import gamma
+from scipy.special import gamma, kv
+from factor_cache import distance_cache, array_key
 
-__all__ = ['mahalanobis_covariance']
+__all__ = ['mahalanobis_covariance', 'matern', 'angular_distance', 'great_circle_distance', 'scaled_squared_distances', 'cached_distances',
+            'geo_rad_component', 'mahalanobis_component']
 
 
 def mahalanobis_covariance(x,y,diff_degree,amp,val,vec,symm=None):
@@ -77,6 +79,75 @@ def mahalanobis_covariance(x,y,diff_degree,amp,val,vec,symm=None):
         #     raise RuntimeError, 'Negative eigenvalues: %s'%val[np.where(val<0)]
 
     return C
+
+def matern(d, diff_degree):
+    """
+    The Matern correlation at scaled distances d, parameterized as in
+    mahalanobis_covariance and PyMC's matern covariances.
+    """
+    t = np.asarray(d)*np.sqrt(diff_degree)*2.
+    if diff_degree == .5:
+        return np.exp(-t)
+    if diff_degree == 1.5:
+        return (1+t)*np.exp(-t)
+    out = np.ones(t.shape)
+    where = t > 0
+    tw = t[where]
+    out[where] = .5**(diff_degree-1.)/gamma(diff_degree)*tw**diff_degree*kv(diff_degree, tw)
+    return out
+
+def angular_distance(lon1, lat1, lon2, lat2):
+    "The angular distances, in radians, between points given in radians. The arguments broadcast."
+    dlon = np.sin(.5*(lon1-lon2))
+    dlat = np.sin(.5*(lat1-lat2))
+    a = dlat**2 + np.cos(lat1)*np.cos(lat2)*dlon**2
+    return 2*np.arctan2(np.sqrt(a), np.sqrt(np.clip(1-a,0,1)))
+
+def great_circle_distance(x, y):
+    "The angular distances, in radians, between points given as (lon, lat) in radians."
+    return angular_distance(x[:,0][:,np.newaxis], x[:,1][:,np.newaxis], y[:,0][np.newaxis,:], y[:,1][np.newaxis,:])
+
+def scaled_squared_distances(x, y, val):
+    """
+    Returns the matrix of sums over columns k of (x[i,k]-y[j,k])**2/val[k],
+    accumulated a column at a time so only one (nx, ny) array is held.
+    """
+    d2 = np.zeros((x.shape[0], y.shape[0]))
+    for k in xrange(x.shape[1]):
+        d2 += (x[:,k][:,np.newaxis]-y[:,k][np.newaxis,:])**2/val[k]
+    return d2
+
+def cached_distances(kind, x, y):
+    "Returns the great-circle distances ('geo') between x and y from the distance cache."
+    compute = {'geo': great_circle_distance}[kind]
+    return distance_cache().get((kind, array_key(x), array_key(y)), lambda: compute(x, y))
+
+def geo_rad_component(x, y, diff_degree, amp, scale):
+    """
+    The same covariance as pm.gp.matern.geo_rad, computed from cached
+    great-circle distances. The matrix itself is cached too, so it is only
+    recomputed when its own parameters change.
+    """
+    def compute():
+        return amp**2*matern(cached_distances('geo', x, y)/scale, diff_degree)
+    key = ('geo_rad', float(diff_degree), float(amp), float(scale), array_key(x), array_key(y))
+    return distance_cache().get(key, compute)
+
+def mahalanobis_component(x, y, diff_degree, amp, val, vec):
+    """
+    The same covariance as mahalanobis_covariance. If vec is the identity the
+    scaled distances are sums of the squared differences of each column, and
+    the matrix is cached, so it is only recomputed when its own parameters
+    change. Otherwise mahalanobis_covariance is called.
+    """
+    val = np.asarray(val, dtype=float)
+    vec = np.asarray(vec, dtype=float)
+    if np.any(vec != np.eye(len(val))):
+        return np.asarray(mahalanobis_covariance(x, y, diff_degree, amp, val, vec))
+    def compute():
+        return amp**2*matern(np.sqrt(scaled_squared_distances(x, y, val)), diff_degree)
+    key = ('mahalanobis', float(diff_degree), float(amp), val.tostring(), array_key(x), array_key(y))
+    return distance_cache().get(key, compute)
     
 if __name__ == '__main__':
     nd = 20
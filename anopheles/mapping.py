@@ -1,64 +1,289 @@
-import pylab as pl
 import time
 import numpy as np
 from env_data import *
-from map_utils import grid_convert
+from env_data import extraction_workers, hdf5_lock, read_points
 from query_to_rec import *
-import hashlib
-import tables
-import os
+from cache_store import cache_store
+from multiband import find_stack, read_thinned_stack
+from raster_store import raster_store, raster_handle, overview_level
+import tables as tb
 import pymc as pm
-from mpl_toolkits import basemap
-
-__all__ = ['presence_map','current_state_map','current_state_slice','subset_x']
-
-try:
-    from map_utils import reconcile_multiple_rasters
-    def make_covering_raster(thin=1, env_variables=(), **kwds):
-        
-        a='MODIS-hdf5/raw-data.land-water.geographic.world.version-4'
-        
-        names = [a]+env_variables
-        names.sort()
-        cache_fname = 'rasters_%i_%s_.hdf5'%(thin, hashlib.sha1('~*~lala~*~oolala'.join(names)).hexdigest())
-        
-        cache_found = False
-        if 'anopheles-caches' in os.listdir('.'):
-            if cache_fname in os.listdir('anopheles-caches'):
-                hf = tables.openFile(os.path.join('anopheles-caches',cache_fname))
-                lon = hf.root.lon[:]
-                lat = hf.root.lat[:]
-                layers = []
-                for n in [a] + env_variables:
-                    layers.append(getattr(hf.root,os.path.split(n)[1])[:])
-                hf.close()
-                cache_found = True
-        
-        if not cache_found:
-            lon,lat,layers = reconcile_multiple_rasters([get_datafile(n) for n in [a] + env_variables], thin=thin)
-            hf = tables.openFile(os.path.join('anopheles-caches',cache_fname),'w')            
-            hf.createArray('/','lon',lon)
-            hf.createArray('/','lat',lat)
-            names = [a] + env_variables
-            for i in xrange(len(layers)):
-                hf_arr=hf.createCArray('/',os.path.split(names[i])[1],shape=layers[i].shape,chunkshape=layers[i].shape,atom=tables.FloatAtom(),filters=tables.Filters(complevel=1))                
-                hf_arr[:] = layers[i]
+
+# Pylab, Basemap and map_utils are imported by the functions that use them, so
+# that importing this module doesn't need a display.
+__all__ = ['presence_map','current_state_map','current_state_slice','subset_x','CoveringRaster','make_covering_raster']
+
+class CoveringRaster(object):
+    """
+    A lazy stand-in for the covering raster
+
+        np.dstack([lon_grid, lat_grid] + layers)
+
+    with the same shape, (nlon, nlat, 2 + number of layers), and the same
+    indexing semantics. Feature values are only assembled for the cells that
+    are asked for, so the layers can be PyTables arrays that are read a tile
+    at a time. Use tiles() to stream the whole raster and subset() to take a
+    lazy rectangular view. Views share the file the layers are read from, if
+    any, and close() closes it.
+    """
+    def __init__(self, lon, lat, layers, offset=(0,0), hf=None):
+        # lon and lat are the axes of this view, in radians. The layers may be
+        # larger than the view, which starts at offset in them.
+        self.lon = lon
+        self.lat = lat
+        self.layers = layers
+        self.offset = offset
+        self.hf = hf
+        self.shape = (len(lon), len(lat), 2+len(layers))
+        self.ndim = 3
+
+    def _layer_slice(self, sl, axis):
+        start, stop, step = sl.indices(self.shape[axis])
+        if step < 0:
+            raise ValueError, 'CoveringRaster does not support negative steps.'
+        return slice(self.offset[axis]+start, self.offset[axis]+max(start,stop), step)
+
+    def block(self, lon_slice=slice(None), lat_slice=slice(None)):
+        "Returns the dense feature block for the given slices of the view."
+        lon = self.lon[lon_slice]
+        lat = self.lat[lat_slice]
+        lon_sl = self._layer_slice(lon_slice, 0)
+        lat_sl = self._layer_slice(lat_slice, 1)
+        out = np.empty((len(lon), len(lat), self.shape[2]))
+        out[:,:,0] = lon[:,np.newaxis]
+        out[:,:,1] = lat[np.newaxis,:]
+        for i, l in enumerate(self.layers):
+            out[:,:,i+2] = l[lon_sl, lat_sl]
+        return out
+
+    def __getitem__(self, index):
+        if not isinstance(index, tuple):
+            index = (index,)
+        index = index + (slice(None),)*(3-len(index))
+        slices = []
+        squeeze = []
+        for axis in (0,1):
+            ind = index[axis]
+            if isinstance(ind, (int, long, np.integer)):
+                ind = ind % self.shape[axis]
+                slices.append(slice(ind, ind+1))
+                squeeze.append(0)
+            else:
+                slices.append(ind)
+                squeeze.append(slice(None))
+        return self.block(*slices)[tuple(squeeze)][...,index[2]]
+
+    def __array__(self):
+        return self.block()
+
+    def subset(self, lon_slice, lat_slice):
+        "Returns a lazy view of a rectangle of the raster. The slices must have unit step."
+        lon_sl = self._layer_slice(lon_slice, 0)
+        lat_sl = self._layer_slice(lat_slice, 1)
+        if lon_sl.step != 1 or lat_sl.step != 1:
+            raise ValueError, 'CoveringRaster subsets must have unit step.'
+        return CoveringRaster(self.lon[lon_slice], self.lat[lat_slice], self.layers, (lon_sl.start, lat_sl.start), self.hf)
+
+    def tiles(self, tile_shape=(256,256)):
+        "Yields (lon slice, lat slice, dense block) for each tile of the raster in turn."
+        for i in xrange(0, self.shape[0], tile_shape[0]):
+            lon_slice = slice(i, min(i+tile_shape[0], self.shape[0]))
+            for j in xrange(0, self.shape[1], tile_shape[1]):
+                lat_slice = slice(j, min(j+tile_shape[1], self.shape[1]))
+                yield lon_slice, lat_slice, self.block(lon_slice, lat_slice)
+
+    def extent(self):
+        "Returns [lonmin, latmin, lonmax, latmax] in degrees."
+        return np.array([self.lon.min(), self.lat.min(), self.lon.max(), self.lat.max()])*180./np.pi
+
+    def close(self):
+        "Closes the file the layers are read from, if any."
+        if self.hf is not None:
+            self.hf.close()
+            self.hf = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def raster_tiles(x, tile_shape=(256,256)):
+    "Yields (lon slice, lat slice, dense block) for a covering raster, lazy or dense."
+    if isinstance(x, CoveringRaster):
+        for t in x.tiles(tile_shape):
+            yield t
+    else:
+        yield slice(None), slice(None), x
+
+def nearest_indices(axis, x):
+    "Returns the index of the node of an increasing axis nearest to each of x."
+    if len(axis) < 2:
+        return np.zeros(len(x), dtype=int)
+    i = np.clip(np.searchsorted(axis, x), 1, len(axis)-1)
+    return np.where(x - axis[i-1] <= axis[i] - x, i-1, i)
+
+def reconciled_grid(hrs, thin):
+    """
+    Returns the lon and lat axes that the layers are reconciled to: the nodes
+    of the coarsest layer that lie inside every layer's extent, taking every
+    thin'th one from the lowest.
+    """
+    spacing = [(hr.lon[-1]-hr.lon[0])/max(len(hr.lon)-1, 1) for hr in hrs]
+    coarsest = hrs[int(np.argmax(spacing))]
+    axes = []
+    for axis in ('lon', 'lat'):
+        lo = max([getattr(hr, axis)[0] for hr in hrs])
+        hi = min([getattr(hr, axis)[-1] for hr in hrs])
+        a = getattr(coarsest, axis)
+        axes.append(a[(a >= lo) & (a <= hi)][::thin])
+    return axes
+
+def grid_indices(hr, lon, lat):
+    """
+    Returns rows and cols, each of shape (len(lon), len(lat)): the indices into
+    the layer's data array of its nodes nearest to the grid lon x lat.
+    """
+    lon_ind = nearest_indices(hr.lon, lon)
+    lat_ind = nearest_indices(hr.lat, lat)
+    view = hr.view
+    for axis, sign in ((view[0], view[1]), (view[2], view[3])):
+        if sign == '-':
+            if axis == 'x':
+                lon_ind = len(hr.lon)-1-lon_ind
+            else:
+                lat_ind = len(hr.lat)-1-lat_ind
+    lon_ind, lat_ind = np.broadcast_arrays(lon_ind[:,np.newaxis], lat_ind[np.newaxis,:])
+    if view[0] == 'x':
+        return lon_ind, lat_ind
+    return lat_ind, lon_ind
+
+def reconcile_tile(args):
+    "Reads a layer at the nodes of one tile of the reconciled grid. Used as a worker task."
+    name, lon, lat = args
+    if extraction_workers['kind'] == 'thread':
+        # Reading the layer touches HDF5 and the shared raster pool, so thread
+        # workers take turns.
+        hdf5_lock.acquire()
+        try:
+            hr = raster_handle(name)
+            return read_points(hr.data, *grid_indices(hr, lon, lat))
+        finally:
+            hdf5_lock.release()
+    hr = raster_handle(name)
+    return read_points(hr.data, *grid_indices(hr, lon, lat))
+
+def reconcile_layers(hf, names, lon, lat, tile_shape=(256,256)):
+    """
+    Reconciles the named layers onto the grid lon x lat, writing each into a
+    chunked array layer_i of the open file hf a tile at a time, so no layer is
+    ever held in memory whole. The tiles of a strip are read in parallel over
+    the extraction workers.
+    """
+    shape = (len(lon), len(lat))
+    layers = [hf.createCArray('/', 'layer_%i'%i, atom=tb.FloatAtom(), shape=shape, filters=tb.Filters(complevel=1))
+                for i in xrange(len(names))]
+    for i in xrange(0, shape[0], tile_shape[0]):
+        lon_slice = slice(i, min(i+tile_shape[0], shape[0]))
+        where = []
+        args = []
+        for j in xrange(0, shape[1], tile_shape[1]):
+            lat_slice = slice(j, min(j+tile_shape[1], shape[1]))
+            for k in xrange(len(names)):
+                where.append((k, lat_slice))
+                args.append((names[k], lon[lon_slice], lat[lat_slice]))
+        for (k, lat_slice), block in zip(where, layer_map(reconcile_tile, args)):
+            layers[k][lon_slice, lat_slice] = block
+
+def covering_raster_key(thin, names):
+    """
+    The cache key of a covering raster. It includes the layers' versions, so
+    updating any of the layers invalidates it.
+    """
+    return ('covering_raster', thin, tuple(names), tuple([raster_store().version(n) for n in names]))
+
+def thin_cached_raster(names, thin):
+    """
+    Looks for a cached covering raster read from the same overviews at a
+    thinning that divides thin, and thins it further. Cached rasters are on the
+    reconciled grid, which is thinned from its lowest lon and lat, so every
+    (thin/d)'th node of one at thinning d is the grid at thinning thin.
+    Returns lon, lat and layers, or None if there isn't one.
+    """
+    level = overview_level(thin)
+    for d in xrange(thin-1, 0, -1):
+        if thin % d != 0 or overview_level(d) != level:
+            continue
+        key = covering_raster_key(d, names)
+        if key not in cache_store():
+            continue
+        hf = cache_store().open(key)
+        if hf is None:
+            continue
+        step = thin/d
+        try:
+            layers = [getattr(hf.root, 'layer_%i'%i)[::step, ::step] for i in xrange(len(names))]
+            return hf.root.lon[::step], hf.root.lat[::step], layers
+        finally:
             hf.close()
+    return None
+
+def layers_to_values(lon, lat, layers):
+    values = {'lon': lon, 'lat': lat}
+    for i in xrange(len(layers)):
+        values['layer_%i'%i] = layers[i]
+    return values
 
-        mask = np.round(layers[0]).astype(bool)
+def make_covering_raster(thin=1, env_variables=(), tile_shape=(256,256), **kwds):
+    """
+    Returns the land-water mask, a CoveringRaster of the environmental layers
+    and the extent of the grid they are reconciled to, thinned by thin. The
+    reconciled layers are cached, and are read back from the cache a tile at
+    a time.
+    """
+    a='MODIS-hdf5/raw-data.land-water.geographic.world.version-4'
+    
+    names = [a]+env_variables
+    key = covering_raster_key(thin, names)
+    hf = cache_store().open(key)
+    
+    if hf is None:
+        stack = find_stack(names)
+        thinned = thin_cached_raster(names, thin)
+        if thinned is None and stack is not None:
+            # All the layers are bands of one stack, which is already reconciled.
+            thinned = read_thinned_stack(stack, names, thin)
+        if thinned is not None:
+            lon, lat, layers = thinned
+            cache_store().put(key, layers_to_values(lon, lat, layers), chunked=['layer_%i'%i for i in xrange(len(layers))])
+        else:
+            # Reconcile the layers' nearest overviews once, a tile at a time,
+            # straight into the cache entry.
+            level = overview_level(thin)
+            overviews = [raster_store().overview(n, level) for n in names]
+            hrs = [raster_handle(n) for n in overviews]
+            for hr in hrs:
+                if hr.view is None:
+                    raise ValueError, "Key 'view' not found in data array's attrs for datafile %s."%hr.path
+            lon, lat = reconciled_grid(hrs, thin/level)
+            cache_store().put(key, {'lon': lon, 'lat': lat}, fill=lambda f: reconcile_layers(f, overviews, lon, lat, tile_shape))
+        # Read the layers back lazily, so they can be dropped from memory.
+        hf = cache_store().open(key)
+
+    lon = hf.root.lon[:]
+    lat = hf.root.lat[:]
+    layers = [getattr(hf.root, 'layer_%i'%i) for i in xrange(len(names))]
+
+    mask = np.round(layers[0][:]).astype(bool)
 
-        img_extent = [lon.min(), lat.min(), lon.max(), lat.max()]
+    img_extent = [lon.min(), lat.min(), lon.max(), lat.max()]
 
-        lat_grid, lon_grid = np.meshgrid(lat*np.pi/180.,lon*np.pi/180.)
-        x=np.dstack([lon_grid,lat_grid]+[l for l in layers[1:]])
-        
-        if x.shape[:-1] != mask.shape:
-            raise RuntimeError, 'Shape mismatch in mask and other layers.'
+    x = CoveringRaster(lon*np.pi/180., lat*np.pi/180., layers[1:], hf=hf)
+    
+    if x.shape[:-1] != mask.shape:
+        raise RuntimeError, 'Shape mismatch in mask and other layers.'
 
-        return mask, x, img_extent
-    __all__ += ['make_covering_raster']
-except:
-    pass
+    return mask, x, img_extent
 
 def subset_x(mask, x, img_extent, new_extent):
     lonmin = img_extent[0]
@@ -70,21 +295,28 @@ def subset_x(mask, x, img_extent, new_extent):
     latind = (int((new_extent[1]-latmin)/dlat), int((new_extent[3]-latmin)/dlat))
     
     subset_mask = mask[lonind[0]:lonind[1],latind[0]:latind[1]]
-    subset_x = x[lonind[0]:lonind[1],latind[0]:latind[1],:]
-    subset_extent = np.array([subset_x[:,:,0].min(), subset_x[:,:,1].min(), subset_x[:,:,0].max(), subset_x[:,:,1].max()])*180./np.pi
+    if isinstance(x, CoveringRaster):
+        subset_x = x.subset(slice(*lonind), slice(*latind))
+        subset_extent = subset_x.extent()
+    else:
+        subset_x = x[lonind[0]:lonind[1],latind[0]:latind[1],:]
+        subset_extent = np.array([subset_x[:,:,0].min(), subset_x[:,:,1].min(), subset_x[:,:,0].max(), subset_x[:,:,1].max()])*180./np.pi
     
     return subset_mask, subset_x, subset_extent
 
-def presence_map(M, session, species, burn=0, thin=1, trace_thin=1, **kwds):
-    "Converts the trace to a map of presence probability."
+def presence_map(M, session, species, burn=0, thin=1, trace_thin=1, tile_shape=(256,256), **kwds):
+    """
+    Converts the trace to a map of presence probability. The covering raster is
+    streamed a tile at a time, and every sample of the trace is evaluated on a
+    tile before moving on to the next.
+    """
     
     from mpl_toolkits import basemap
-    import pylab as pl
-    import time
+    from map_utils import grid_convert
     
     chain_len = len(M.db._h5file.root.chain0.PyMCsamples)
     
-    mask, x, img_extent = make_covering_raster(thin, M.env_variables, **kwds)
+    mask, x, img_extent = make_covering_raster(thin, M.env_variables, tile_shape=tile_shape, **kwds)
 
     out = np.zeros(mask.shape)
 
@@ -92,19 +324,26 @@ def presence_map(M, session, species, burn=0, thin=1, trace_thin=1, **kwds):
     time_start = time.time()
     
     ptrace = M.trace('p')[:]
-    for i in xrange(burn, len(M.trace('p_find')[:]), trace_thin):
-        
-        if time.time() - time_count > 10:
-            print (((i-burn)*100)/(chain_len)), '% complete',
-            if i>burn:
-                time_count = time.time()      
-                print 'expect results '+time.ctime((time_count-time_start)*(chain_len-burn)/float(i-burn)+time_start)
-            else:
-                print
-        
-        p = ptrace[i]
-        pe = p(x)
-        out += pe/float(chain_len-burn)
+    samples = range(burn, len(M.trace('p_find')[:]), trace_thin)
+    n_cells = float(np.prod(mask.shape))
+    done = 0
+    try:
+        for lon_slice, lat_slice, block in raster_tiles(x, tile_shape):
+            
+            if time.time() - time_count > 10:
+                print int((done*100)/n_cells), '% complete',
+                if done>0:
+                    time_count = time.time()      
+                    print 'expect results '+time.ctime((time_count-time_start)*n_cells/done+time_start)
+                else:
+                    print
+            
+            for i in samples:
+                p = ptrace[i]
+                out[lon_slice, lat_slice] += p(block)/float(chain_len-burn)
+            done += block.shape[0]*block.shape[1]
+    finally:
+        x.close()
     
     b = basemap.Basemap(*img_extent)
     arr = np.ma.masked_array(out, mask=True-mask)
@@ -114,10 +353,18 @@ def presence_map(M, session, species, burn=0, thin=1, trace_thin=1, **kwds):
     plot_species(session, species[0], species[1], b, negs=True, **kwds)    
     return out, arr
     
-def current_state_map(M, session, species, mask, x, img_extent, thin=1, f2p=None, **kwds):
-    "Maps the current state of the model."
+def current_state_map(M, session, species, mask, x, img_extent, thin=1, f2p=None, tile_shape=(256,256), **kwds):
+    """
+    Maps the current state of the model. x may be a dense array or a
+    CoveringRaster, which is left open for the caller to close.
+    """
+    from mpl_toolkits import basemap
+    from map_utils import grid_convert
 
-    out = pm.utils.value(M.p)(x, f2p=f2p)
+    p = pm.utils.value(M.p)
+    out = np.empty(mask.shape)
+    for lon_slice, lat_slice, block in raster_tiles(x, tile_shape):
+        out[lon_slice, lat_slice] = p(block, f2p=f2p)
 
     b = basemap.Basemap(*img_extent)
     arr = np.ma.masked_array(out, mask=True-mask)
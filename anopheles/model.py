@@ -13,23 +13,19 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import matplotlib
-from mpl_toolkits import basemap
-b = basemap.Basemap(0,0,1,1)
 import pymc as pm
 import numpy as np
 from step_methods import *
 from query_to_rec import *
 from env_data import *
+from bundles import *
 from mahalanobis_covariance import *
-from map_utils import multipoly_sample
-from mapping import *
 from spatial_submodels import *
+from inducing_points import *
 from constraints import *
 from cov_prior import GivensStepper, OrthogonalBasis
 import datetime
 import warnings
-import shapely
 import tables as tb
 import utils
 
@@ -50,11 +46,17 @@ def evaluation_group(C,U,p,x,x_p,f2p,suffix,doc=''):
     p_eval = pm.Lambda('p_eval_%s'%suffix, lambda f=f_eval, f2p=f2p: f2p(f), trace=False)
     return od, f_eval, p_eval
     
-def make_model(session, species, spatial_submodel, with_eo = True, with_data = True, env_variables = (), constraint_fns={}, n_inducing=1000, f2p=threshold):
+def make_model(session, species, spatial_submodel, with_eo = True, with_data = True, env_variables = None, constraint_fns={}, n_inducing=1000, f2p=threshold,
+                inducing_error=None, inducing_bytes=None, rl=None, pivots=None):
     """
     Generates a PyMC probability model with a plug-in spatial submodel.
     The likelihood and expert-opinion layers are common.
     
+    session can be a database session, or a SpeciesBundle or the path of a
+    bundle file, in which case neither the database nor the data server is
+    needed. With a bundle, species can be None. If env_variables is None,
+    all the bundle's covariates are used. See as_bundle.
+    
     Constraints are hard expert opinions. The keys should be either
     'location' or members of env_variables. The values should be functions
     that take two arguments labelled 'x' and 'p'. The first will be either 
@@ -67,31 +69,51 @@ def make_model(session, species, spatial_submodel, with_eo = True, with_data = T
     can be opened and closed as normal.
     
     Note that constraints will not be created unless with_eo=True.
+    
+    If inducing_error or inducing_bytes is given, the inducing points are
+    chosen from the expert-opinion points and the data sites by variance
+    reduction under the spatial submodel's reference_covariance, and as few
+    are used as reach a relative error of inducing_error or fit in
+    inducing_bytes; see select_inducing_points. The achieved error is
+    reported and exposed as inducing_error. Otherwise every expert-opinion
+    point is an inducing point.
+    
+    rl and pivots are passed on to the spatial submodel; lr_spatial_env uses
+    rl as the rank of its field, and pivots, if given, as the indices of the
+    inducing points it keeps.
     """
 
     # =========
     # = Query =
     # =========
     
-    pts_in, pts_out = sample_eo(session, species, n_inducing)
+    # The bundle holds the inducing points, the data and the environmental
+    # surfaces evaluated at all of them.
+    bundle = as_bundle(session, species, env_variables, n_inducing)
+    species = bundle.species
+    env_variables = bundle.env_variables
+    
+    pts_in, pts_out = bundle.pts_in, bundle.pts_out
     
     # ========================
     # = Environmental inputs =
     # ========================
     
-    # Evaluate the environmental surfaces at the inducing points.
-    if len(env_variables)>0:
-        env_in = np.array([extract_environment(n, pts_in * 180./np.pi) for n in env_variables]).T
-        env_out = np.array([extract_environment(n, pts_out * 180./np.pi) for n in env_variables]).T
-        # Record the means and standard deviations, because the surfaces will be scaled and shifted
-        # according to those before input into the fields.
-        env_means = np.array([np.mean(np.concatenate((env_in[:,i], env_out[:,i]))) for i in xrange(len(env_variables))])
-        env_stds = np.array([np.std(np.concatenate((env_in[:,i], env_out[:,i]))) for i in xrange(len(env_variables))])
+    if with_data:
+        breaks, x, found, zero, others_found = bundle.breaks, bundle.x, bundle.found, bundle.zero, bundle.others_found
+        env_x = bundle.env_x
     else:
-        env_in = np.empty((len(pts_in),0))
-        env_out = np.empty((len(pts_out),0))
-        env_means = []
-        env_stds = []
+        x = np.empty((0,2))
+        env_x = np.empty((0,len(env_variables)))
+    
+    env_in = bundle.env_in
+    env_out = bundle.env_out
+    
+    # Record the means and standard deviations, because the surfaces will be scaled and shifted
+    # according to those before input into the fields.
+    env_eo = np.vstack((env_in, env_out))
+    env_means = bundle.env_means
+    env_stds = bundle.env_stds
     
     # ==========
     # = Priors =
@@ -114,6 +136,14 @@ def make_model(session, species, spatial_submodel, with_eo = True, with_data = T
     x_fr = x_eo#[::2]
     full_x_fr = full_x_eo#[::2]
     
+    if inducing_error is not None or inducing_bytes is not None:
+        candidates = np.vstack((full_x_eo, np.hstack((x, env_x))))
+        inducing, inducing_error = select_inducing_points(spatial_submodel.reference_covariance(len(env_variables)), 
+                                        normalize_env(candidates, env_means, env_stds), inducing_error, inducing_bytes)
+        full_x_fr = candidates[inducing]
+        x_fr = full_x_fr[:,:2]
+        print 'Using %i of %i candidate inducing points, relative error %f.'%(len(inducing), len(candidates), inducing_error)
+    
     full_x_fr_n = normalize_env(full_x_fr, env_means, env_stds)
 
     # ============================
@@ -128,14 +158,16 @@ def make_model(session, species, spatial_submodel, with_eo = True, with_data = T
     C = spatial_variables['C']
     U_fr = spatial_variables['U_fr']
     g_fr = spatial_variables['g_fr']
+    # Reduced-rank submodels only keep some of the inducing points.
+    if spatial_variables.has_key('x_fr'):
+        full_x_fr_n = spatial_variables['x_fr']
     
     if with_data:
         # ==============
         # = Likelihood =
         # ==============
         
-        # Read in the data, and split it up.
-        breaks, x, found, zero, others_found, multipoints = sites_as_ndarray(session, species)
+        # Split the data up.
         wherefound = np.where(found > 0)
         where_notfound = np.where(found==0)
         x_wherefound = x[wherefound]
@@ -148,11 +180,6 @@ def make_model(session, species, spatial_submodel, with_eo = True, with_data = T
         n_neg = (found+others_found+zero)[where_notfound]
         n_pos = (found+others_found+zero)[wherefound]
         
-        # Evaluate the environmental surfaces at the data locations.
-        if len(env_variables)>0:
-            env_x = np.array([extract_environment(n, x * 180./np.pi) for n in env_variables]).T
-        else:
-            env_x = np.empty((len(x),0))
         env_x_wherefound = env_x[wherefound]    
         env_x_where_notfound = env_x[where_notfound]
         
@@ -373,12 +400,19 @@ def add_data(M2):
 
 
 def restore_species_MCMC(session, dbpath):
+    """
+    Reopens a run made by species_MCMC. If the trace file holds a snapshot of
+    the model's inputs, the model is rebuilt from it and session can be None;
+    otherwise the inputs are prepared again from the database.
+    """
 
     # Load the database from the disk
     db = pm.database.hdf5.load(dbpath)
     
     # Recover MCMC object, restore variables' states, add data
     metadata = db._h5file.root.metadata[0]
+    if hasattr(db._h5file.root, 'bundle'):
+        session = load_bundle(db._h5file, '/bundle')
     model = make_model(session, **metadata)
     M=pm.MCMC(model, db=db)
     M.restore_sampler_state()
@@ -402,24 +436,46 @@ def restore_species_MCMC(session, dbpath):
     
     return M
 
-def add_metadata(hf, kwds, species, spatial_submodel):
+def add_metadata(hf, kwds, species, spatial_submodel, bundle=None):
     hf.createVLArray('/','metadata', atom=tb.ObjectAtom())
     metadata = {}
     metadata.update(kwds)
     metadata['species']=species
     metadata['spatial_submodel']=spatial_submodel    
     hf.root.metadata.append(metadata)
+    if bundle is not None:
+        # Snapshot the model's inputs, so the run can be restored without the database.
+        hf.createGroup('/', 'bundle')
+        write_bundle(bundle, hf, '/bundle')
 
 def species_MCMC(session, species, spatial_submodel, **kwds):
-    print 'Environment variables: ',kwds['env_variables']
+    """
+    Creates the model of a species and finds a legal initial state for it.
+    session can be a database session, or a SpeciesBundle or the path of a
+    bundle file; see make_model. With a bundle, species can be None.
+    
+    The model is built once. The first stage, which satisfies the constraints,
+    and the second stage, which samples from the posterior, share its nodes,
+    so the second stage starts where the first stopped.
+    """
+    bundle = as_bundle(session, species, kwds.get('env_variables', None), kwds.get('n_inducing', 1000))
+    species = bundle.species
+    
+    print 'Environment variables: ',bundle.env_variables
     print 'Constraints: ',kwds['constraint_fns']
     print 'Spatial submodel: ',spatial_submodel.__name__
     print 'Species: ',species[1]
 
+    model = make_model(bundle, species, spatial_submodel, **kwds)
+    if model.get('pivots', None) is not None:
+        # Record the inducing points the field was reduced to, so that the
+        # run is restored against the same ones.
+        kwds['pivots'] = model['pivots']
+
     # ====================================
     # = First stage: Satisfy constraints =
     # ====================================
-    M1=LatchingMCMC(make_model(session, species, spatial_submodel, **kwds), db='ram')
+    M1=LatchingMCMC(model, db='ram')
     new_val = M1.f_fr.value*0+.1
     # new_val[len(M1.pts_in):] = .001
     M1.f_fr.value = new_val
@@ -437,11 +493,7 @@ def species_MCMC(session, species, spatial_submodel, **kwds):
     # =======================================
     # = Second stage: sample from posterior =
     # =======================================
-    M2=pm.MCMC(make_model(session, species, spatial_submodel, **kwds), db='hdf5', dbcomplevel=1, dbname=species[1]+str(datetime.datetime.now())+'.hdf5')
-    for s2 in M2.stochastics:
-        for s1 in M1.stochastics:
-            if s2.__name__ == s1.__name__:
-                s2.value = s1.value
+    M2=pm.MCMC(model, db='hdf5', dbcomplevel=1, dbname=species[1]+str(datetime.datetime.now())+'.hdf5')
     for c in filter(lambda x: isinstance(x,Constraint), M2.potentials):
         c.close()
 
@@ -449,7 +501,7 @@ def species_MCMC(session, species, spatial_submodel, **kwds):
     add_data(M2)
     species_stepmethods(M2)
     
-    add_metadata(M2.db._h5file, kwds, species, spatial_submodel)
+    add_metadata(M2.db._h5file, kwds, species, spatial_submodel, bundle)
     
     # Try to initialize full-rank field to a reasonable value.
     # for i in xrange(10):
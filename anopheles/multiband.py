@@ -0,0 +1,184 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Band-interleaved stacks of co-registered layers.
+
+A stack is a datafile like any other, stored under 'stacks/' in the data
+root, whose data array has shape (rows, columns, bands) and is chunked so
+that every chunk holds all the bands. A point lookup against a stack
+therefore costs one chunk read for all its bands rather than one per layer.
+The data array's attrs hold the common view, the names of the bands and
+each band's original view, version and checksum; the optional mask array is
+interleaved the same way. A band whose source layer has changed since the
+stack was packed is stale, and is read from the source layer instead.
+Checksums are compared against the raster store's manifest, so checking a
+band never reads its source layer.
+"""
+
+import os
+import numpy as np
+import tables as tb
+from raster_store import raster_store, raster_handle, overview_level, file_checksum
+
+__all__ = ['pack_layers', 'stack_index', 'band_is_current', 'find_stack', 'read_thinned_stack']
+
+stack_dirname = 'stacks'
+
+def pack_layers(names, stack_name, chunk=(64,64), strip=1024):
+    """
+    Packs the named layers, which must share their grid, into a stack called
+    stack_name. The layers are copied a strip of rows at a time, so they
+    never need to fit in memory. Returns the stack's datafile name.
+    """
+    handles = [raster_handle(n) for n in names]
+    h0 = handles[0]
+    for h in handles[1:]:
+        if h.data.shape != h0.data.shape or h.view != h0.view or np.any(h.lon != h0.lon) or np.any(h.lat != h0.lat):
+            raise ValueError, 'Layer %s is not co-registered with %s.'%(h.name, h0.name)
+
+    dtype = np.result_type(*[h.data.atom.dtype for h in handles])
+    has_mask = [h.mask is not None for h in handles]
+    nr, nc = h0.data.shape
+    nb = len(names)
+
+    stack = os.path.join(stack_dirname, stack_name)
+    path = raster_store().path(stack)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    raster_store().close(stack)
+
+    tmp = path + '.tmp'
+    hf = tb.openFile(tmp, 'w')
+    try:
+        hf.createArray('/', 'lon', h0.lon)
+        hf.createArray('/', 'lat', h0.lat)
+        filters = tb.Filters(complevel=1)
+        data = hf.createCArray('/', 'data', atom=tb.Atom.from_dtype(dtype), shape=(nr,nc,nb),
+                                chunkshape=(min(chunk[0],nr), min(chunk[1],nc), nb), filters=filters)
+        data.attrs.view = h0.view
+        data.attrs.bands = list(names)
+        data.attrs.band_views = [h.view for h in handles]
+        data.attrs.band_versions = [raster_store().version(n) for n in names]
+        data.attrs.band_checksums = [recorded_checksum(n) or file_checksum(raster_store().path(n)) for n in names]
+        if np.any(has_mask):
+            mask = hf.createCArray('/', 'mask', atom=tb.BoolAtom(), shape=(nr,nc,nb),
+                                    chunkshape=data.chunkshape, filters=filters)
+
+        for r0 in xrange(0, nr, strip):
+            r1 = min(r0+strip, nr)
+            data[r0:r1] = np.dstack([h.data[r0:r1] for h in handles])
+            if np.any(has_mask):
+                mask[r0:r1] = np.dstack([h.mask[r0:r1] if h.mask is not None else np.zeros((r1-r0,nc),dtype=bool) for h in handles])
+    finally:
+        hf.close()
+    os.rename(tmp, path)
+
+    _index['mtime'] = None
+    _index['current'] = {}
+    return stack
+
+_index = {'mtime': None, 'bands': {}, 'current': {}}
+
+def stack_index():
+    """
+    Returns a dictionary mapping layer names to (stack, band index) for every
+    stack in the raster store. The index is rebuilt when the stack directory
+    changes.
+    """
+    dirname = os.path.join(raster_store().root, stack_dirname)
+    if not os.path.isdir(dirname):
+        return {}
+    mtime = os.path.getmtime(dirname)
+    if mtime != _index['mtime']:
+        bands = {}
+        for fname in sorted(os.listdir(dirname)):
+            if not fname.endswith('.hdf5'):
+                continue
+            stack = os.path.join(stack_dirname, fname[:-5])
+            for i, name in enumerate(raster_handle(stack).data.attrs.bands):
+                bands[name] = (stack, i)
+        _index['bands'] = bands
+        _index['mtime'] = mtime
+    return _index['bands']
+
+def recorded_checksum(name):
+    "The checksum of a layer recorded in the raster store's manifest, or None."
+    store = raster_store()
+    return store.manifest.get(store.relpath(name), None)
+
+def band_is_current(stack, name):
+    """
+    Returns True if the named band of a stack was packed from the current
+    version of its source layer. If the versions differ the band's checksum
+    is compared with the one the raster store has recorded for the layer,
+    so a layer that was fetched again unchanged still counts as current; a
+    layer without a recorded checksum that has changed doesn't. If the
+    source layer isn't available the stack is the only copy, and counts as
+    current.
+    """
+    try:
+        version = raster_store().version(name)
+    except IOError:
+        return True
+    key = (stack, name, version)
+    if not _index['current'].has_key(key):
+        attrs = raster_handle(stack).data.attrs
+        if not hasattr(attrs, 'band_versions'):
+            # Stacks packed before versions were recorded can't be checked.
+            current = False
+        else:
+            b = list(attrs.bands).index(name)
+            current = attrs.band_versions[b] == version or \
+                        attrs.band_checksums[b] == recorded_checksum(name)
+        _index['current'][key] = current
+    return _index['current'][key]
+
+def find_stack(names):
+    """
+    Returns the name of a stack containing current versions of all the named
+    layers, or None.
+    """
+    index = stack_index()
+    stacks = set([index.get(n, (None,))[0] for n in names])
+    if len(stacks) == 1:
+        stack = stacks.pop()
+        if stack is not None and np.all([band_is_current(stack, n) for n in names]):
+            return stack
+    return None
+
+def read_thinned_stack(stack, names, thin):
+    """
+    Reads every thin'th row and column of the named bands of a stack in a
+    single pass, from the stack's nearest overview. Returns lon, lat and a
+    list of layers in the 'x+y+' view, on the grid make_covering_raster
+    reconciles layers to.
+    """
+    from map_utils import grid_convert
+    level = overview_level(thin)
+    hr = raster_handle(raster_store().overview(stack, level))
+    thin /= level
+    bands = list(hr.data.attrs.bands)
+    view = hr.view
+    axes = {'x': hr.lon, 'y': hr.lat}
+
+    # Thin from the lowest lon and lat, like make_covering_raster's
+    # reconciled grid, whichever end of the data array that is.
+    slices = []
+    for axis, sign in ((view[0], view[1]), (view[2], view[3])):
+        slices.append(slice(0 if sign == '+' else (len(axes[axis])-1) % thin, None, thin))
+    data = hr.data[slices[0], slices[1], :]
+    layers = [grid_convert(data[:,:,bands.index(n)], view, 'x+y+') for n in names]
+    return hr.lon[::thin], hr.lat[::thin], layers
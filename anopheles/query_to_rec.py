@@ -14,14 +14,30 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
-from anopheles_query import *
-from map_utils import multipoly_sample, shapely_multipoly_area
-import tables as tb
 import sys, os
-import shapely
-import cPickle
+import warnings
+import shapely.wkb
+from cache_store import cache_store
+from eo_sampling import sample_triangles, region_geometries, earth_radius
 
-__all__ = ['site_to_rec', 'sitelist_to_recarray', 'list_species', 'species_query', 'map_extents', 'multipoint_to_ndarray', 'sample_eo', 'map_extents', 'point_to_ndarray', 'sites_as_ndarray']
+__all__ = ['Session', 'site_to_rec', 'sitelist_to_recarray', 'list_species', 'species_query', 'map_extents', 'multipoint_to_ndarray', 'sample_eo', 'map_extents', 'point_to_ndarray', 'sites_as_ndarray', 'wkb_points', 'site_columns', 'species_version', 'fetch_species', 'cached_species_query', 'forget_species_queries', 'site_recarray', 'world_geometry', 'species_regions', 'split_recs', 'plot_species']
+
+# The database layer is only imported when it's first used, so that models
+# can be run from bundles without it.
+def Session(*args, **kwds):
+    "Opens a session on the database, see anopheles_query.Session."
+    import anopheles_query
+    return anopheles_query.Session(*args, **kwds)
+
+def list_species(session):
+    "Lists the (id, name) tuples of all the species, see anopheles_query.list_species."
+    import anopheles_query
+    return anopheles_query.list_species(session)
+
+def species_query(session, species_id):
+    "Returns the sites and expert opinion of a species, see anopheles_query.species_query."
+    import anopheles_query
+    return anopheles_query.species_query(session, species_id)
 
 def multipoint_to_ndarray(mp):
     "Converts a multipont to a coordinate array IN RADIANS."
@@ -63,148 +79,268 @@ def map_extents(pos_recs, eo):
             max(pos_recs.x.max(), eo.bounds[2]),
             max(pos_recs.y.max(), eo.bounds[3])]
 
-def sites_as_ndarray(session, species):
-    
-    fname = '%s_sites.hdf5'%(species[1])
+def _read_words(buf, offsets, width, nwords, little, dtype):
+    """
+    Reads nwords words of the given width starting at each of the offsets in
+    buf, which is a uint8 array, byte-swapping the rows that aren't little
+    endian.
+    """
+    b = buf[offsets[:,np.newaxis] + np.arange(width*nwords)].reshape((-1,nwords,width))
+    big = np.where(~little)[0]
+    b[big] = b[big,:,::-1]
+    return b.reshape((-1,width*nwords)).copy().view(dtype)
+
+def wkb_points(blobs):
+    """
+    Decodes a sequence of 2D point and multipoint WKB strings in bulk, without
+    creating any geometry objects. Returns the coordinates, as stored, and the
+    number of points in each geometry.
+    """
+    lengths = np.array([len(b) for b in blobs], dtype=int)
+    buf = np.frombuffer(''.join(map(str, blobs)), dtype=np.uint8)
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(int)
+
+    little = buf[starts] == 1
+    types = _read_words(buf, starts+1, 4, 1, little, '<u4')[:,0]
+    is_point = types == 1
+    counts = np.where(is_point, 1, (lengths-9)//21)
+    if np.any((types != 1) & (types != 4)) or np.any(lengths != np.where(is_point, 21, 9+21*counts)):
+        raise ValueError, 'Your list of sites has something in it that is neither a multipoint nor a point, you fruitcake.'
+
+    # Each point, including those inside multipoints, is a byte-order byte and
+    # a type word followed by its two coordinates.
+    first = np.cumsum(counts) - counts
+    within = np.arange(counts.sum()) - np.repeat(first, counts)
+    pt_starts = np.repeat(starts + np.where(is_point, 0, 9), counts) + 21*within
+    pt_little = buf[pt_starts] == 1
+    coords = _read_words(buf, pt_starts+5, 8, 2, pt_little, '<f8')
+    return coords, counts
+
+def site_columns(sites):
+    """
+    Splits a list of (geometry, found, zero, others_found, total) sites into
+    columns. The geometries can be Shapely points and multipoints or their WKB.
+    Sites without a geometry are dropped, and missing counts are zeros.
+    Returns the coordinates IN RADIANS, the number of coordinates for each site,
+    and the found, zero and others_found columns.
+    """
+    sites = [s for s in sites if s[0] is not None]
+    if len(sites) == 0:
+        return np.empty((0,2)), np.zeros(0,dtype=int), np.zeros(0,dtype=int), np.zeros(0,dtype=int), np.zeros(0,dtype=int)
+    cols = zip(*sites)
+    x, counts = wkb_points([getattr(g, 'wkb', g) for g in cols[0]])
+    def count_column(col):
+        col = np.array(col, dtype=float)
+        return np.where(np.isnan(col), 0, col).astype(int)
+    return x*np.pi/180., counts, count_column(cols[1]), count_column(cols[2]), count_column(cols[3])
+
+# Changes whenever rows are added to or deleted from the species' sample
+# periods or expert opinion. On PostgreSQL it also includes an md5 of the
+# rows' contents, computed on the server, so that edits to existing rows
+# change it too.
+species_version_sql = """
+    select
+    (select count(*) from vector_sampleperiod where anopheline2_id = :species),
+    (select max(id) from vector_sampleperiod where anopheline2_id = :species),
+    (select count(*) from vector_expertopinion where anopheline2_id = :species),
+    (select max(id) from vector_expertopinion where anopheline2_id = :species)
+    """
+
+species_checksum_sql = """
+    select
+    md5(array_to_string(array(select t::text from vector_sampleperiod t where anopheline2_id = :species order by id), ',')),
+    md5(array_to_string(array(select t::text from vector_expertopinion t where anopheline2_id = :species order by id), ','))
+    """
+
+def session_dialect(session):
+    "The name of the database dialect a session is bound to, or None."
+    try:
+        return session.bind.dialect.name
+    except AttributeError:
+        return None
+
+def species_version(session, species_id):
+    """
+    Returns a marker that changes when the database's records for the species
+    change, or None if the database can't provide one.
+    """
+    from sqlalchemy.sql import text
+    try:
+        marker = tuple(session.execute(text(species_version_sql), {'species': species_id}).fetchone())
+        if session_dialect(session) in ('postgres', 'postgresql'):
+            marker += tuple(session.execute(text(species_checksum_sql), {'species': species_id}).fetchone())
+        return marker
+    except Exception:
+        cls, inst, tb = sys.exc_info()
+        warnings.warn('Could not get the database version of species %s, its query results will not be cached across runs. Original error message:\n\n%s'%(species_id, inst))
+        return None
+
+def species_key(species_id, marker):
+    return ('species_query', species_id, marker)
+
+def query_species_wkb(session, species_id):
+    "Runs species_query and converts the geometries to WKB."
+    sites, eo = species_query(session, species_id)
+    sites = [(getattr(s[0], 'wkb', s[0]),) + tuple(s[1:]) for s in sites]
+    return sites, getattr(eo, 'wkb', eo)
+
+def fetch_species(session, species_id):
+    """
+    Does the database work for a species. Returns its version marker and,
+    unless the cache store holds its results under that marker, its sites and
+    expert opinion as WKB; otherwise those are None. No HDF5 files are read,
+    so this can run in a background thread.
+    """
+    marker = species_version(session, species_id)
+    if marker is not None and species_key(species_id, marker) in cache_store():
+        return marker, None, None
+    sites, eo = query_species_wkb(session, species_id)
+    return marker, sites, eo
+
+_species_results = {}
+
+def _species_entry(session, species_id, fetched=None):
+    """
+    Returns the database version marker, the sites and the expert opinion of
+    the species. The database is checked once per process, unless the
+    output of fetch_species is passed in as fetched. Results are kept in the
+    cache store under the marker, so they are only queried again when the
+    marker changes.
+    """
+    if _species_results.has_key(species_id):
+        return _species_results[species_id]
     
-    if fname in os.listdir('anopheles-caches'):
-        hf = tb.openFile(os.path.join('anopheles-caches', fname))
-        breaks = hf.root.breaks[:]
-        x = hf.root.x[:]
-        found = hf.root.found[:]
-        zero = hf.root.zero[:]
-        others_found = hf.root.others_found[:]
-        multipoints = hf.root.multipoints[0]
-        hf.close()
+    marker, sites, eo = fetched or fetch_species(session, species_id)
+    key = species_key(species_id, marker)
+    cached = cache_store().get(key) if sites is None else None
     
+    if cached is not None:
+        sites = cached['sites']
+        eo = cached['eo']
     else:
-        sites, eo = species_query(session, species[0])
+        if sites is None:
+            # The results were evicted after they were fetched.
+            sites, eo = query_species_wkb(session, species_id)
+        if marker is not None:
+            cache_store().put(key, {'sites': sites, 'eo': eo})
+    
+    _species_results[species_id] = (marker, sites, shapely.wkb.loads(eo))
+    return _species_results[species_id]
+
+def cached_species_query(session, species_id, fetched=None):
+    """
+    Like species_query, but shared by every consumer and invalidated when the
+    database changes. The site geometries are returned as WKB. If the
+    database work has already been done by fetch_species, pass its output as
+    fetched.
+    """
+    return _species_entry(session, species_id, fetched)[1:]
+
+def forget_species_queries():
+    "Makes the next query for every species check the database again."
+    _species_results.clear()
+
+def site_recarray(sites):
+    """
+    Converts a list of sites to a NumPy record array of x, y and found, in
+    degrees, in bulk.
+    WARNING: Takes only the first point from multipoints.
+    """
+    x, counts, found, zero, others_found = site_columns(sites)
+    first = np.cumsum(counts)-counts
+    return np.rec.fromarrays([x[first,0]*180./np.pi, x[first,1]*180./np.pi, found], names='x,y,n')
+
+def sites_as_ndarray(session, species):
     
-        # Forget about non-records
-        sites = filter(lambda s:s[0] is not None, sites)
+    sites, eo = cached_species_query(session, species[0])
     
-        x = []
-        breaks = [0]
-        found = []
-        zero = []
-        others_found = []
-        totals = []
-
-        multipoints = False
-        for site in sites:
-            if isinstance(site[0], shapely.geometry.multipoint.MultiPoint):
-                x.append(multipoint_to_ndarray(site[0]))
-                breaks.append(breaks[-1] + len(site[0].geoms))
-                multipoints = True
-            if isinstance(site[0], shapely.geometry.point.Point):
-                x.append(np.atleast_2d(point_to_ndarray(site[0])))
-                breaks.append(breaks[-1] + 1)
-            else:
-                raise ValueError, 'Your list of sites has something in it that is neither a multipoint nor a point, you fruitcake.'
-            found.append(site[1] if site[1] is not None else 0)
-            zero.append(site[2] if site[2] is not None else 0)
-            others_found.append(site[3] if site[3] is not None else 0)
-            totals.append(site[4])
-
-        breaks = np.array(breaks)
-        x = np.concatenate(x)
-        found = np.array(found)
-        zero = np.array(zero)
-        others_found = np.array(others_found)
-        
-        hf = tb.openFile(os.path.join('anopheles-caches', fname),'w')
-        hf.createArray('/','breaks',breaks)
-        hf.createArray('/','x',x)
-        hf.createArray('/','found',found)
-        hf.createArray('/','zero',zero)
-        hf.createArray('/','others_found',others_found)
-        hf.createArray('/','multipoints',[multipoints])
-        hf.close()
+    x, counts, found, zero, others_found = site_columns(sites)
+    breaks = np.concatenate(([0], np.cumsum(counts)))
+    multipoints = bool(np.any(counts != 1))
     
     return breaks, x, found, zero, others_found, multipoints
             
+def world_geometry(session):
+    "Returns the WKB of the World table's land, which is only queried once."
+    key = ('geometry', 'World')
+    cached = cache_store().get(key)
+    if cached is None:
+        from anopheles_query import World
+        cached = {'wkb': session.query(World)[0].geom.wkb}
+        cache_store().put(key, cached)
+    return cached['wkb']
+
+def species_regions(session, species_id):
+    """
+    Returns the prepared expert opinion of the species, its complement against
+    World and their display versions. See region_geometries.
+    """
+    marker, sites, eo = _species_entry(session, species_id)
+    return region_geometries(eo.wkb, lambda: world_geometry(session))
+
 def sample_eo(session, species, n_inducing):
     
-    # Don't compute the world's land surface area using Shapely, because it
-    # uses cylindrical coordinates & will be wrong.
-    world_area = 150000000
-    
-    fname = '%s_eo_pts_%i.hdf5'%(species[1],n_inducing)
+    marker, sites, eo = _species_entry(session, species[0])
+    key = ('eo_pts', species[1], n_inducing, marker)
+    # Without a version marker the points can't be told apart from stale ones.
+    cached = cache_store().get(key) if marker is not None else None
     
-    if fname in os.listdir('anopheles-caches'):
-        hf = tb.openFile(os.path.join('anopheles-caches', fname))
-        pts_in = hf.root.pts_in[:]
-        pts_out = hf.root.pts_out[:]
-        hf.close()
+    if cached is not None:
+        pts_in = cached['pts_in']
+        pts_out = cached['pts_out']
     else:
         print 'Cached expert-opinion points not found, recomputing.'        
-        print 'Querying species'
-        sites, eo = species_query(session, species[0])
-        print 'Querying world'
-        world = session.query(World)[0].geom
-        print 'Differencing with expert opinion'
-        not_eo = world.difference(eo)
+        print 'Triangulating'
+        regions = species_regions(session, species[0])
+        eo_tri = regions['region'].triangulation()
+        out_tri = regions['complement'].triangulation()
         
-        eo_area = shapely_multipoly_area(eo)
+        # Areas are computed on the sphere, in steradians.
+        eo_area = eo_tri['areas'].sum()
+        out_area = out_tri['areas'].sum()
         
-        # Area of the EO region computed by Shapely will not be so bad
-        # because all the EO regions are near the equator
-        n_in = max(int(eo_area/world_area*n_inducing),20)
+        n_in = max(int(eo_area/(eo_area+out_area)*n_inducing),20)
         n_out = n_inducing-n_in
-        print 'Outside area=%f, n_out=%i:'%(world_area-eo_area,n_out)
-        print 'Inside area=%f, n_in=%i:'%(eo_area,n_in)
+        print 'Outside area=%f, n_out=%i:'%(out_area*earth_radius**2,n_out)
+        print 'Inside area=%f, n_in=%i:'%(eo_area*earth_radius**2,n_in)
     
         print 'Sampling outside'
-        lon_out, lat_out = multipoly_sample(n_out, not_eo)
+        lon_out, lat_out = sample_triangles(out_tri, n_out)
         print 'Sampling inside'
-        lon_in, lat_in = multipoly_sample(n_in, eo)
+        lon_in, lat_in = sample_triangles(eo_tri, n_in)
     
-        print 'Writing out'
         pts_in = np.vstack((lon_in, lat_in)).T*np.pi/180. 
         pts_out = np.vstack((lon_out, lat_out)).T*np.pi/180.
         
-        from IPython.Debugger import Pdb
-        Pdb(color_scheme='LightBG').set_trace()
-    
-        hf = tb.openFile(os.path.join('anopheles-caches',fname),'w')
-        hf.createArray('/','pts_in',pts_in)
-        hf.createArray('/','pts_out',pts_out)
+        if marker is not None:
+            cache_store().put(key, {'pts_in': pts_in, 'pts_out': pts_out})
     
     return pts_in, pts_out
 
-# Pylab-dependent stuff
-try:
+def split_recs(recs):
+    "Splits records into positive and negative versions."
+    pos_recs = recs[np.where(recs.n>0)]
+    neg_recs = recs[np.where(recs.n<=0)]
+    return pos_recs, neg_recs
+
+def plot_species(session, species, name, b=None, negs=True, **kwds):
+    "Plots the expert opinion, positives and not-observeds for the given species."
     import pylab as pl
     from mpl_toolkits import basemap
     from map_utils import plot_unit
-
-    __all__ += ['split_recs', 'plot_species']
-
-    def split_recs(recs):
-        "Splits records into positive and negative versions."
-        pos_recs = recs[np.where(recs.n>0)]
-        neg_recs = recs[np.where(recs.n<=0)]
-        return pos_recs, neg_recs
-    
-    def plot_species(session, species, name, b=None, negs=True, **kwds):
-        "Plots the expert opinion, positives and not-observeds for the given species."
-        sites, eo = species_query(session, species)
-        ra = sitelist_to_recarray(sites)
-        pos_recs, neg_recs = split_recs(ra)
-        if b is None:
-            b = basemap.Basemap(*map_extents(pos_recs, eo), **kwds)
-        b.drawcoastlines(color='w',linewidth=.5)
-        # b.drawcountries(color='w',linewidth=.5)
-        pl.title(name, style='italic')        
-        plot_unit(b, eo, '-', color=(.4,.4,.9), label='_nolegend_', linewidth=.75)        
-        if negs:
-            b.plot(neg_recs.x, neg_recs.y, '.', color=(.1,.6,.6), markersize=1.5, label='Observed')        
-        b.plot(pos_recs.x, pos_recs.y, '.', color=(.9,.4,.4), markersize=1.5, label='Observed')
-
-
-except ImportError:
-    kls,inst,tb = sys.exc_info()
-    print 'Warning, could not import Pylab. Original error message:\n\n' + inst.message
+    sites, eo = cached_species_query(session, species)
+    eo = species_regions(session, species)['region_display'].geom
+    ra = site_recarray(sites)
+    pos_recs, neg_recs = split_recs(ra)
+    if b is None:
+        b = basemap.Basemap(*map_extents(pos_recs, eo), **kwds)
+    b.drawcoastlines(color='w',linewidth=.5)
+    # b.drawcountries(color='w',linewidth=.5)
+    pl.title(name, style='italic')        
+    plot_unit(b, eo, '-', color=(.4,.4,.9), label='_nolegend_', linewidth=.75)        
+    if negs:
+        b.plot(neg_recs.x, neg_recs.y, '.', color=(.1,.6,.6), markersize=1.5, label='Observed')        
+    b.plot(pos_recs.x, pos_recs.y, '.', color=(.9,.4,.4), markersize=1.5, label='Observed')
 
 if __name__ == '__main__':
     session = Session()
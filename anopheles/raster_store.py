@@ -0,0 +1,498 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A local store of the raster datafiles, kept in step with the server through
+a checksum manifest. Each layer is synchronized at most once per version,
+rather than once per call.
+
+The server (or a local directory standing in for it) holds a file called
+MANIFEST in sha1sum format, i.e. lines of the form
+
+    <sha1 hex digest>  <path relative to the data root>
+
+The store keeps a manifest of the same format describing its local copies,
+and fetches a layer only when the two disagree.
+"""
+
+import os, sys, shutil, subprocess, tempfile
+import hashlib
+import warnings
+import tables as tb
+import numpy as np
+from collections import OrderedDict
+
+__all__ = ['overview_level', 'thinned_axis', 'RasterStore', 'RasterPool', 'RasterHandle', 'raster_handle', 'LocalDirectoryBackend', 'RsyncBackend', 'raster_store', 'set_raster_store']
+
+manifest_fname = 'MANIFEST'
+overview_dirname = 'overviews'
+
+def file_checksum(path, blocksize=2**20):
+    "Returns the SHA1 hex digest of the file at path."
+    h = hashlib.sha1()
+    f = open(path, 'rb')
+    try:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            h.update(block)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def read_manifest(path):
+    "Reads a sha1sum-format manifest into a dictionary mapping relative paths to checksums."
+    manifest = {}
+    if not os.path.exists(path):
+        return manifest
+    for line in file(path):
+        line = line.strip()
+        if len(line)==0 or line.startswith('#'):
+            continue
+        checksum, relpath = line.split(None, 1)
+        manifest[relpath.lstrip('*').strip()] = checksum
+    return manifest
+
+def write_manifest(path, manifest):
+    "Writes a manifest atomically, so that concurrent readers never see a partial file."
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.manifest')
+    f = os.fdopen(fd, 'w')
+    try:
+        for relpath in sorted(manifest.iterkeys()):
+            f.write('%s  %s\n'%(manifest[relpath], relpath))
+    finally:
+        f.close()
+    os.rename(tmp, path)
+
+def thinned_axis(axis, sign, thin):
+    """
+    Returns the values of an increasing axis, in increasing order, picked out
+    by taking every thin'th element of a data array that runs along the axis
+    forward (sign '+') or backward (sign '-').
+    """
+    if sign == '+':
+        return axis[::thin]
+    return axis[::-1][::thin][::-1]
+
+def overview_level(thin, max_level=64):
+    "Returns the coarsest overview level that a thinning of thin can be served from exactly."
+    level = 1
+    while thin % (level*2) == 0 and level*2 <= max_level:
+        level *= 2
+    return level
+
+class LocalDirectoryBackend(object):
+    """
+    A backend that reads rasters from a local directory standing in for the
+    server. If the directory has no MANIFEST, checksums are computed from the
+    files themselves.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._manifest = None
+
+    def manifest(self):
+        if self._manifest is None:
+            self._manifest = read_manifest(os.path.join(self.root, manifest_fname))
+        return self._manifest
+
+    def checksum(self, relpath):
+        "Returns the server-side checksum of relpath, or None if the server does not have it."
+        manifest = self.manifest()
+        if manifest.has_key(relpath):
+            return manifest[relpath]
+        path = os.path.join(self.root, relpath)
+        if os.path.exists(path):
+            return file_checksum(path)
+        return None
+
+    def fetch(self, relpath, dest):
+        "Copies relpath to dest. Returns True on success."
+        src = os.path.join(self.root, relpath)
+        if not os.path.exists(src):
+            return False
+        shutil.copyfile(src, dest)
+        return True
+
+class RsyncBackend(object):
+    """
+    A backend that synchronizes with the server over ssh. The remote manifest
+    is fetched once per backend, so a model run costs one round trip plus one
+    transfer per stale layer.
+    """
+    def __init__(self, host='map1.zoo.ox.ac.uk', root='/srv/data'):
+        self.host = host
+        self.root = root
+        self._manifest = None
+        self._unreachable = False
+
+    def _rsync(self, relpath, dest):
+        remote_file = '%s:%s'%(self.host, os.path.join(self.root, relpath))
+        return subprocess.call(['rsync', '--quiet', remote_file, dest]) == 0
+
+    def manifest(self):
+        if self._unreachable:
+            raise IOError, 'Server %s is unreachable.'%self.host
+        if self._manifest is None:
+            fd, tmp = tempfile.mkstemp(prefix='anopheles-manifest')
+            os.close(fd)
+            try:
+                if self._rsync(manifest_fname, tmp):
+                    self._manifest = read_manifest(tmp)
+                else:
+                    # Don't stall on every subsequent layer.
+                    self._unreachable = True
+                    raise IOError, 'Failed to fetch manifest from %s.'%self.host
+            finally:
+                os.remove(tmp)
+        return self._manifest
+
+    def checksum(self, relpath):
+        return self.manifest().get(relpath, None)
+
+    def fetch(self, relpath, dest):
+        return self._rsync(relpath, dest)
+
+class RasterStore(object):
+    """
+    A local, checksummed copy of the raster datafiles.
+
+    Layers are named as in get_datafile, ie relative to the data root and
+    without the '.hdf5' extension. A layer is fetched from the backend only
+    if the local manifest's checksum differs from the backend's, and each
+    layer is checked at most once per store. In offline mode the backend is
+    never contacted and only local copies are used.
+
+    Open handles are kept in a RasterPool and handed out again on later
+    requests; max_open and max_bytes are the pool's budgets.
+    """
+    def __init__(self, root, backend=None, offline=False, max_open=32, max_bytes=2**29):
+        self.root = root
+        if backend is None:
+            backend = RsyncBackend()
+        self.backend = backend
+        self.offline = offline
+        self.manifest_path = os.path.join(self.root, manifest_fname)
+        self.manifest = read_manifest(self.manifest_path)
+        self._checked = set()
+        self.pool = RasterPool(self, max_open, max_bytes)
+
+    def relpath(self, name):
+        return name + '.hdf5'
+
+    def path(self, name):
+        return os.path.join(self.root, self.relpath(name))
+
+    def is_stale(self, name):
+        """
+        Returns True if the local copy of the layer is missing or differs from
+        the backend's version. Raises IOError if the backend is unreachable.
+        """
+        if not os.path.exists(self.path(name)):
+            return True
+        remote = self.backend.checksum(self.relpath(name))
+        if remote is None:
+            # The backend doesn't know about this layer, so the local copy is authoritative.
+            return False
+        return self.manifest.get(self.relpath(name), None) != remote
+
+    def sync(self, name):
+        """
+        Makes sure the local copy of the layer is current, and returns its path.
+        Contacts the backend at most once per layer over the store's lifetime.
+        """
+        path = self.path(name)
+        if self.offline or name in self._checked:
+            if not os.path.exists(path):
+                raise IOError, 'Layer %s is not available locally%s.'%(name, ' and the store is offline' if self.offline else '')
+            return path
+
+        try:
+            stale = self.is_stale(name)
+        except (IOError, OSError):
+            cls, inst, trace = sys.exc_info()
+            if not os.path.exists(path):
+                raise
+            warnings.warn('Failed to check %s against server, using local copy. Error message:\n\t%s'%(name, inst))
+            stale = False
+
+        if stale:
+            self.fetch(name)
+        self._checked.add(name)
+        return path
+
+    def fetch(self, name):
+        "Unconditionally fetches the layer from the backend and records its checksum."
+        relpath = self.relpath(name)
+        path = self.path(name)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+
+        # Fetch into a temporary file, so that a failed transfer never clobbers a good local copy.
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.'+os.path.basename(path))
+        os.close(fd)
+        try:
+            if not self.backend.fetch(relpath, tmp):
+                if os.path.exists(path):
+                    warnings.warn('Failed to synchronize %s with server, using local copy.'%name)
+                    return
+                raise IOError, 'Failed to fetch %s from server.'%name
+            self.invalidate(name)
+            os.rename(tmp, path)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+        expected = self.backend.checksum(relpath)
+        actual = file_checksum(path)
+        if expected is not None and expected != actual:
+            warnings.warn('Checksum of %s does not match the server manifest.'%name)
+        self.manifest[relpath] = actual
+        write_manifest(self.manifest_path, self.manifest)
+
+    def version(self, name):
+        "Returns a string identifying the version of the local copy of the layer."
+        path = self.sync(name)
+        return self.manifest.get(self.relpath(name), None) or repr(os.path.getmtime(path))
+
+    def overview(self, name, level):
+        """
+        Returns the name of the datafile holding the layer thinned by level,
+        which must be a power of two, ie every level'th row and column of its
+        data array. Overviews are built once, each from the next finer one,
+        and rebuilt when the layer changes.
+        """
+        if level == 1:
+            return name
+        if level < 1 or level & (level-1) != 0:
+            raise ValueError, 'Overview levels must be powers of two, not %i.'%level
+        ov_name = os.path.join(overview_dirname, '%s.x%i'%(name, level))
+        finer = self.overview(name, level/2)
+        version = self.version(name)
+
+        if os.path.exists(self.path(ov_name)):
+            if self.pool.get(ov_name).data.attrs.source_version == version:
+                return ov_name
+        self.build_overview(finer, ov_name, version)
+        return ov_name
+
+    def build_overview(self, source, dest, version, strip=1024):
+        "Writes dest as source thinned by two, a strip of rows at a time."
+        src = self.pool.get(source)
+        view = src.view
+        path = self.path(dest)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.invalidate(dest)
+
+        shape = ((src.data.shape[0]+1)/2, (src.data.shape[1]+1)/2) + src.data.shape[2:]
+        chunkshape = src.data.chunkshape
+        if chunkshape is not None:
+            chunkshape = tuple(np.minimum(chunkshape, shape))
+        filters = tb.Filters(complevel=1)
+
+        tmp = path + '.tmp'
+        hf = tb.openFile(tmp, 'w')
+        try:
+            hf.createArray('/', 'lon', thinned_axis(src.lon, view[view.index('x')+1], 2))
+            hf.createArray('/', 'lat', thinned_axis(src.lat, view[view.index('y')+1], 2))
+            data = hf.createCArray('/', 'data', atom=src.data.atom, shape=shape, chunkshape=chunkshape, filters=filters)
+            for attr in src.data.attrs._v_attrnamesuser:
+                setattr(data.attrs, attr, getattr(src.data.attrs, attr))
+            data.attrs.source_version = version
+            if hasattr(src.root, 'mask'):
+                mask = hf.createCArray('/', 'mask', atom=src.root.mask.atom, shape=shape, chunkshape=chunkshape, filters=filters)
+            for r0 in xrange(0, src.data.shape[0], 2*strip):
+                r1 = min(r0+2*strip, src.data.shape[0])
+                data[r0/2:(r1+1)/2] = src.data[r0:r1:2, ::2]
+                if hasattr(src.root, 'mask'):
+                    mask[r0/2:(r1+1)/2] = src.root.mask[r0:r1:2, ::2]
+        finally:
+            hf.close()
+        os.rename(tmp, path)
+
+    def open(self, name):
+        "Returns an open PyTables file for the layer, reusing a previously opened one if possible."
+        return self.pool.get(name).file
+
+    def close(self, name):
+        self.pool.discard(name)
+
+    def invalidate(self, name):
+        """
+        Closes any pooled handles on the layer's local file and forgets that it
+        was checked, so the next request reopens the file as it is on disk.
+        """
+        self.pool.invalidate(self.path(name))
+        self._checked.discard(name)
+
+    def close_all(self):
+        self.pool.clear()
+
+class RasterHandle(object):
+    """
+    An open raster layer, with its coordinate axes, view and (if it is small
+    enough) mask read into memory once.
+    """
+    def __init__(self, name, path, max_mask_bytes):
+        self.name = name
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        self.file = tb.openFile(path)
+        self.root = self.file.root
+
+        hr = self.root
+        if hasattr(hr, 'lon'):
+            self.lon = hr.lon[:]
+        else:
+            self.lon = hr.long[:]
+        self.lat = hr.lat[:]
+        self.data = hr.data
+
+        if hasattr(self.data.attrs, 'view'):
+            self.view = self.data.attrs.view
+        else:
+            self.view = None
+
+        # Global masks can be very large, so leave those on disk.
+        self.mask = None
+        mask_bytes = 0
+        if hasattr(hr, 'mask'):
+            mask_bytes = int(np.prod(hr.mask.shape))*hr.mask.atom.itemsize
+            if mask_bytes <= max_mask_bytes:
+                self.mask = hr.mask[:]
+            else:
+                self.mask = hr.mask
+                mask_bytes = 0
+
+        self.nbytes = self.lon.nbytes + self.lat.nbytes + mask_bytes
+
+    def is_current(self):
+        return self.file.isopen and self.mtime == os.path.getmtime(self.path)
+
+    def close(self):
+        if self.file.isopen:
+            self.file.close()
+
+class RasterPool(object):
+    """
+    A least-recently-used pool of open raster handles. At most max_open files
+    are kept open, and the coordinate axes and masks held in memory are kept
+    under max_bytes; the least recently used handles are closed to make room.
+
+    Handles handed out by the pool may be closed by later requests once more
+    than max_open layers are in use, so max_open should be at least the number
+    of layers any one computation needs at once.
+    """
+    def __init__(self, store, max_open=32, max_bytes=2**29):
+        self.store = store
+        self.max_open = max_open
+        self.max_bytes = max_bytes
+        self.handles = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        "Returns an open RasterHandle for the named layer."
+        handle = self.handles.pop(name, None)
+        if handle is not None:
+            if handle.is_current():
+                self.handles[name] = handle
+                self.hits += 1
+                return handle
+            self.nbytes -= handle.nbytes
+            handle.close()
+
+        self.misses += 1
+        path = self.store.sync(name)
+        handle = RasterHandle(name, path, self.max_bytes/4)
+        self.handles[name] = handle
+        self.nbytes += handle.nbytes
+        self.evict()
+        return handle
+
+    def evict(self):
+        "Closes least recently used handles until the pool is within its budgets."
+        while len(self.handles) > 1 and (len(self.handles) > self.max_open or self.nbytes > self.max_bytes):
+            name, handle = self.handles.popitem(last=False)
+            self.nbytes -= handle.nbytes
+            handle.close()
+
+    def discard(self, name):
+        handle = self.handles.pop(name, None)
+        if handle is not None:
+            self.nbytes -= handle.nbytes
+            handle.close()
+
+    def invalidate(self, path):
+        """
+        Closes and drops every handle open on the file at path. Call this before
+        replacing or rewriting a file that the pool may have open, since HDF5
+        will not reopen an open file for writing.
+        """
+        path = os.path.abspath(path)
+        for name, handle in self.handles.items():
+            if os.path.abspath(handle.path) == path:
+                self.discard(name)
+
+    def clear(self):
+        for name in self.handles.keys():
+            self.discard(name)
+
+    def forget(self):
+        """
+        Drops all handles without closing them. Forked worker processes call
+        this so that they never touch file handles inherited from the parent.
+        """
+        self.handles = OrderedDict()
+        self.nbytes = 0
+
+_store = None
+
+def raster_store():
+    """
+    Returns the process-wide raster store, creating it on first use. The
+    store is offline if the environment variable ANOPHELES_OFFLINE is 1, true
+    or yes, and reads from the directory ANOPHELES_DATA_SERVER instead of the
+    real server if that is set. ANOPHELES_MAX_OPEN_RASTERS and
+    ANOPHELES_RASTER_CACHE_BYTES set the handle pool's budgets.
+    """
+    global _store
+    if _store is None:
+        import anopheles
+        root = os.path.join(anopheles.__path__[0], '../datafiles')
+        local_server = os.environ.get('ANOPHELES_DATA_SERVER', None)
+        if local_server is not None:
+            backend = LocalDirectoryBackend(local_server)
+        else:
+            backend = RsyncBackend()
+        _store = RasterStore(root, backend, offline=os.environ.get('ANOPHELES_OFFLINE', '').lower() in ('1', 'true', 'yes'),
+                                max_open=int(os.environ.get('ANOPHELES_MAX_OPEN_RASTERS', 32)),
+                                max_bytes=int(os.environ.get('ANOPHELES_RASTER_CACHE_BYTES', 2**29)))
+    return _store
+
+def raster_handle(name):
+    "Returns a pooled RasterHandle for the named layer from the process-wide raster store."
+    return raster_store().pool.get(name)
+
+def set_raster_store(store):
+    "Replaces the process-wide raster store, closing the old one's handles."
+    global _store
+    if _store is not None:
+        _store.close_all()
+    _store = store
@@ -2,8 +2,10 @@ from sqlalchemy.orm import join
 from sqlalchemy.sql import func, exists, and_, not_
 from models import Anopheline, Site, SamplePeriod, Session
 from sqlalchemygeom import *
+from sessions import LazySession
 
-session = Session(autocommit=True)
+# Don't connect until a report is actually run.
+session = LazySession(lambda: Session(autocommit=True))
 
 reports = []
 
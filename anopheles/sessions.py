@@ -0,0 +1,130 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Database sessions for the query layer.
+
+Sessions come from a factory bound to an engine with a bounded pool of
+connections, so several species can be queried at once without opening
+a connection per query. prefetch_species uses it to run the next species'
+queries in the background while the current species is being processed.
+SQLAlchemy is only imported when the first engine or factory is made.
+"""
+
+import os
+import multiprocessing.pool
+from query_to_rec import fetch_species, cached_species_query
+
+__all__ = ['pooled_engine', 'session_factory', 'set_session_factory', 'new_session', 'prefetch_species', 'LazySession']
+
+def pooled_engine(url, pool_size=4, max_overflow=0, **kwds):
+    """
+    Creates an engine that holds at most pool_size+max_overflow connections
+    to the database at url. SQLite databases can't share connections between
+    threads, so an in-memory SQLite database gets a single connection that
+    the threads take turns on, and a SQLite file gets a new connection for
+    each session.
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import NullPool, StaticPool
+    if url.startswith('sqlite'):
+        if url in ['sqlite://', 'sqlite:///:memory:']:
+            return create_engine(url, poolclass=StaticPool, connect_args={'check_same_thread': False}, **kwds)
+        return create_engine(url, poolclass=NullPool, **kwds)
+    return create_engine(url, pool_size=pool_size, max_overflow=max_overflow, **kwds)
+
+_factory = None
+
+def default_url():
+    "The database anopheles_query connects to."
+    from anopheles_query import Session
+    session = Session()
+    try:
+        return str(session.bind.url)
+    finally:
+        session.close()
+
+def session_factory():
+    """
+    Returns the process-wide session factory, creating it on first use.
+    ANOPHELES_DATABASE_URL names the database, which defaults to the one
+    anopheles_query connects to, and ANOPHELES_DB_CONNECTIONS bounds the
+    number of connections.
+    """
+    global _factory
+    if _factory is None:
+        from sqlalchemy.orm import sessionmaker
+        url = os.environ.get('ANOPHELES_DATABASE_URL', None) or default_url()
+        engine = pooled_engine(url, pool_size=int(os.environ.get('ANOPHELES_DB_CONNECTIONS', 4)))
+        _factory = sessionmaker(bind=engine)
+    return _factory
+
+def set_session_factory(factory):
+    "Replaces the process-wide session factory, for example with one bound to a test database."
+    global _factory
+    _factory = factory
+
+def new_session():
+    "Returns a new session from the process-wide session factory."
+    return session_factory()()
+
+def _fetch(args):
+    factory, species_id = args
+    session = factory()
+    try:
+        return fetch_species(session, species_id)
+    finally:
+        session.close()
+
+def prefetch_species(species, factory=None, lookahead=2):
+    """
+    Iterates over (species, sites, eo) for a list of (id, name) species, with
+    the same results as cached_species_query. The database work for the next
+    lookahead species runs in background threads, each on its own session
+    from factory, while the caller works on the current species.
+    """
+    factory = factory or session_factory()
+    species = list(species)
+    pool = multiprocessing.pool.ThreadPool(max(lookahead,1))
+    session = factory()
+    pending = []
+    try:
+        for i in xrange(len(species)):
+            while len(pending) < min(i+lookahead+1, len(species)):
+                pending.append(pool.apply_async(_fetch, ((factory, species[len(pending)][0]),)))
+            sites, eo = cached_species_query(session, species[i][0], pending[i].get())
+            yield species[i], sites, eo
+    finally:
+        pool.terminate()
+        pool.join()
+        session.close()
+
+class LazySession(object):
+    """
+    Stands in for a session that is only opened when it is first used, so
+    that modules can build queries at import without connecting.
+    """
+    def __init__(self, factory):
+        self._factory = factory
+        self._session = None
+
+    def query(self, *entities):
+        from sqlalchemy.orm import Query
+        return Query(entities, session=self)
+
+    def __getattr__(self, name):
+        if self.__dict__['_session'] is None:
+            self.__dict__['_session'] = self._factory()
+        return getattr(self._session, name)
@@ -1,6 +1,8 @@
 import numpy as np
 import cov_prior
 from mahalanobis_covariance import *
+from factor_cache import factor_cache, cached_cholesky, without_distance_cache
+from inducing_points import variance_reduction
 import pymc as pm
 
 def normalize_env(x, means, stds):
@@ -10,8 +12,37 @@ def normalize_env(x, means, stds):
         x_norm[:,i] /= stds[i-2]
     return x_norm
 
-def compute_offdiag(C, U, x, xp):
-    return pm.gp.trisolve(U, C(x,xp), uplo='U', transa='T').T
+def compute_offdiag(C, U, x, xp, cache=None):
+    """
+    Returns C(xp,x) U^{-1}, where U is the Cholesky factor of C on x. The
+    result is kept in the factor cache, or the process-wide one if cache is
+    None. If cache is False neither it nor the distances it is computed from
+    are cached.
+    """
+    if hasattr(U, 'offdiag'):
+        # Sparse factors make their own off-diagonal operators.
+        compute = lambda: U.offdiag(C, x, xp)
+    else:
+        compute = lambda: pm.gp.trisolve(U, C(x,xp), uplo='U', transa='T').T
+    if cache is False:
+        return without_distance_cache(compute)
+    return (cache or factor_cache()).offdiag(C, x, xp, compute)
+                
+def covariance_pivots(C, x, rank, tol=1.e-4):
+    """
+    Chooses up to rank pivots from the rows of x by incomplete Cholesky
+    factorization of C on x with greedy pivoting; see variance_reduction.
+    Returns the pivots in increasing order.
+    """
+    return np.sort(variance_reduction(C, x, rank, tol)[0])
+
+def reference_covariance(n_env):
+    """
+    The covariance of lr_spatial_env with scale and val at their prior means,
+    which make_model uses to choose inducing points.
+    """
+    return pm.gp.FullRankCovariance(spatial_mahalanobis, dds=1.5, dde=1.5, amp=1.0, scale=1., val=np.ones(n_env),
+                                    vec=np.eye(n_env), spat_frac=1./3, const_frac=1./3)
                 
 class LRP(object):
     """A closure that can evaluate a low-rank field."""
@@ -25,23 +56,44 @@ class LRP(object):
         if f2p is None:
             f2p = self.f2p
         if offdiag is None:
-            offdiag = compute_offdiag(self.C, self.U_fr, self.x_fr, x)
+            # Maps evaluate each tile once per sample, so there's no point caching.
+            offdiag = compute_offdiag(self.C, self.U_fr, self.x_fr, x, cache=False)
         return f2p(np.dot(np.asarray(offdiag), self.krige_wt).reshape(x.shape[:-1]))
 
 def spatial_mahalanobis(x,y,dds,dde,amp,scale,val,vec,spat_frac,const_frac,symm=None):
     """
     The covariance of k + f_env(x) + f_spat, where the overall amplitude is fixed
     to 'amp'.
+    
+    The spatial and environmental parts are computed from cached distances and
+    are cached themselves, so a change to scale only recomputes the spatial part
+    and a change to val only recomputes the environmental part.
     """
     spat_amp = np.sqrt(spat_frac*amp**2)
     env_amp = np.sqrt((1-spat_frac-const_frac)*amp**2)
     const_amp = np.sqrt(const_frac*amp**2)
-    spat_part = pm.gp.matern.geo_rad(x[:,:2],y[:,:2],amp=spat_amp,scale=scale,diff_degree=dds,symm=symm)
-    env_part = mahalanobis_covariance(x[:,2:],y[:,2:],diff_degree=dde,amp=env_amp,val=val,vec=vec,symm=symm)
+    spat_part = geo_rad_component(x[:,:2],y[:,:2],diff_degree=dds,amp=spat_amp,scale=scale)
+    env_part = mahalanobis_component(x[:,2:],y[:,2:],diff_degree=dde,amp=env_amp,val=val,vec=vec)
     
-    out = spat_part+env_part+const_amp**2
+    out = np.asmatrix(np.asarray(spat_part+env_part+const_amp**2, order='F'))
 
     return out
+
+def spatial_mahalanobis_blocks(x,y,dds,dde,amp,scale,val,vec,spat_frac,const_frac):
+    """
+    The same covariance as spatial_mahalanobis between stacks of points. x
+    and y have shapes (...,a,d) and (...,b,d), and the result has shape
+    (...,a,b).
+    """
+    x = x[...,:,np.newaxis,:]
+    y = y[...,np.newaxis,:,:]
+    spat_part = spat_frac*amp**2*matern(angular_distance(x[...,0],x[...,1],y[...,0],y[...,1])/scale, dds)
+    tdev = np.tensordot(x[...,2:]-y[...,2:], np.asarray(vec, dtype=float), axes=1)
+    env_part = (1-spat_frac-const_frac)*amp**2*matern(np.sqrt((tdev**2/np.asarray(val, dtype=float)).sum(axis=-1)), dde)
+    return spat_part+env_part+const_frac*amp**2
+
+# The parts' variances add up to amp**2, so PyMC can evaluate the variance without a loop.
+spatial_mahalanobis.diag_call = lambda x, amp, **params: np.repeat(amp**2, len(x)).astype(float)
     
 class LRP_norm(LRP):
     """
@@ -58,8 +110,18 @@ class LRP_norm(LRP):
         x_norm = normalize_env(x, self.means, self.stds)
         return LRP.__call__(self, x_norm.reshape(x.shape), f2p,offdiag)        
 
-def lr_spatial_env(rl=200,**stuff):
-    """A low-rank spatial-only model."""
+def lr_spatial_env(rl=None, tol=1.e-4, pivots=None, **stuff):
+    """
+    A low-rank spatial-only model.
+    
+    If rl is given, the field is only sampled at up to rl of the inducing
+    points, chosen by covariance_pivots under reference_covariance, and
+    kriged everywhere else. The reference covariance is fixed, so the same
+    points are chosen every time the model is built. If pivots is given,
+    the inducing points with those indices are used instead. Otherwise the
+    field is sampled at all the inducing points. The pivots are returned as
+    pivots and the inducing points used as x_fr.
+    """
 
     x_fr = normalize_env(stuff['full_x_fr'], stuff['env_means'], stuff['env_stds'])
     f2p = stuff['f2p']
@@ -107,12 +169,19 @@ def lr_spatial_env(rl=200,**stuff):
     def C(val=val,vec=vec,const_frac=const_frac,spat_frac=spat_frac,scale=scale):
         return pm.gp.FullRankCovariance(spatial_mahalanobis, dds=1.5, dde=1.5, amp=1.0, scale=scale,val=val, vec=vec, spat_frac=spat_frac, const_frac=const_frac)
 
+    # Reduce the rank by keeping the inducing points that explain the most
+    # prior variance. Factorizing C on them is then O(rl^3) rather than O(n^3),
+    # and each evaluation group costs O(n*rl^2).
+    if pivots is None and rl is not None and rl < len(x_fr):
+        pivots = covariance_pivots(reference_covariance(n_env), x_fr, rl, tol)
+    if pivots is not None:
+        x_fr = x_fr[pivots]
+
+    # Rejected hyperparameter proposals are often proposed again, so the
+    # factors come from the factor cache.
     @pm.deterministic(trace=False)
     def U_fr(C=C, x=x_fr):
-        try:
-            return C.cholesky(x)
-        except np.linalg.LinAlgError:
-            return None
+        return cached_cholesky(C, x)
 
     @pm.potential
     def rank_check(U=U_fr):
@@ -132,4 +201,6 @@ def lr_spatial_env(rl=200,**stuff):
 
     p = pm.Lambda('p', lambda x_fr=x_fr, C=C, krige_wt=g_fr, U_fr=U_fr, means=stuff['env_means'], stds=stuff['env_stds'], f2p=f2p: LRP_norm(x_fr, C, krige_wt, U_fr, means, stds, f2p))
 
-    return locals()
\ No newline at end of file
+    return locals()
+
+lr_spatial_env.reference_covariance = reference_covariance
\ No newline at end of file
@@ -19,6 +19,30 @@ def union(sets):
 class ConstraintError(ValueError):
     pass
 
+# The factors and off-diagonal blocks are either dense matrices or sparse
+# operators like VecchiaFactor and VecchiaOffdiag.
+
+def factor_row(U, i):
+    "Row i of the factor U, the change in f per unit change in g[i]."
+    U = pm.utils.value(U)
+    if hasattr(U, 'row'):
+        return U.row(i)
+    return np.asarray(U[i,:]).squeeze()
+
+def offdiag_column(od, i):
+    "Column i of an off-diagonal block."
+    od = pm.utils.value(od)
+    if hasattr(od, 'column'):
+        return od.column(i)
+    return np.asarray(od[:,i]).squeeze()
+
+def offdiag_dot(od, g):
+    "The product of an off-diagonal block and g."
+    od = pm.utils.value(od)
+    if hasattr(od, 'column'):
+        return od.dot(g)
+    return np.asarray(np.dot(od, g)).squeeze()
+
 def check_cached_value(v):
     if isinstance(v, pm.Deterministic):
         if np.any(v.value != v._value.fun(**v.parents.value)):
@@ -83,7 +107,7 @@ class CMVNImportance(pm.StepMethod):
         g = self.g.value
         for j,od in enumerate(self.constraint_offdiags):
             rhs[od] = self.rhs[od].copy()
-            coef = np.asarray(pm.utils.value(od))[:,i].squeeze()
+            coef = offdiag_column(od, i)
             rhs[od] -= coef * g[i]
             
             where_coef_neg = np.where(coef<0)
@@ -121,14 +145,14 @@ class CMVNImportance(pm.StepMethod):
         
         t1 = time.time()
         # Record change in f.
-        self.f.value = self.f.value + np.asarray(pm.utils.value(self.U)[i,:]).squeeze()*dg
+        self.f.value = self.f.value + factor_row(self.U, i)*dg
         self.g._value.force_cache(g)
         
         for j,od in enumerate(self.constraint_offdiags):
             # The children of the offdiags are just the f_evals.
             # check_cached_value(od)
             for c in od.children:
-                c._value.force_cache(cv[c] + np.asarray(od.value[:,i]).squeeze()*dg)
+                c._value.force_cache(cv[c] + offdiag_column(od, i)*dg)
                 # check_cached_value(c)
                 eval_all_children(c)
         
@@ -139,7 +163,7 @@ class CMVNImportance(pm.StepMethod):
             # The children of the offdiags are just the f_evals.
             for c in od.children:
                 # check_cached_value(c)
-                new_val = cv[c] + np.asarray(od.value[:,i]).squeeze()*dg
+                new_val = cv[c] + offdiag_column(od, i)*dg
                 c._value.force_cache(new_val)
                 eval_all_children(c)
                         
@@ -156,7 +180,7 @@ class CMVNImportance(pm.StepMethod):
         
         # The right-hand sides for the linear constraints
         self.rhs = dict(zip(self.constraint_offdiags, 
-                            [np.asarray(np.dot(pm.utils.value(od), self.g.value)).squeeze() for od in self.constraint_offdiags]))
+                            [offdiag_dot(od, self.g.value) for od in self.constraint_offdiags]))
         
         for i in xrange(self.n):
             
@@ -182,7 +206,7 @@ class CMVNImportance(pm.StepMethod):
             self.set_g_value(newg, i)
                     
             for od in self.constraint_offdiags:
-                rhs[od] += np.asarray(pm.utils.value(od))[:,i].squeeze() * newg
+                rhs[od] += offdiag_column(od, i) * newg
                 self.rhs = rhs
         
 class CMVNMetropolis(CMVNImportance):
@@ -197,7 +221,7 @@ class CMVNMetropolis(CMVNImportance):
         # TODO: Propose from not the prior, and tune using the asf's.
         # The right-hand sides for the linear constraints
         self.rhs = dict(zip(self.constraint_offdiags, 
-                            [np.asarray(np.dot(pm.utils.value(od), self.g.value)).squeeze() for od in self.constraint_offdiags]))
+                            [offdiag_dot(od, self.g.value) for od in self.constraint_offdiags]))
         this_round = np.zeros(self.n, dtype='int')
 
         for i in xrange(self.n):
@@ -239,7 +263,7 @@ class CMVNMetropolis(CMVNImportance):
                 self.accepted[i] += 1
                 this_round[i] = 1
                 for od in self.constraint_offdiags:
-                    rhs[od] += np.asarray(pm.utils.value(od))[:,i].squeeze() * newg
+                    rhs[od] += offdiag_column(od, i) * newg
                 self.rhs = rhs
                 self.check_constraints()
             else:
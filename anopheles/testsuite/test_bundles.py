@@ -0,0 +1,98 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import os, shutil, tempfile
+import tables as tb
+from anopheles import SpeciesBundle, write_bundle, load_bundle, as_bundle, make_model, lr_spatial_env
+
+def fake_bundle(n_sites=5):
+    return SpeciesBundle((3, 'Anopheles fakeus'), ['a','b','c'], 50, np.random.normal(size=(20,2))*.1, np.random.normal(size=(30,2)), 
+                            np.arange(n_sites+1), np.random.normal(size=(n_sites,2))*.1, np.arange(n_sites)%2, np.zeros(n_sites,dtype=int),
+                            np.ones(n_sites,dtype=int), np.random.normal(size=(20,3)), np.random.normal(size=(30,3)), 
+                            np.random.normal(size=(n_sites,3)))
+
+class test_bundles(object):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_roundtrip(self):
+        "Tests that bundles come back from their files unchanged, including empty arrays."
+        pts_in = np.random.normal(size=(20,2))
+        pts_out = np.random.normal(size=(30,2))
+        x = np.random.normal(size=(5,2))
+        bundle = SpeciesBundle((3, 'Anopheles fakeus'), ['a','b'], 50, pts_in, pts_out, np.arange(6), x,
+                                np.array([1,0,2,0,1]), np.zeros(5,dtype=int), np.ones(5,dtype=int),
+                                np.random.normal(size=(20,2)), np.random.normal(size=(30,2)), np.random.normal(size=(5,2)))
+        assert_almost_equal(bundle.env_means, np.mean(np.vstack((bundle.env_in, bundle.env_out)),axis=0))
+        
+        path = os.path.join(self.dirname, 'fakeus.hdf5')
+        write_bundle(bundle, path)
+        loaded = load_bundle(path)
+        assert_equal(loaded.species, bundle.species)
+        assert_equal(loaded.env_variables, bundle.env_variables)
+        assert_equal(loaded.n_inducing, 50)
+        for name in SpeciesBundle.arrays:
+            assert_equal(getattr(loaded, name), getattr(bundle, name))
+            
+        empty = SpeciesBundle((3, 'Anopheles fakeus'), ['a','b'], 50, pts_in, pts_out, np.zeros(1,dtype=int), np.empty((0,2)),
+                                np.zeros(0,dtype=int), np.zeros(0,dtype=int), np.zeros(0,dtype=int),
+                                bundle.env_in, bundle.env_out, np.empty((0,2)))
+        write_bundle(empty, path)
+        loaded = load_bundle(path)
+        assert_equal(loaded.x.shape, (0,2))
+        assert_equal(loaded.env_x.shape, (0,2))
+
+    def test_snapshot(self):
+        "Tests that bundles can be kept in a group of another file, as in trace files."
+        bundle = fake_bundle()
+        hf = tb.openFile(os.path.join(self.dirname, 'trace.hdf5'), 'w')
+        hf.createVLArray('/', 'metadata', atom=tb.ObjectAtom()).append({'species': bundle.species})
+        hf.createGroup('/', 'bundle')
+        write_bundle(bundle, hf, '/bundle')
+        hf.close()
+        hf = tb.openFile(os.path.join(self.dirname, 'trace.hdf5'))
+        loaded = load_bundle(hf, '/bundle')
+        hf.close()
+        for name in SpeciesBundle.arrays:
+            assert_equal(getattr(loaded, name), getattr(bundle, name))
+
+    def test_select(self):
+        "Tests that models can ask for a subset of a bundle's covariates."
+        bundle = fake_bundle()
+        assert(as_bundle(bundle, env_variables=['a','b','c']) is bundle)
+        assert(as_bundle(bundle, n_inducing=50) is bundle)
+        none = as_bundle(bundle, env_variables=[], n_inducing=50)
+        assert_equal(none.env_variables, [])
+        assert_equal(none.env_x.shape, (len(bundle.x), 0))
+        sub = as_bundle(bundle, bundle.species, ['c','a'], 50)
+        assert_equal(sub.env_x, bundle.env_x[:,[2,0]])
+        assert_equal(sub.env_means, bundle.env_means[[2,0]])
+        assert_raises(ValueError, as_bundle, bundle, None, ['d'], 50)
+        assert_raises(ValueError, as_bundle, bundle, (4, 'Anopheles otherus'), ['a'], 50)
+
+    def test_model(self):
+        "Tests that a model can be made from a bundle file without a database."
+        path = os.path.join(self.dirname, 'fakeus.hdf5')
+        write_bundle(fake_bundle(), path)
+        model = make_model(path, None, lr_spatial_env, env_variables=['a','b'], n_inducing=50)
+        assert_equal(model['species'], (3, 'Anopheles fakeus'))
+        assert_equal(model['full_x_eo'].shape, (50,4))
+
+    def test_rank(self):
+        "Tests that a reduced-rank model keeps the same inducing points every time it is built."
+        path = os.path.join(self.dirname, 'fakeus.hdf5')
+        write_bundle(fake_bundle(), path)
+        m1 = make_model(path, None, lr_spatial_env, env_variables=['a','b'], n_inducing=50, rl=20)
+        m2 = make_model(path, None, lr_spatial_env, env_variables=['a','b'], n_inducing=50, rl=20)
+        assert_equal(len(m1['x_fr']), 20)
+        assert_equal(m1['pivots'], m2['pivots'])
+        assert_equal(m1['x_fr'], m2['x_fr'])
+        m3 = make_model(path, None, lr_spatial_env, env_variables=['a','b'], n_inducing=50, pivots=m1['pivots'][::2])
+        assert_equal(m3['x_fr'], m1['x_fr'][::2])
+
+if __name__ == '__main__':
+    nose.runmodule()
@@ -0,0 +1,60 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import os, shutil, tempfile
+from anopheles import CacheStore
+
+class test_cache_store(object):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dirname)
+
+    def test_roundtrip(self):
+        "Tests that arrays and other objects come back as they went in, and that hits and misses are counted."
+        cs = CacheStore(self.dirname)
+        assert(cs.get(('eval', 'layer', 'abc')) is None)
+        cs.put(('eval', 'layer', 'abc'), {'eval': np.arange(10.), 'empty': np.empty((0,2)), 'flag': True})
+        out = cs.get(('eval', 'layer', 'abc'))
+        assert_equal(out['eval'], np.arange(10.))
+        assert_equal(out['empty'].shape, (0,2))
+        assert_equal(out['flag'], True)
+        assert_equal((cs.stats()['hits'], cs.stats()['misses']), (1, 1))
+
+        # A second store in the same directory sees the entry through the index.
+        assert_equal(CacheStore(self.dirname).get(('eval', 'layer', 'abc'))['eval'], np.arange(10.))
+
+        # No temporary files are left behind.
+        assert_equal(sorted(os.listdir(self.dirname)), sorted(['INDEX', cs.key_hash(('eval', 'layer', 'abc'))+'.hdf5']))
+
+    def test_eviction(self):
+        "Tests that the least recently used entries are evicted when the store exceeds its budget."
+        cs = CacheStore(self.dirname)
+        cs.put(('a',), {'x': np.zeros(10000)})
+        cs.max_bytes = int(cs.nbytes()*2.5)
+        cs.put(('b',), {'x': np.zeros(10000)})
+        cs.get(('a',))
+        cs.put(('c',), {'x': np.zeros(10000)})
+        assert(('a',) in cs)
+        assert(('b',) not in cs)
+        assert(('c',) in cs)
+        assert(cs.nbytes() <= cs.max_bytes)
+
+    def test_open_entries(self):
+        "Tests that entries open for reading are not evicted until they are closed."
+        cs = CacheStore(self.dirname)
+        cs.put(('a',), {'x': np.arange(10000.)})
+        cs.max_bytes = int(cs.nbytes()*1.5)
+        hf = cs.open(('a',))
+        cs.put(('b',), {'x': np.zeros(10000)})
+        assert(('a',) in cs)
+        assert_equal(hf.root.x[:], np.arange(10000.))
+        hf.close()
+        cs.put(('c',), {'x': np.zeros(10000)})
+        assert(('a',) not in cs)
+        assert(cs.nbytes() <= cs.max_bytes)
+
+if __name__ == '__main__':
+    nose.runmodule()
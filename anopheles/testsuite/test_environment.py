@@ -1,11 +1,14 @@
 import numpy as np
 from numpy.testing import *
 import nose,  warnings
-from anopheles import extract_environment
+from anopheles import extract_environment, extract_environment_many, extraction_stats, reset_extraction_stats, set_extraction_workers
 import os
 import anopheles
 from map_utils import grid_convert, reconcile_multiple_rasters
 import tables as tb
+import shutil, tempfile
+from anopheles import CacheStore, cache_store, set_cache_store, raster_store
+from anopheles.env_data import point_keys, point_values_key
 data_dirname = os.path.join(anopheles.__path__[0] ,'../datafiles')
 
 def rotate(s,e,t):
@@ -20,6 +23,8 @@ def f(s, e, t=0, sc=1):
     return out
 
 def write_datafile(x,y,t=0,sc=1,view='x+y+'):
+    # Earlier tests may have left the file open in the raster store's pool.
+    raster_store().invalidate('test_extraction_%s'%view)
     hf = tb.openFile(os.path.join(data_dirname, 'test_extraction_%s.hdf5'%view),'w')
     hf.createArray('/','lon',x*180./np.pi)
     hf.createArray('/','lat',y*180./np.pi)
@@ -62,6 +67,102 @@ class test_environment(object):
                     assert_almost_equal(e1,e2,decimal=3)
 
 
+    def test_many(self):
+        "Tests that batched extraction agrees with layer-by-layer extraction."
+        names = []
+        for view in ['x+y+','y-x+','x-y+']:
+            fname, hf = write_datafile(x,y,t=.3,view=view)
+            hf.close()
+            names.append(fname)
+        
+        pts = np.vstack((np.random.uniform(-2,2,size=n), np.random.uniform(-1,1,size=n))).T*180./np.pi
+        e_many = extract_environment_many(names, pts, cache=False)
+        assert_equal(e_many.shape, (n, len(names)))
+        for i, fname in enumerate(names):
+            assert_almost_equal(e_many[:,i], extract_environment(fname, pts, cache=False))
+        # All the views describe the same surface.
+        assert_almost_equal(e_many[:,0], e_many[:,1])
+        assert_almost_equal(e_many[:,0], e_many[:,2])
+
+    def test_incremental(self):
+        "Tests that the per-point cache answers partial hits and only extracts new locations."
+        fname, hf = write_datafile(x,y,view='x+y+')
+        hf.close()
+        dirname = tempfile.mkdtemp()
+        old_store = cache_store()
+        set_cache_store(CacheStore(dirname))
+        try:
+            pts = np.vstack((np.random.uniform(-2,2,size=n), np.random.uniform(-1,1,size=n))).T*180./np.pi
+            e1 = extract_environment(fname, pts)
+            entry = cache_store().get(point_values_key(fname))
+            assert_equal(entry['keys'], np.unique(point_keys(pts)))
+            
+            new_pts = np.vstack((pts, [[0.,0.]]))
+            e2 = extract_environment(fname, new_pts)
+            assert_equal(e2[:-1], e1)
+            assert_almost_equal(e2[-1], extract_environment(fname, new_pts[-1:], cache=False)[0])
+            assert_equal(len(cache_store().get(point_values_key(fname))['keys']), len(entry['keys'])+1)
+        finally:
+            set_cache_store(old_store)
+            shutil.rmtree(dirname)
+
+    def test_version(self):
+        "Tests that cached point values aren't used once the layer changes."
+        fname, hf = write_datafile(x,y,view='x+y+')
+        hf.close()
+        dirname = tempfile.mkdtemp()
+        old_store = cache_store()
+        set_cache_store(CacheStore(dirname))
+        try:
+            pts = np.vstack((np.random.uniform(-2,2,size=n), np.random.uniform(-1,1,size=n))).T*180./np.pi
+            e1 = extract_environment(fname, pts)
+            fname, hf = write_datafile(x,y,t=.5,view='x+y+')
+            hf.close()
+            path = os.path.join(data_dirname, fname+'.hdf5')
+            os.utime(path, (os.path.getatime(path), os.path.getmtime(path)+10))
+            e2 = extract_environment(fname, pts)
+            assert_almost_equal(e2, extract_environment(fname, pts, cache=False))
+            assert(np.any(np.abs(e2-e1) > 1e-3))
+        finally:
+            set_cache_store(old_store)
+            shutil.rmtree(dirname)
+
+    def test_chunked(self):
+        "Tests that chunk-ordered reads agree with the other read modes and read each chunk once."
+        fname, hf = write_datafile(x,y,view='y-x+')
+        hf.close()
+        pts = np.vstack((np.random.uniform(-2,2,size=n), np.random.uniform(-1,1,size=n))).T*180./np.pi
+        
+        e_points = extract_environment_many([fname], pts, cache=False, mode='points')
+        e_box = extract_environment_many([fname], pts, cache=False, mode='box')
+        reset_extraction_stats()
+        e_chunks = extract_environment_many([fname], pts, cache=False, mode='chunks')
+        assert_equal(e_chunks, e_points)
+        assert_equal(e_chunks, e_box)
+        
+        # The datafile has 10x10 chunks, and n is large enough to touch them all.
+        assert(extraction_stats()['chunk'] <= 100)
+
+    def test_parallel(self):
+        "Tests that extraction over process and thread pools agrees with serial extraction."
+        names = []
+        for t in [0, .3, .6]:
+            fname, hf = write_datafile(x,y,t=t,view='x+y+')
+            hf.close()
+            # Give each layer its own file.
+            new_fname = fname+'_%i'%(t*10)
+            os.rename(os.path.join(data_dirname, fname+'.hdf5'), os.path.join(data_dirname, new_fname+'.hdf5'))
+            names.append(new_fname)
+        pts = np.vstack((np.random.uniform(-2,2,size=n), np.random.uniform(-1,1,size=n))).T*180./np.pi
+        
+        e_serial = extract_environment_many(names, pts, cache=False)
+        try:
+            for kind in ['process', 'thread']:
+                set_extraction_workers(3, kind)
+                assert_equal(extract_environment_many(names, pts, cache=False), e_serial)
+        finally:
+            set_extraction_workers(1)
+
     def test_reconciliation(self):
         "Tests that reconciling multiple rasters works correctly for multiple views."
         lims = {}
@@ -0,0 +1,81 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import shutil, tempfile
+from shapely.geometry import Polygon, Point
+from anopheles import triangulate, spherical_areas, triangulation, sample_triangles, region_geometries, \
+    CacheStore, cache_store, set_cache_store
+
+class test_eo_sampling(object):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.old_store = cache_store()
+        set_cache_store(CacheStore(self.dirname))
+
+    def tearDown(self):
+        set_cache_store(self.old_store)
+        shutil.rmtree(self.dirname)
+
+    def test_triangulate(self):
+        "Tests that the triangles of a concave polygon with a hole cover it exactly."
+        poly = Polygon([(0,0),(10,0),(10,10),(5,3),(0,10)], [[(2,1),(3,1),(3,2),(2,2)]])
+        tris = triangulate(poly)
+        assert_almost_equal(sum([Polygon(t).area for t in tris]), poly.area)
+        for t in tris:
+            assert(poly.contains(Polygon(t).centroid))
+
+    def test_areas(self):
+        "Tests areas on the sphere of triangles with straight edges in lon/lat."
+        # The integral of cos(lat)*(pi/2-lat) from 0 to pi/2.
+        assert_almost_equal(spherical_areas(np.array([[[0,0],[90,0],[0,90]]],dtype=float)), [1.])
+        # A band of longitude between two latitudes, including a nearly flat one.
+        band = np.array([[[0,10],[20,10],[20,30]], [[0,10],[20,30],[0,30]]], dtype=float)
+        assert_almost_equal(spherical_areas(band).sum(), np.pi/9*(np.sin(np.pi/6)-np.sin(np.pi/18)))
+        thin = np.array([[[0,10],[20,10],[20,10.01]], [[0,10],[20,10.01],[0,10.01]]], dtype=float)
+        assert_almost_equal(spherical_areas(thin).sum()/(np.pi/9*(np.sin(10.01*np.pi/180)-np.sin(np.pi/18))), 1.)
+
+    def test_uniform(self):
+        "Tests that points are spread uniformly over the sphere rather than the lon/lat plane."
+        tri = triangulation(Polygon([(0,0),(90,0),(0,90)]))
+        lon, lat = sample_triangles(tri, 100000)
+        assert_equal(len(lon), 100000)
+        assert_almost_equal((lat>30).mean(), np.sqrt(3)/2-np.pi/6, decimal=2)
+        assert_almost_equal((lon<45).mean(), np.sqrt(2)/2, decimal=2)
+
+    def test_inside(self):
+        "Tests that every sampled point lies in the region."
+        poly = Polygon([(-20,-60),(40,-60),(40,70),(10,0),(-20,70)], [[(0,-40),(20,-40),(20,-20),(0,-20)]])
+        lon, lat = sample_triangles(triangulation(poly), 10000)
+        inside = poly.buffer(1e-9)
+        assert(np.all([inside.contains(Point(x,y)) for x,y in zip(lon, lat)]))
+
+    def test_persisted(self):
+        "Tests that triangulations are only computed once."
+        calls = []
+        def geom():
+            calls.append(1)
+            return Polygon([(0,0),(10,0),(0,10)])
+        triangulation(geom, key=('triangulation','test'))
+        tri = triangulation(geom, key=('triangulation','test'))
+        assert_equal(len(calls), 1)
+        assert_almost_equal(tri['areas'].sum(), spherical_areas(np.array([[[0,0],[10,0],[0,10]]],dtype=float)))
+
+    def test_regions(self):
+        "Tests that complements are computed once and reused from their WKB."
+        calls = []
+        def world():
+            calls.append(1)
+            return Polygon([(0,0),(10,0),(10,10),(0,10)]).wkb
+        eo = Polygon([(0,0),(5,0),(5,5),(0,5)])
+        regions = region_geometries(eo.wkb, world)
+        regions = region_geometries(eo.wkb, world)
+        assert_equal(len(calls), 1)
+        assert_almost_equal(regions['complement'].geom.area, 75)
+        assert_almost_equal(regions['region_display'].geom.area, 25)
+        assert_equal(regions['region'].contains([1,6],[1,6]), [True, False])
+        lon, lat = sample_triangles(regions['complement'].triangulation(), 500)
+        assert(not np.any(regions['region'].contains(lon, lat)))
+
+if __name__ == '__main__':
+    nose.runmodule()
@@ -0,0 +1,111 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import pymc as pm
+from anopheles.factor_cache import FactorCache, covariance_key, distance_cache, without_distance_cache
+from anopheles.mahalanobis_covariance import *
+
+def sqexp(x, y, amp, scale):
+    d = ((x[:,np.newaxis,:]-y[np.newaxis,:,:])**2).sum(axis=-1)
+    return amp**2*np.exp(-d/scale**2)
+
+class CountingCovariance(object):
+    "Stands in for a PyMC covariance, counting the factorizations made."
+    eval_fun = staticmethod(sqexp)
+    factorizations = 0
+    def __init__(self, **params):
+        self.params = params
+    def __call__(self, x, y):
+        return sqexp(x, y, **self.params)
+    def cholesky(self, x):
+        CountingCovariance.factorizations += 1
+        return np.linalg.cholesky(self(x,x) + 1e-8*np.eye(len(x))).T
+
+class test_factor_cache(object):
+    def setUp(self):
+        CountingCovariance.factorizations = 0
+        self.x = np.random.normal(size=(50,2))
+        
+    def test_revisit(self):
+        "Tests that revisited hyperparameters reuse their factors."
+        cache = FactorCache(maxsize=4)
+        for scale in [1., 2., 1., 2., 1.]:
+            U = cache.cholesky(CountingCovariance(amp=1., scale=scale), self.x)
+            assert_almost_equal(np.dot(U.T,U), sqexp(self.x, self.x, 1., scale), 6)
+        assert_equal(CountingCovariance.factorizations, 2)
+        assert_equal(cache.stats()['hits'], 3)
+        assert_equal(cache.stats()['misses'], 2)
+        
+    def test_keys(self):
+        "Tests that covariances only share keys when their parameters are exactly equal."
+        C1 = CountingCovariance(amp=1., scale=np.array([1.,2.]))
+        C2 = CountingCovariance(amp=1., scale=np.array([1.,2.]))
+        C3 = CountingCovariance(amp=1., scale=np.array([1.,2.+1e-12]))
+        assert_equal(covariance_key(C1), covariance_key(C2))
+        assert(covariance_key(C1) != covariance_key(C3))
+        
+    def test_eviction(self):
+        "Tests that the least recently used factors are dropped first."
+        cache = FactorCache(maxsize=2)
+        for scale in [1., 2., 1., 3., 1., 2.]:
+            cache.cholesky(CountingCovariance(amp=1., scale=scale), self.x)
+        assert_equal(CountingCovariance.factorizations, 4)
+        assert_equal(cache.stats()['evictions'], 2)
+        assert_equal(cache.stats()['entries'], 2)
+        
+    def test_offdiag(self):
+        "Tests that off-diagonal blocks are shared between calls with the same state."
+        cache = FactorCache()
+        C = CountingCovariance(amp=1., scale=1.)
+        xp = np.random.normal(size=(20,2))
+        calls = []
+        def compute():
+            calls.append(1)
+            return np.linalg.solve(cache.cholesky(C, self.x).T, C(self.x,xp)).T
+        od1 = cache.offdiag(C, self.x, xp, compute)
+        od2 = cache.offdiag(CountingCovariance(amp=1., scale=1.), self.x, xp.copy(), compute)
+        assert(od1 is od2)
+        assert_equal(len(calls), 1)
+        assert_equal(CountingCovariance.factorizations, 1)
+        
+class test_distance_cache(object):
+    def setUp(self):
+        distance_cache().clear()
+        self.x = np.random.normal(size=(40,5))*[1,.5,1,1,1]
+        self.y = np.random.normal(size=(30,5))*[1,.5,1,1,1]
+        
+    def test_geo_rad(self):
+        "Tests that the cached spatial component matches pm.gp.matern.geo_rad."
+        for dd in [.5, 1.5, 2.2]:
+            C = np.asarray(pm.gp.matern.geo_rad(self.x[:,:2], self.y[:,:2], amp=.7, scale=.3, diff_degree=dd))
+            assert_almost_equal(geo_rad_component(self.x[:,:2], self.y[:,:2], dd, .7, .3), C, 8)
+            
+    def test_mahalanobis(self):
+        "Tests that the cached environmental component matches mahalanobis_covariance."
+        val = np.array([.5,1.,2.])
+        C = np.asarray(mahalanobis_covariance(self.x[:,2:], self.y[:,2:], 1.5, .7, val, np.eye(3)))
+        assert_almost_equal(mahalanobis_component(self.x[:,2:], self.y[:,2:], 1.5, .7, val, np.eye(3)), C, 8)
+        
+    def test_components(self):
+        "Tests that changing one component's parameters doesn't recompute the other's distances."
+        geo_rad_component(self.x[:,:2], self.y[:,:2], 1.5, 1., .3)
+        mahalanobis_component(self.x[:,2:], self.y[:,2:], 1.5, 1., np.ones(3), np.eye(3))
+        misses = distance_cache().stats()['misses']
+        geo_rad_component(self.x[:,:2], self.y[:,:2], 1.5, 1., .4)
+        mahalanobis_component(self.x[:,2:], self.y[:,2:], 1.5, 1., np.ones(3), np.eye(3))
+        # Only the new spatial component is computed; its distances are reused.
+        assert_equal(distance_cache().stats()['misses'], misses+1)
+
+    def test_uncached(self):
+        "Tests that covariances evaluated without the distance cache match and leave it untouched."
+        C = mahalanobis_component(self.x[:,2:], self.y[:,2:], 1.5, 1., np.ones(3), np.eye(3))
+        stats = distance_cache().stats()
+        for z in [self.y, self.y[:7]]:
+            assert_almost_equal(without_distance_cache(geo_rad_component, self.x[:,:2], z[:,:2], 1.5, 1., .3),
+                                np.asarray(pm.gp.matern.geo_rad(self.x[:,:2], z[:,:2], amp=1., scale=.3, diff_degree=1.5)), 8)
+        assert_almost_equal(without_distance_cache(mahalanobis_component, self.x[:,2:], self.y[:,2:], 1.5, 1., np.ones(3), np.eye(3)), C)
+        assert_equal(distance_cache().stats(), stats)
+        assert(distance_cache().enabled)
+
+if __name__ == '__main__':
+    nose.runmodule()
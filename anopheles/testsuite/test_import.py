@@ -0,0 +1,35 @@
+from numpy.testing import *
+import nose,  warnings
+import os, sys, subprocess
+
+# Modules that sampling-only use of the package shouldn't load.
+heavy = ['pylab', 'matplotlib', 'mpl_toolkits.basemap', 'anopheles_query', 'sqlalchemy', 'map_utils']
+
+# Seconds. Generous, so that slow file systems don't make the test flaky.
+import_budget = float(os.environ.get('ANOPHELES_IMPORT_BUDGET', 10))
+
+script = """
+import sys, time
+t = time.time()
+import anopheles
+print time.time() - t
+print ' '.join([m for m in %r if m in sys.modules])
+"""%heavy
+
+class test_import(object):
+    def test_headless(self):
+        "Tests that the package imports quickly without a display, and without plotting or database modules."
+        env = dict(os.environ)
+        env.pop('DISPLAY', None)
+        p = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+        out, err = p.communicate()
+        assert_equal(p.returncode, 0, err)
+        lines = out.strip().split('\n')
+        elapsed = float(lines[-2])
+        loaded = lines[-1].split()
+        print 'Importing anopheles took %f seconds.'%elapsed
+        assert_equal(loaded, [])
+        assert(elapsed < import_budget)
+
+if __name__ == '__main__':
+    nose.runmodule()
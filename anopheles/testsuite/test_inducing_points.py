@@ -0,0 +1,54 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+from anopheles.inducing_points import *
+
+class SquaredExponential(object):
+    "Stands in for a PyMC covariance; C(x) is the diagonal."
+    def __init__(self, scale):
+        self.scale = scale
+    def __call__(self, x, y=None):
+        if y is None:
+            return np.ones(len(x))
+        return np.exp(-((x[:,np.newaxis,:]-y[np.newaxis,:,:])**2).sum(axis=-1)/self.scale**2)
+
+def achieved_error(C, x, pivots):
+    K = C(x,x)
+    Kp = K[:,pivots]
+    return (np.diag(K) - (Kp*np.linalg.solve(K[np.ix_(pivots,pivots)], Kp.T).T).sum(axis=1)).max()
+
+class test_inducing_points(object):
+    def setUp(self):
+        self.x = np.random.uniform(-2, 2, size=(400,2))
+        self.C = SquaredExponential(1.)
+        
+    def test_target_error(self):
+        "Tests that the selection reaches the target error and reports it correctly."
+        pivots, error = select_inducing_points(self.C, self.x, target_error=1e-3)
+        assert(error <= 1e-3)
+        assert(len(pivots) < len(self.x))
+        assert_almost_equal(achieved_error(self.C, self.x, pivots), error, 6)
+        
+    def test_errors_decrease(self):
+        "Tests that the error falls as points are added."
+        pivots, errors = variance_reduction(self.C, self.x, 50)
+        assert(np.all(np.diff(errors) <= 1e-12))
+        
+    def test_growth(self):
+        "Tests that the factor grows past its first block without changing the selection."
+        C = SquaredExponential(.3)
+        pivots, errors = variance_reduction(C, self.x, 150)
+        assert_equal(len(pivots), 150)
+        assert_equal(pivots[:50], variance_reduction(C, self.x, 50)[0])
+        assert_almost_equal(achieved_error(C, self.x, pivots), errors[-1], 6)
+        
+    def test_memory_budget(self):
+        "Tests that the selection fits in a memory budget."
+        max_bytes = 8*(30**2 + 400*30)
+        assert_equal(rank_for_bytes(max_bytes, 400), 30)
+        pivots, error = select_inducing_points(self.C, self.x, target_error=1e-8, max_bytes=max_bytes)
+        assert_equal(len(pivots), 30)
+        assert(error > 1e-8)
+        
+if __name__ == '__main__':
+    nose.runmodule()
@@ -0,0 +1,122 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import tables as tb
+import os, shutil, tempfile
+from anopheles import CoveringRaster, subset_x, make_covering_raster, RasterStore, LocalDirectoryBackend, \
+    raster_store, set_raster_store, CacheStore, cache_store, set_cache_store
+
+lon = np.linspace(-30,30,70)*np.pi/180.
+lat = np.linspace(-20,20,50)*np.pi/180.
+
+class test_covering_raster(object):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.hf = tb.openFile(os.path.join(self.dirname, 'layers.hdf5'), 'w')
+        self.layers = []
+        for i in xrange(3):
+            l = self.hf.createCArray('/', 'layer_%i'%i, atom=tb.FloatAtom(), shape=(len(lon),len(lat)), chunkshape=(8,8))
+            l[:] = np.random.normal(size=(len(lon),len(lat)))
+            self.layers.append(l)
+        lat_grid, lon_grid = np.meshgrid(lat, lon)
+        self.dense = np.dstack([lon_grid, lat_grid]+[l[:] for l in self.layers])
+        self.x = CoveringRaster(lon, lat, self.layers, hf=self.hf)
+
+    def tearDown(self):
+        self.x.close()
+        shutil.rmtree(self.dirname)
+
+    def test_indexing(self):
+        assert_equal(self.x.shape, self.dense.shape)
+        for index in [(slice(None),), (3,), (5,7), (slice(2,40,3),slice(None),2), (-1,slice(10,20),slice(1,4))]:
+            assert_almost_equal(self.x[index], self.dense[index])
+
+    def test_tiles(self):
+        out = np.empty(self.dense.shape)
+        for lon_slice, lat_slice, block in self.x.tiles((16,16)):
+            assert(block.shape[0] <= 16 and block.shape[1] <= 16)
+            out[lon_slice, lat_slice] = block
+        assert_almost_equal(out, self.dense)
+
+    def test_subset(self):
+        mask = np.ones(self.dense.shape[:2], dtype=bool)
+        img_extent = [-30,-20,30,20]
+        new_extent = (-10,-5,20,15)
+        m1, x1, e1 = subset_x(mask, self.x, img_extent, new_extent)
+        m2, x2, e2 = subset_x(mask, self.dense, img_extent, new_extent)
+        assert(isinstance(x1, CoveringRaster))
+        assert_equal(m1.shape, m2.shape)
+        assert_almost_equal(x1[:], x2)
+        assert_almost_equal(e1, e2)
+        assert_almost_equal(x1.subset(slice(2,5),slice(1,3))[:], x2[2:5,1:3])
+
+land_water = 'MODIS-hdf5/raw-data.land-water.geographic.world.version-4'
+
+def write_layer(root, name, layer_lon, layer_lat, view):
+    "Writes a layer whose value at each node is lon + 100*lat."
+    path = os.path.join(root, name+'.hdf5')
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    lat_grid, lon_grid = np.meshgrid(layer_lat, layer_lon)
+    data = lon_grid + 100*lat_grid
+    if view == 'y-x+':
+        data = data.T[::-1]
+    hf = tb.openFile(path, 'w')
+    hf.createArray('/','lon',layer_lon)
+    hf.createArray('/','lat',layer_lat)
+    hf.createCArray('/','data',shape=data.shape,chunkshape=(8,8),atom=tb.FloatAtom())
+    hf.root.data[:] = data
+    hf.root.data.attrs.view = view
+    hf.close()
+
+class test_make_covering_raster(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_store = raster_store()
+        self.old_cache = cache_store()
+        set_raster_store(RasterStore(self.root, LocalDirectoryBackend(self.root), offline=True))
+        set_cache_store(CacheStore(os.path.join(self.root, 'caches')))
+        # The land-water layer is the coarser one, and the other layer covers more ground.
+        self.lon = np.linspace(-30,30,61)
+        self.lat = np.linspace(-20,20,41)
+        write_layer(self.root, land_water, self.lon, self.lat, 'y-x+')
+        write_layer(self.root, 'fine', np.linspace(-40,40,161), np.linspace(-20,30,101), 'x+y+')
+
+    def tearDown(self):
+        set_raster_store(self.old_store)
+        set_cache_store(self.old_cache)
+        shutil.rmtree(self.root)
+
+    def test_reconcile(self):
+        "Tests that layers on different grids are reconciled onto the coarser one, a tile at a time."
+        mask, x, img_extent = make_covering_raster(1, ['fine'], tile_shape=(16,16))
+        try:
+            assert(isinstance(x, CoveringRaster))
+            assert_equal(x.shape, (61,41,3))
+            assert_equal(img_extent, [-30,-20,30,20])
+            lat_grid, lon_grid = np.meshgrid(self.lat, self.lon)
+            assert_almost_equal(x[:,:,2], lon_grid + 100*lat_grid)
+        finally:
+            x.close()
+
+    def test_thin_cached(self):
+        "Tests that thinning a cached covering raster gives the raster reconciled at the coarser thinning."
+        mask, x, img_extent = make_covering_raster(3, ['fine'], tile_shape=(16,16))
+        x.close()
+        mask_1, x_1, img_extent_1 = make_covering_raster(9, ['fine'], tile_shape=(16,16))
+
+        set_cache_store(CacheStore(os.path.join(self.root, 'fresh-caches')))
+        mask_2, x_2, img_extent_2 = make_covering_raster(9, ['fine'], tile_shape=(16,16))
+        try:
+            assert_equal(mask_1, mask_2)
+            assert_equal(img_extent_1, img_extent_2)
+            assert_almost_equal(x_1[:], x_2[:])
+            assert_almost_equal(x_2[:,:,0]*180./np.pi, self.lon[::9][:,np.newaxis]*np.ones(x_2.shape[1]))
+        finally:
+            x_1.close()
+            x_2.close()
+
+if __name__ == '__main__':
+    nose.runmodule()
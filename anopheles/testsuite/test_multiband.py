@@ -0,0 +1,93 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import tables as tb
+import os, shutil, tempfile
+from anopheles import RasterStore, LocalDirectoryBackend, raster_store, set_raster_store, pack_layers, find_stack, \
+    extract_environment_many, extraction_stats, reset_extraction_stats, CacheStore, cache_store, set_cache_store
+from anopheles.env_data import point_values_key
+
+lon = np.linspace(-30,30,120)
+lat = np.linspace(-20,20,80)
+
+def write_layer(root, name, data, view='y-x+'):
+    hf = tb.openFile(os.path.join(root, name+'.hdf5'), 'w')
+    hf.createArray('/','lon',lon)
+    hf.createArray('/','lat',lat)
+    hf.createCArray('/','data',shape=data.shape,chunkshape=(10,10),atom=tb.FloatAtom())
+    hf.root.data[:] = data
+    hf.root.data.attrs.view = view
+    hf.close()
+
+class test_multiband(object):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.old_store = raster_store()
+        set_raster_store(RasterStore(self.root, LocalDirectoryBackend(self.root), offline=True))
+        self.names = []
+        for i in xrange(3):
+            write_layer(self.root, 'layer_%i'%i, np.random.normal(size=(len(lat),len(lon))))
+            self.names.append('layer_%i'%i)
+
+    def tearDown(self):
+        set_raster_store(self.old_store)
+        shutil.rmtree(self.root)
+
+    def test_stack(self):
+        "Tests that extraction from a stack agrees with extraction from the separate layers, with fewer reads."
+        pts = np.vstack((np.random.uniform(-30,30,size=500), np.random.uniform(-20,20,size=500))).T
+        e_separate = extract_environment_many(self.names, pts, cache=False, mode='chunks')
+
+        stack = pack_layers(self.names, 'test', chunk=(10,10))
+        assert_equal(find_stack(self.names), stack)
+        assert_equal(find_stack(self.names[1:]), stack)
+        assert(find_stack(self.names + ['elsewhere']) is None)
+
+        reset_extraction_stats()
+        e_stack = extract_environment_many(self.names, pts, cache=False, mode='chunks')
+        assert_almost_equal(e_stack, e_separate)
+        # One pass over the chunks for all three bands.
+        assert(extraction_stats()['chunk'] <= 8*12)
+
+    def test_stale(self):
+        "Tests that a stack isn't used once one of its source layers changes."
+        stack = pack_layers(self.names, 'test', chunk=(10,10))
+        assert_equal(find_stack(self.names), stack)
+        
+        # Fetching unchanged copies of the layers gives them new versions, but
+        # the checksums the store records match the stack's.
+        server = os.path.join(self.root, 'server')
+        os.makedirs(server)
+        for n in self.names:
+            shutil.copy(os.path.join(self.root, n+'.hdf5'), server)
+        set_raster_store(RasterStore(self.root, LocalDirectoryBackend(server)))
+        assert_equal(find_stack(self.names), stack)
+        
+        write_layer(server, 'layer_1', np.zeros((len(lat),len(lon))))
+        set_raster_store(RasterStore(self.root, LocalDirectoryBackend(server)))
+        assert(find_stack(self.names) is None)
+        assert_equal(find_stack(self.names[2:]), stack)
+        pts = np.vstack((np.random.uniform(-30,30,size=50), np.random.uniform(-20,20,size=50))).T
+        assert_almost_equal(extract_environment_many(self.names[1:2], pts, cache=False), 0)
+
+    def test_stack_only(self):
+        "Tests that layers that only exist as bands of a stack are extracted and cached."
+        pts = np.vstack((np.random.uniform(-30,30,size=50), np.random.uniform(-20,20,size=50))).T
+        e = extract_environment_many(self.names[2:], pts, cache=False)
+        pack_layers(self.names, 'test', chunk=(10,10))
+        os.remove(os.path.join(self.root, 'layer_2.hdf5'))
+        dirname = tempfile.mkdtemp()
+        old_store = cache_store()
+        set_cache_store(CacheStore(dirname))
+        try:
+            assert_almost_equal(extract_environment_many(self.names[2:], pts), e)
+            assert_equal(point_values_key('layer_2')[2][0], 'stack')
+            assert_equal(cache_store().get(point_values_key('layer_2'))['values'].size, 50)
+            assert_almost_equal(extract_environment_many(self.names[2:], pts), e)
+        finally:
+            set_cache_store(old_store)
+            shutil.rmtree(dirname)
+
+if __name__ == '__main__':
+    nose.runmodule()
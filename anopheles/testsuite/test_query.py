@@ -1,6 +1,12 @@
 from numpy.testing import *
 import nose,  warnings
-from anopheles import species_query, list_species, Session
+import numpy as np
+import struct
+import shutil, tempfile
+from shapely.geometry import Polygon
+from anopheles import species_query, list_species, Session, wkb_points, site_columns, sites_as_ndarray, \
+    cached_species_query, forget_species_queries, CacheStore, cache_store, set_cache_store
+from anopheles import query_to_rec
 
 class test_queries(object):
     def test_checksums(self):
@@ -12,5 +18,115 @@ class test_queries(object):
     def some_other_test(self):
         pass
 
+def point_wkb(x, y, order='<'):
+    return struct.pack(order+'BIdd', order=='<', 1, x, y)
+
+def multipoint_wkb(pts, order='<'):
+    return struct.pack(order+'BII', order=='<', 4, len(pts)) + ''.join([point_wkb(x, y, order) for x, y in pts])
+
+class test_site_columns(object):
+    def test_wkb(self):
+        "Tests bulk decoding of points and multipoints in both byte orders."
+        blobs = [point_wkb(1.,2.), multipoint_wkb([(3.,4.),(5.,6.)], '>'), point_wkb(7.,8.,'>'), multipoint_wkb([(9.,10.)])]
+        coords, counts = wkb_points(blobs)
+        assert_equal(counts, [1,2,1,1])
+        assert_equal(coords, np.arange(1,11).reshape((5,2)))
+
+    def test_buffers(self):
+        "Tests that blobs returned by database drivers as buffers are decoded too."
+        blobs = [buffer(point_wkb(1.,2.)), buffer(multipoint_wkb([(3.,4.),(5.,6.)], '>'))]
+        coords, counts = wkb_points(blobs)
+        assert_equal(counts, [1,2])
+        assert_equal(coords, np.arange(1,7).reshape((3,2)))
+        
+    def test_columns(self):
+        "Tests that missing geometries are dropped and missing counts are zeros."
+        sites = [(point_wkb(1.,2.), 3, None, 1, 4), (None, 1, 1, 1, 3), (multipoint_wkb([(3.,4.),(5.,6.)]), None, 2, None, 2)]
+        x, counts, found, zero, others_found = site_columns(sites)
+        assert_almost_equal(x, np.array([[1,2],[3,4],[5,6]])*np.pi/180.)
+        assert_equal(counts, [1,2])
+        assert_equal(found, [3,0])
+        assert_equal(zero, [0,2])
+        assert_equal(others_found, [1,0])
+
+class FakeSession(object):
+    "Stands in for a database session that only answers version queries."
+    def __init__(self, dialect=None):
+        self.version = (1,1,1,1)
+        self.checksums = ('a','b')
+        self.executed = 0
+        if dialect is not None:
+            self.bind = FakeBind(dialect)
+    def execute(self, sql, params):
+        self.executed += 1
+        if 'md5' in str(sql):
+            return FakeResult(self.checksums)
+        return FakeResult(self.version)
+
+class FakeBind(object):
+    def __init__(self, name):
+        self.dialect = self
+        self.name = name
+
+class FakeResult(object):
+    def __init__(self, row):
+        self.row = row
+    def fetchone(self):
+        return self.row
+
+class test_species_cache(object):
+
+    def setUp(self):
+        self.dirname = tempfile.mkdtemp()
+        self.old_store = cache_store()
+        set_cache_store(CacheStore(self.dirname))
+        self.old_query = query_to_rec.species_query
+        self.queries = 0
+        def species_query(session, species_id):
+            self.queries += 1
+            return [(point_wkb(1.,2.), 1, 0, 0, 1)], Polygon([(0,0),(0,1),(1,1),(0,0)])
+        query_to_rec.species_query = species_query
+        forget_species_queries()
+        
+    def tearDown(self):
+        query_to_rec.species_query = self.old_query
+        set_cache_store(self.old_store)
+        forget_species_queries()
+        shutil.rmtree(self.dirname)
+
+    def test_shared(self):
+        "Tests that the database is asked once per process and once per version."
+        session = FakeSession()
+        sites, eo = cached_species_query(session, 3)
+        breaks, x, found, zero, others_found, multipoints = sites_as_ndarray(session, (3, 'Anopheles fakeus'))
+        assert_equal(self.queries, 1)
+        assert_equal(session.executed, 1)
+        assert_equal(breaks, [0,1])
+        assert_almost_equal(eo.area, .5)
+        
+        # A new process with an unchanged database uses the cached results.
+        forget_species_queries()
+        cached_species_query(session, 3)
+        assert_equal(self.queries, 1)
+        
+        # A changed database invalidates them.
+        forget_species_queries()
+        session.version = (2,2,1,1)
+        cached_species_query(session, 3)
+        assert_equal(self.queries, 2)
+
+    def test_checksums(self):
+        "Tests that on PostgreSQL edits to existing rows invalidate the cached results."
+        session = FakeSession('postgresql')
+        cached_species_query(session, 3)
+        assert_equal(session.executed, 2)
+        forget_species_queries()
+        cached_species_query(session, 3)
+        assert_equal(self.queries, 1)
+        forget_species_queries()
+        session.checksums = ('a','c')
+        cached_species_query(session, 3)
+        assert_equal(self.queries, 2)
+
 if __name__ == '__main__':
     nose.runmodule()
@@ -0,0 +1,153 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import tables as tb
+import os, shutil, tempfile
+from anopheles import RasterStore, LocalDirectoryBackend, overview_level
+
+def write_layer(root, name, value):
+    path = os.path.join(root, name+'.hdf5')
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    hf = tb.openFile(path, 'w')
+    hf.createArray('/','lon',np.linspace(-1,1,3))
+    hf.createArray('/','lat',np.linspace(-1,1,3))
+    hf.createArray('/','mask',np.ones((3,3),dtype=bool))
+    hf.createArray('/','data',np.ones((3,3))*value)
+    hf.root.data.attrs.view = 'x+y+'
+    hf.close()
+
+class CountingBackend(LocalDirectoryBackend):
+    "Counts fetches, so the tests can tell when the store goes to the server."
+    def __init__(self, root):
+        LocalDirectoryBackend.__init__(self, root)
+        self.n_fetches = 0
+    def fetch(self, relpath, dest):
+        self.n_fetches += 1
+        return LocalDirectoryBackend.fetch(self, relpath, dest)
+
+class test_raster_store(object):
+
+    def setUp(self):
+        self.server = tempfile.mkdtemp()
+        self.local = tempfile.mkdtemp()
+        write_layer(self.server, 'MODIS-hdf5/layer', 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.server)
+        shutil.rmtree(self.local)
+
+    def test_sync_once(self):
+        "Tests that a layer is fetched once, and that the same handle is handed out afterward."
+        backend = CountingBackend(self.server)
+        store = RasterStore(self.local, backend)
+        hf1 = store.open('MODIS-hdf5/layer')
+        hf2 = store.open('MODIS-hdf5/layer')
+        assert(hf1 is hf2)
+        assert_equal(backend.n_fetches, 1)
+        assert_equal(hf1.root.data[:], np.ones((3,3)))
+        store.close_all()
+
+        # A fresh store reads the local manifest and sees that its copy is current.
+        store = RasterStore(self.local, backend)
+        store.open('MODIS-hdf5/layer')
+        assert_equal(backend.n_fetches, 1)
+        store.close_all()
+
+    def test_stale(self):
+        "Tests that a layer whose checksum has changed on the server is fetched again."
+        backend = CountingBackend(self.server)
+        store = RasterStore(self.local, backend)
+        store.open('MODIS-hdf5/layer')
+        store.close_all()
+
+        write_layer(self.server, 'MODIS-hdf5/layer', 2)
+        store = RasterStore(self.local, CountingBackend(self.server))
+        assert(store.is_stale('MODIS-hdf5/layer'))
+        assert_equal(store.open('MODIS-hdf5/layer').root.data[:], np.ones((3,3))*2)
+        store.close_all()
+
+    def test_offline(self):
+        "Tests that an offline store never contacts the backend."
+        backend = CountingBackend(self.server)
+        store = RasterStore(self.local, backend, offline=True)
+        assert_raises(IOError, store.open, 'MODIS-hdf5/layer')
+
+        write_layer(self.local, 'MODIS-hdf5/layer', 3)
+        assert_equal(store.open('MODIS-hdf5/layer').root.data[:], np.ones((3,3))*3)
+        assert_equal(backend.n_fetches, 0)
+        store.close_all()
+
+    def test_pool(self):
+        "Tests that the handle pool caches layer metadata and evicts the least recently used layer."
+        write_layer(self.server, 'MODIS-hdf5/other', 2)
+        store = RasterStore(self.local, LocalDirectoryBackend(self.server), max_open=1)
+
+        h1 = store.pool.get('MODIS-hdf5/layer')
+        assert_equal(h1.view, 'x+y+')
+        assert_equal(h1.lon, np.linspace(-1,1,3))
+        assert_equal(h1.mask, np.ones((3,3),dtype=bool))
+        assert(store.pool.get('MODIS-hdf5/layer') is h1)
+
+        h2 = store.pool.get('MODIS-hdf5/other')
+        assert(not h1.file.isopen)
+        assert(h2.file.isopen)
+        assert_equal(store.pool.handles.keys(), ['MODIS-hdf5/other'])
+        assert_equal((store.pool.hits, store.pool.misses), (1, 2))
+        store.close_all()
+
+    def test_invalidate(self):
+        "Tests that invalidating a layer closes its pooled handle so the file can be rewritten."
+        write_layer(self.local, 'layer', 1)
+        store = RasterStore(self.local, LocalDirectoryBackend(self.server), offline=True)
+        h = store.pool.get('layer')
+        assert_equal(h.data[:], np.ones((3,3)))
+
+        store.invalidate('layer')
+        assert(not h.file.isopen)
+        assert_equal(store.pool.handles.keys(), [])
+        write_layer(self.local, 'layer', 2)
+        assert_equal(store.pool.get('layer').data[:], 2*np.ones((3,3)))
+        store.close_all()
+
+    def test_overview(self):
+        "Tests that overviews thin the data array, are built once and are rebuilt when the layer changes."
+        path = os.path.join(self.server, 'big.hdf5')
+        hf = tb.openFile(path, 'w')
+        hf.createArray('/','lon',np.linspace(-10,10,37))
+        hf.createArray('/','lat',np.linspace(-5,5,23))
+        data = np.random.normal(size=(23,37))
+        hf.createCArray('/','data',shape=data.shape,chunkshape=(5,5),atom=tb.FloatAtom())
+        hf.root.data[:] = data
+        hf.root.data.attrs.view = 'y-x+'
+        hf.close()
+
+        store = RasterStore(self.local, LocalDirectoryBackend(self.server))
+        ov = store.overview('big', 4)
+        h = store.pool.get(ov)
+        assert_equal(h.data[:], data[::4,::4])
+        assert_equal(h.lon, np.linspace(-10,10,37)[::4])
+        assert_equal(h.lat, np.linspace(-5,5,23)[::-1][::4][::-1])
+        mtime = os.path.getmtime(store.path(ov))
+        store.overview('big', 4)
+        assert_equal(os.path.getmtime(store.path(ov)), mtime)
+        store.close_all()
+
+        # Change the layer on the server. A new store syncs it and rebuilds the overview.
+        hf = tb.openFile(path, 'a')
+        new_data = data + 1
+        hf.root.data[:] = new_data
+        hf.close()
+        store = RasterStore(self.local, LocalDirectoryBackend(self.server))
+        ov = store.overview('big', 4)
+        assert_equal(store.pool.get(ov).data[:], new_data[::4,::4])
+        assert_equal(store.pool.get(ov).data.attrs.source_version, store.version('big'))
+
+        for level in [0, 3, 6, 10]:
+            assert_raises(ValueError, store.overview, 'big', level)
+
+        assert_equal([overview_level(t) for t in [1,3,4,20,100,128,256]], [1,1,4,4,4,64,64])
+        store.close_all()
+
+if __name__ == '__main__':
+    nose.runmodule()
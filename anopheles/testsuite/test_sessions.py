@@ -0,0 +1,77 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import struct, threading
+import shutil, tempfile
+from shapely.geometry import Polygon
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+from anopheles import pooled_engine, prefetch_species, LazySession, forget_species_queries, \
+    CacheStore, cache_store, set_cache_store
+from anopheles import query_to_rec
+
+def point_wkb(x, y):
+    return struct.pack('<BIdd', 1, 1, x, y)
+
+class test_sessions(object):
+    
+    def setUp(self):
+        # An in-memory SQLite database stands in for PostGIS.
+        self.factory = sessionmaker(bind=pooled_engine('sqlite://'))
+        session = self.factory()
+        session.execute(text('create table vector_sampleperiod (id integer primary key, anopheline2_id integer)'))
+        session.execute(text('create table vector_expertopinion (id integer primary key, anopheline2_id integer)'))
+        for species_id in [1,2,3]:
+            session.execute(text('insert into vector_sampleperiod (anopheline2_id) values (:s)'), {'s': species_id})
+            session.execute(text('insert into vector_expertopinion (anopheline2_id) values (:s)'), {'s': species_id})
+        session.commit()
+        session.close()
+        
+        self.dirname = tempfile.mkdtemp()
+        self.old_store = cache_store()
+        set_cache_store(CacheStore(self.dirname))
+        self.old_query = query_to_rec.species_query
+        self.queries = []
+        self.threads = set()
+        def species_query(session, species_id):
+            self.queries.append(species_id)
+            self.threads.add(threading.currentThread().getName())
+            return [(point_wkb(species_id, 0.), 1, 0, 0, 1)], Polygon([(0,0),(0,species_id),(species_id,0),(0,0)])
+        query_to_rec.species_query = species_query
+        forget_species_queries()
+        
+    def tearDown(self):
+        query_to_rec.species_query = self.old_query
+        set_cache_store(self.old_store)
+        forget_species_queries()
+        shutil.rmtree(self.dirname)
+        
+    def test_prefetch(self):
+        "Tests that prefetched species come back in order, queried in the background."
+        species = [(1,'a'),(2,'b'),(3,'c')]
+        out = list(prefetch_species(species, self.factory))
+        assert_equal([o[0] for o in out], species)
+        for sp, sites, eo in out:
+            assert_almost_equal(eo.area, sp[0]**2/2.)
+            assert_equal(sites[0][1:], (1,0,0,1))
+        assert_equal(sorted(self.queries), [1,2,3])
+        assert(threading.currentThread().getName() not in self.threads)
+        
+        # The results are cached under the SQLite database's version markers.
+        forget_species_queries()
+        out = list(prefetch_species(species, self.factory))
+        assert_equal(len(self.queries), 3)
+        
+    def test_lazy(self):
+        "Tests that a LazySession doesn't open a session until it's used."
+        opened = []
+        def factory():
+            opened.append(1)
+            return self.factory()
+        session = LazySession(factory)
+        assert_equal(len(opened), 0)
+        assert_equal(session.execute(text('select count(*) from vector_sampleperiod')).fetchone()[0], 3)
+        assert_equal(len(opened), 1)
+
+if __name__ == '__main__':
+    nose.runmodule()
@@ -0,0 +1,37 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+from anopheles.spatial_submodels import covariance_pivots
+
+class SquaredExponential(object):
+    "Stands in for a PyMC covariance; C(x) is the diagonal."
+    def __init__(self, scale):
+        self.scale = scale
+    def __call__(self, x, y=None):
+        if y is None:
+            return np.ones(len(x))
+        return np.exp(-((x[:,np.newaxis,:]-y[np.newaxis,:,:])**2).sum(axis=-1)/self.scale**2)
+
+class test_pivots(object):
+    def setUp(self):
+        self.x = np.random.normal(size=(300,3))
+        self.C = SquaredExponential(1.)
+        
+    def test_rank(self):
+        "Tests that at most rank distinct pivots are chosen."
+        pivots = covariance_pivots(self.C, self.x, 40, tol=0)
+        assert_equal(len(pivots), 40)
+        assert_equal(len(np.unique(pivots)), 40)
+        
+    def test_tolerance(self):
+        "Tests that pivoting stops once the conditional variances are small, and that the pivots krige the rest well."
+        x = np.vstack((self.x[:20],)*10)
+        pivots = covariance_pivots(self.C, x, 100, tol=1e-6)
+        assert(len(pivots) <= 20)
+        K = self.C(x,x)
+        Kp = K[:,pivots]
+        cond = np.diag(K) - (Kp*np.linalg.solve(K[np.ix_(pivots,pivots)], Kp.T).T).sum(axis=1)
+        assert(cond.max() < 1e-5)
+        
+if __name__ == '__main__':
+    nose.runmodule()
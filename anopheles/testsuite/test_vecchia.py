@@ -0,0 +1,51 @@
+from numpy.testing import *
+import nose,  warnings
+import numpy as np
+import pymc as pm
+from anopheles.spatial_submodels import spatial_mahalanobis
+from anopheles.vecchia import *
+
+class test_vecchia(object):
+    def setUp(self):
+        n = 60
+        self.x = np.hstack((np.random.uniform(-1,1,size=(n,1)), np.random.uniform(-.5,.5,size=(n,1)), np.random.normal(size=(n,2))))
+        self.xp = np.hstack((np.random.uniform(-1,1,size=(20,1)), np.random.uniform(-.5,.5,size=(20,1)), np.random.normal(size=(20,2))))
+        self.C = pm.gp.FullRankCovariance(spatial_mahalanobis, dds=1.5, dde=1.5, amp=1.0, scale=.5, val=np.array([1.,2.]),
+                                            vec=np.eye(2), spat_frac=1./3, const_frac=1./3)
+        self.K = np.asarray(self.C(self.x,self.x)) + np.eye(n)*1e-8
+        self.index = NeighbourIndex(self.x)
+        self.f = np.random.normal(size=n)
+
+    def test_neighbours(self):
+        "Tests that each point's neighbours are its nearest predecessors."
+        nbrs = self.index.previous_neighbours(5)
+        for i in xrange(1, len(self.x)):
+            d = ((self.index.z[:i]-self.index.z[i])**2).sum(axis=1)
+            assert_equal(set(nbrs[i][nbrs[i]>=0]), set(np.argsort(d)[:5]))
+
+    def test_exact(self):
+        "Tests that conditioning on every predecessor reproduces the dense model."
+        n = len(self.x)
+        U = vecchia_factor(self.C, self.x, self.index.previous_neighbours(n-1), self.index)
+        logp = -.5*(np.dot(self.f, np.linalg.solve(self.K, self.f)) + np.linalg.slogdet(self.K)[1] + n*np.log(2*np.pi))
+        assert_almost_equal(U.logp(self.f), logp, 6)
+        Ud = np.array([U.row(i) for i in xrange(n)])
+        assert_almost_equal(np.dot(Ud.T, Ud), self.K, 8)
+        assert_almost_equal(U.color(U.whiten(self.f)), self.f, 10)
+
+    def test_kriging(self):
+        "Tests that kriging from every inducing point matches dense kriging."
+        A = kriging_matrix(self.C, self.index, self.x, self.xp, len(self.x))
+        dense = np.dot(np.asarray(self.C(self.xp,self.x)), np.linalg.solve(self.K, self.f))
+        assert_almost_equal(A*self.f, dense, 8)
+
+    def test_offdiag(self):
+        "Tests that the off-diagonal operators map g to the kriged field."
+        U = vecchia_factor(self.C, self.x, self.index.previous_neighbours(8), self.index)
+        od = U.offdiag(self.C, self.x, self.xp)
+        g = U.whiten(self.f)
+        assert_almost_equal(od.dot(g), od.A*self.f, 10)
+        assert_almost_equal(od.column(3), od.A*U.row(3), 10)
+
+if __name__ == '__main__':
+    nose.runmodule()
@@ -18,7 +18,7 @@ from __future__ import division
 # Throughout, p is predicted and a is actual
 
 import numpy as np
-from env_data import extract_environment
+from env_data import extract_environment_many
 
 __all__ = ['compose','simple_assessments','roc','plot_roc','plot_roc_','validate','plot_validation']
 
@@ -115,7 +115,7 @@ def validate(M, session, x, a, burn=0, trace_thin=1):
     names = [s.__name__ for s in simple_assessments]
     results = dict([(n, []) for n in names])
     
-    env_x = np.array([extract_environment(n, x * 180./np.pi) for n in M.env_variables]).T
+    env_x = extract_environment_many(M.env_variables, x * 180./np.pi)
     full_x = np.hstack((x,env_x))
 
     ptrace = M.trace('p')[:]
@@ -0,0 +1,323 @@
+# Copyright (C) 2009  Anand Patil
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A nearest-neighbour (Vecchia) spatial submodel.
+
+The inducing points are put in a random order, and the field at each one is
+conditioned only on its nearest neighbours among the points before it, with
+distances measured on the unit sphere plus the normalized covariates. The
+prior of the field then has a sparse precision B^T D^{-1} B, where B is unit
+lower-triangular with one row of conditioning coefficients per point and D
+holds the conditional variances, so its log-density is linear in the number
+of points. Values elsewhere are kriged from their nearest inducing points,
+so prediction is linear too.
+
+VecchiaFactor stands in for the dense Cholesky factor U_fr of
+lr_spatial_env, with f = U^T g for U = D^{1/2} B^{-T}, so the step methods
+and make_model's evaluation groups work with either submodel.
+"""
+
+import numpy as np
+import pymc as pm
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from spatial_submodels import normalize_env, spatial_mahalanobis, spatial_mahalanobis_blocks, reference_covariance
+from factor_cache import factor_cache, covariance_key, array_key, not_positive_definite
+
+__all__ = ['NeighbourIndex', 'VecchiaFactor', 'VecchiaOffdiag', 'VecchiaP', 'vecchia_factor', 'kriging_matrix', 'vecchia_spatial_env']
+
+# Relative jitter added to the variances, so that coincident points can be conditioned on.
+jitter = 1.e-8
+
+# Neighbourhoods are evaluated this many points at a time, to bound memory.
+chunk = 4096
+
+def embed(x):
+    "Maps normalized (lon, lat, covariates) rows to the unit sphere plus covariate space."
+    lon = x[:,0]
+    lat = x[:,1]
+    return np.hstack((np.cos(lat)[:,np.newaxis]*np.cos(lon)[:,np.newaxis],
+                        np.cos(lat)[:,np.newaxis]*np.sin(lon)[:,np.newaxis],
+                        np.sin(lat)[:,np.newaxis],
+                        x[:,2:]))
+
+class NeighbourIndex(object):
+    """
+    A spatial index of a set of normalized points. The tree is built on
+    first use and isn't pickled.
+    """
+    def __init__(self, x):
+        self.z = embed(x)
+        self._tree = None
+
+    def __getstate__(self):
+        return {'z': self.z, '_tree': None}
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            self._tree = cKDTree(self.z)
+        return self._tree
+
+    def nearest(self, x, m):
+        "Returns the indices of the m nearest indexed points to each of the normalized points x."
+        m = min(m, len(self.z))
+        d, idx = self.tree.query(embed(x), m)
+        return np.reshape(idx, (len(x), m))
+
+    def previous_neighbours(self, m):
+        """
+        Returns an array holding the indices of the m nearest earlier points
+        to each point, padded with -1 for the first m points. Points with too
+        few earlier points among their nearest are searched again with twice
+        as many, until every point has enough.
+        """
+        n = len(self.z)
+        nbrs = -np.ones((n, m), dtype=int)
+        todo = np.arange(1, n)
+        k = min(n, 4*m+1)
+        while len(todo) > 0:
+            d, idx = self.tree.query(self.z[todo], k)
+            idx = np.reshape(idx, (len(todo), k))
+            short = []
+            for j, i in enumerate(todo):
+                prev = idx[j][idx[j] < i][:m]
+                if len(prev) < min(m, i) and k < n:
+                    short.append(i)
+                else:
+                    nbrs[i,:len(prev)] = prev
+            todo = np.array(short, dtype=int)
+            k = min(n, 2*k)
+        return nbrs
+
+def _conditioning(params, x, xp, nbrs):
+    """
+    Returns the kriging weights of the points x[nbrs] for the points xp and
+    the kriging variances. Entries of nbrs that are -1 are ignored.
+    """
+    mask = nbrs >= 0
+    X = x[np.where(mask, nbrs, 0)]
+    K = spatial_mahalanobis_blocks(X, X, **params)
+    k = spatial_mahalanobis_blocks(X, xp[:,np.newaxis,:], **params)[:,:,0]
+    var = spatial_mahalanobis_blocks(xp[:,np.newaxis,:], xp[:,np.newaxis,:], **params)[:,0,0]
+    m = nbrs.shape[1]
+    eye = np.eye(m)
+    both = mask[:,:,np.newaxis]*mask[:,np.newaxis,:]
+    K = np.where(both, K, 0) + eye*np.where(mask, var.max()*jitter, 1)[:,:,np.newaxis]
+    k = np.where(mask, k, 0)
+    w = np.linalg.solve(K, k[:,:,np.newaxis])[:,:,0]
+    return w, var*(1+jitter) - (w*k).sum(axis=1)
+
+def vecchia_factor(C, x, nbrs, index):
+    """
+    Returns the VecchiaFactor of C on x, conditioning each point on its
+    neighbours nbrs, or None if a conditional variance isn't positive.
+    """
+    n, m = nbrs.shape
+    coeffs = np.empty((n, m))
+    cond_var = np.empty(n)
+    for start in xrange(0, n, chunk):
+        stop = min(start+chunk, n)
+        coeffs[start:stop], cond_var[start:stop] = _conditioning(C.params, x, x[start:stop], nbrs[start:stop])
+    if np.any(cond_var <= 0):
+        return None
+    return VecchiaFactor(x, nbrs, coeffs, cond_var, index)
+
+def cached_vecchia_factor(C, x, nbrs, index, cache=None):
+    "Returns vecchia_factor(C, x, nbrs, index) from the factor cache."
+    def compute():
+        U = vecchia_factor(C, x, nbrs, index)
+        return not_positive_definite if U is None else U
+    U = (cache or factor_cache()).get(('vecchia', covariance_key(C), array_key(x), array_key(nbrs)), compute)
+    if U is not_positive_definite:
+        return None
+    return U
+
+def kriging_matrix(C, index, x, xp, m):
+    """
+    Returns a sparse matrix whose rows krige the field at the normalized
+    points xp from its values at their m nearest neighbours among x.
+    """
+    m = min(m, len(x))
+    nbrs = index.nearest(xp, m)
+    w = np.empty(nbrs.shape)
+    for start in xrange(0, len(xp), chunk):
+        stop = min(start+chunk, len(xp))
+        w[start:stop] = _conditioning(C.params, x, xp[start:stop], nbrs[start:stop])[0]
+    return sparse.csr_matrix((w.ravel(), nbrs.ravel(), np.arange(0, len(xp)*m+1, m)), shape=(len(xp), len(x)))
+
+class VecchiaFactor(object):
+    """
+    The factor U = D^{1/2} B^{-T} of the nearest-neighbour approximation to
+    a covariance, kept in sparse form. f = U^T g is color(g) and g = U^{-T} f
+    is whiten(f). Rows of U are computed one at a time, with a triangular
+    solve.
+    """
+    def __init__(self, x, nbrs, coeffs, cond_var, index):
+        self.x = x
+        self.nbrs = nbrs
+        self.coeffs = coeffs
+        self.cond_var = cond_var
+        self.index = index
+        n, m = nbrs.shape
+        rows = np.repeat(np.arange(n), m)
+        mask = nbrs.ravel() >= 0
+        B = sparse.coo_matrix((np.hstack((np.ones(n), -coeffs.ravel()[mask])),
+                                (np.hstack((np.arange(n), rows[mask])), np.hstack((np.arange(n), nbrs.ravel()[mask])))),
+                                shape=(n,n))
+        self.B = B.tocsr()
+        self.nbytes = coeffs.nbytes + cond_var.nbytes + self.B.data.nbytes + self.B.indices.nbytes
+        self.shape = (n,n)
+        self._lu = None
+        self._row = (None, None)
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_lu'] = None
+        state['_row'] = (None, None)
+        return state
+
+    @property
+    def lu(self):
+        # B is triangular, so with the natural ordering and no pivoting its LU factors have no fill.
+        if self._lu is None:
+            self._lu = splu(self.B.tocsc(), permc_spec='NATURAL', diag_pivot_thresh=0)
+        return self._lu
+
+    def logp(self, f):
+        "The log-density of f under the approximation, in linear time."
+        r = self.B*f
+        return -.5*(np.sum(r**2/self.cond_var) + np.sum(np.log(self.cond_var)) + len(f)*np.log(2*np.pi))
+
+    def whiten(self, f):
+        return (self.B*f)/np.sqrt(self.cond_var)
+
+    def color(self, g):
+        return self.lu.solve(np.sqrt(self.cond_var)*g)
+
+    def row(self, i):
+        "Row i of U, the change in f per unit change in g[i]."
+        if self._row[0] != i:
+            e = np.zeros(self.shape[0])
+            e[i] = np.sqrt(self.cond_var[i])
+            self._row = (i, self.lu.solve(e))
+        return self._row[1]
+
+    def offdiag(self, C, x, xp):
+        "The off-diagonal operator C(xp,x) U^{-1}, kriging from the nearest neighbours."
+        return VecchiaOffdiag(self, kriging_matrix(C, self.index, self.x, xp, self.nbrs.shape[1]))
+
+class VecchiaOffdiag(object):
+    """
+    The operator A U^T mapping the whitened field g to the field at some
+    evaluation points, where the sparse matrix A kriges them from their
+    nearest inducing points.
+    """
+    def __init__(self, factor, A):
+        self.factor = factor
+        self.A = A
+        self.shape = A.shape
+        self.nbytes = A.data.nbytes + A.indices.nbytes
+        self._column = (None, None)
+
+    def dot(self, g):
+        return self.A*self.factor.color(g)
+
+    def column(self, i):
+        if self._column[0] != i:
+            self._column = (i, self.A*self.factor.row(i))
+        return self._column[1]
+
+class VecchiaP(object):
+    """
+    A closure that can evaluate a nearest-neighbour field. Normalizes the
+    third argument onward.
+    """
+    def __init__(self, x_fr, C, krige_wt, U_fr, means, stds, f2p):
+        self.x_fr = x_fr
+        self.C = C
+        self.krige_wt = krige_wt
+        self.U_fr = U_fr
+        self.means = means
+        self.stds = stds
+        self.f2p = f2p
+
+    def __call__(self, x, f2p=None, offdiag=None):
+        if f2p is None:
+            f2p = self.f2p
+        if offdiag is None:
+            x_norm = normalize_env(x, self.means, self.stds)
+            offdiag = self.U_fr.offdiag(self.C, self.x_fr, x_norm)
+        return f2p(np.asarray(offdiag.dot(self.krige_wt)).reshape(x.shape[:-1]))
+
+def vecchia_spatial_env(n_neighbours=10, seed=0, **stuff):
+    """
+    A nearest-neighbour spatial-only model, with the same covariance and
+    priors as lr_spatial_env. Each inducing point is conditioned on its
+    n_neighbours nearest predecessors in an order drawn with the given seed,
+    and the inducing points are returned in that order as x_fr.
+    """
+
+    x_fr = normalize_env(stuff['full_x_fr'], stuff['env_means'], stuff['env_stds'])
+    f2p = stuff['f2p']
+
+    # Random orderings give good nearest-neighbour approximations. The
+    # neighbours don't depend on the covariance parameters, so they are
+    # found once.
+    order = np.random.RandomState(seed).permutation(len(x_fr))
+    x_fr = x_fr[order]
+    index = NeighbourIndex(x_fr)
+    nbrs = index.previous_neighbours(n_neighbours)
+
+    n_env = stuff['env_in'].shape[1]
+    val = np.array([pm.Gamma('val_%i'%i,3,3,value=1) for i in xrange(n_env)])
+    vec = np.eye(n_env)
+    scale = pm.Gamma('scale',3,3)
+    const_frac = 1./3
+    spat_frac = 1./3
+
+    @pm.deterministic
+    def C(val=val,vec=vec,const_frac=const_frac,spat_frac=spat_frac,scale=scale):
+        return pm.gp.FullRankCovariance(spatial_mahalanobis, dds=1.5, dde=1.5, amp=1.0, scale=scale,val=val, vec=vec, spat_frac=spat_frac, const_frac=const_frac)
+
+    @pm.deterministic(trace=False)
+    def U_fr(C=C):
+        return cached_vecchia_factor(C, x_fr, nbrs, index)
+
+    @pm.potential
+    def rank_check(U=U_fr):
+        if U is None:
+            return -np.inf
+        else:
+            return 0.
+
+    @pm.stochastic(dtype=float)
+    def f_fr(value=np.ones(len(x_fr))*-.1, U=U_fr):
+        """The field at the inducing points."""
+        if U is None:
+            return -np.inf
+        return U.logp(value)
+
+    @pm.deterministic(trace=False)
+    def g_fr(f_fr=f_fr, U_fr=U_fr):
+        return U_fr.whiten(f_fr)
+
+    p = pm.Lambda('p', lambda x_fr=x_fr, C=C, krige_wt=g_fr, U_fr=U_fr, means=stuff['env_means'], stds=stuff['env_stds'], f2p=f2p: VecchiaP(x_fr, C, krige_wt, U_fr, means, stds, f2p))
+
+    return locals()
+
+vecchia_spatial_env.reference_covariance = reference_covariance
@@ -26,6 +26,7 @@ import pylab as pl
 pl.close('all')
 
 mask, x, img_extent = anopheles.make_covering_raster(100, env)
+x.close()
 mask, x, img_extent = anopheles.make_covering_raster(20, env)
 # outside_lat = (x[:,1]*180./np.pi>38)+(x[:,1]*180./np.pi<-36)
 # outside_lon = (x[:,0]*180./np.pi>56)+(x[:,0]*180./np.pi<-18)